@@ -1,47 +1,585 @@
 import os
+import io
+import re
+import gzip
+import json
 import time
 import webbrowser
 import http.server
-import socketserver
 import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
 from functools import partial
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import chunkStore
+import genBaseline
+import genRollup
+import genTiles
 
 
 # --- CẤU HÌNH ---
+HOST = ''         # '' = mọi địa chỉ; '127.0.0.1' để chỉ phục vụ máy local
 PORT = 8000
 HTML_FILE = 'viewer_lazy.html'
 
-def start_server():
-    """Hàm chạy Local Server trong luồng riêng"""
+# Mảnh giờ (YYYY-MM-DD_H.*) bị ghi lại dưới cùng URL (build tăng dần, liveIngest) nên
+# không cache dài: trình duyệt luôn hỏi lại bằng ETag, mảnh không đổi chỉ tốn một 304.
+# max-age dài chỉ hợp với URL gắn nội dung (hash trong tên file).
+SHARD_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}_\d+\.')
+SHARD_CACHE_CONTROL = 'no-cache'
+DEFAULT_CACHE_CONTROL = 'no-cache' # index.json, nodes.json, html: luôn hỏi lại (304 nếu không đổi)
+
+# Nén khi gửi cho các kiểu text nếu không có sẵn bản .gz/.br
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/x-ndjson', 'application/javascript',
+                      'application/octet-stream')
+MIN_COMPRESS_SIZE = 1024
+GZIP_CACHE_MB = 64 # bản gzip nén tại chỗ giữ lại theo ETag, khỏi nén lại mỗi request
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+# API /api/edges: các giờ vừa dùng giữ trong RAM dạng cột, bỏ giờ cũ nhất khi vượt giới hạn
+DATA_DIR = 'traffic_data_chunks'
+HOUR_CACHE_MB = 256
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+class _RangeFile:
+    """Đọc tối đa `length` byte từ vị trí `start` (phục vụ Range request)."""
+    def __init__(self, f, start, length):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+def parse_range(header, size):
+    """'bytes=a-b' -> (start, end) bao gồm end; None nếu không hợp lệ/nhiều đoạn, 'invalid' nếu vượt quá file."""
+    m = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', header or '')
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+    else:
+        # bytes=-N: N byte cuối
+        start = max(0, size - int(m.group(2)))
+        end = size - 1
+    if start >= size or start > end:
+        return 'invalid'
+    return start, min(end, size - 1)
+
+class HourCache:
+    """LRU các mảnh giờ đã nạp (dict cột numpy), giới hạn theo tổng dung lượng mảng.
+
+    `loader(data_dir, date_key, h)` đọc một giờ: mặc định chỉ cột agg, hoặc
+    genTiles.read_tile_index cho chỉ mục ô. Mỗi mục nhớ kèm mtime của file JSON
+    nguồn: mảnh bị build lại (tăng dần) thì lần truy vấn sau tự nạp lại.
+    """
+
+    def __init__(self, data_dir, max_bytes, loader=chunkStore.read_agg):
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, date_key, h):
+        """Các cột của (ngày, giờ); None nếu mảnh không tồn tại."""
+        key = (date_key, h)
+        try:
+            mtime = os.stat(os.path.join(self.data_dir, f"{date_key}_{h}.json")).st_mtime_ns
+        except OSError:
+            return None
+
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] == mtime:
+                self._items.move_to_end(key)
+                return item[1]
+
+        # Nạp ngoài khóa để các request giờ khác không phải chờ
+        agg = self.loader(self.data_dir, date_key, h)
+        size = sum(arr.nbytes for arr in agg.values())
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self._items[key] = (mtime, agg, size)
+            self.nbytes += size
+            # Luôn giữ lại mục vừa nạp kể cả khi riêng nó đã vượt giới hạn
+            while self.nbytes > self.max_bytes and len(self._items) > 1:
+                _, (_, _, old_size) = self._items.popitem(last=False)
+                self.nbytes -= old_size
+        return agg
+
+class BaselineCache:
+    """Hồ sơ tốc độ theo giờ-trong-tuần (genBaseline), nạp lại khi baseline.npz đổi."""
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._item = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """(bảng baseline, state) hoặc None nếu chưa dựng baseline."""
+        try:
+            mtime = os.stat(os.path.join(self.data_dir, genBaseline.BASELINE_DIRNAME, 'baseline.npz')).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            if self._item is None or self._item[0] != mtime:
+                self._item = (mtime, genBaseline.read_baseline(self.data_dir), genBaseline.load_state(self.data_dir))
+            return self._item[1], self._item[2]
+
+    def score(self, date_key, h, cols):
+        """Cột z / anomaly / base cho các cạnh của `cols` (None nếu chưa có baseline)."""
+        item = self.get()
+        if item is None:
+            return None
+        baseline, state = item
+        return genBaseline.score(baseline, date_key, h, cols['from'], cols['to'], cols['speed'],
+                                 genBaseline.is_included(state, self.data_dir, date_key, h))
+
+class GzipCache:
+    """LRU các bản gzip nén tại chỗ theo đường dẫn, giới hạn theo tổng số byte nén.
+
+    Mỗi mục nhớ kèm ETag (`mtime_ns-size-gzip`) của file gốc: file bị ghi lại thì
+    ETag lệch, lần sau nén lại và thay mục cũ.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, etag):
+        with self._lock:
+            item = self._items.get(path)
+            if item is None or item[0] != etag:
+                return None
+            self._items.move_to_end(path)
+            return item[1]
+
+    def put(self, path, etag, body):
+        with self._lock:
+            old = self._items.pop(path, None)
+            if old is not None:
+                self.nbytes -= len(old[1])
+            self._items[path] = (etag, body)
+            self.nbytes += len(body)
+            while self.nbytes > self.max_bytes and len(self._items) > 1:
+                _, (_, old_body) = self._items.popitem(last=False)
+                self.nbytes -= len(old_body)
+
+def query_param(query, name, cast):
+    """Giá trị tham số `name` đã ép kiểu, None nếu không truyền (ValueError nếu sai kiểu)."""
+    value = query.get(name, [''])[0]
+    return cast(value) if value != '' else None
+
+def int_list(value):
+    return {int(v) for v in value.split(',') if v.strip()}
+
+def filter_edges(agg, min_count=None, max_speed=None, limit=None, idx=None, scores=None):
+    """Lọc cạnh agg như viewer (c >= min_count, s <= max_speed), giữ thứ tự trong mảnh.
+
+    idx: chỉ xét các dòng này (vd. các cạnh của một ô bản đồ).
+    scores: cột z / anomaly / base cùng thứ tự với agg (genBaseline.score).
+    Trả về (tổng số cạnh thỏa điều kiện, danh sách tối đa `limit` cạnh {"f","t","s","tm","c"}
+    kèm "p50"/"p85"/"var" nếu mảnh có các cột thống kê này và "z"/"anomaly"/"base" nếu có scores;
+    z / base là null khi cạnh chưa đủ lịch sử).
+    """
+    if idx is None:
+        idx = np.arange(len(agg['count']))
+    mask = np.ones(len(idx), dtype=bool)
+    if min_count is not None:
+        mask &= agg['count'][idx] >= min_count
+    if max_speed is not None:
+        mask &= agg['speed'][idx] <= max_speed
+    idx = idx[mask]
+    total = len(idx)
+    if limit is not None:
+        idx = idx[:limit]
+    edges = [
+        {"f": f, "t": t, "s": s, "tm": tm, "c": c}
+        for f, t, s, tm, c in zip(agg['from'][idx].tolist(), agg['to'][idx].tolist(), agg['speed'][idx].tolist(),
+                                   agg['time'][idx].tolist(), agg['count'][idx].tolist())
+    ]
+    for name, key in chunkStore.AGG_STAT_COLUMNS.items():
+        if name in agg:
+            for e, v in zip(edges, agg[name][idx].tolist()):
+                e[key] = v
+    if scores is not None:
+        for name in genBaseline.SCORE_COLUMNS:
+            for e, v in zip(edges, scores[name][idx].tolist()):
+                e[name] = None if v != v else v # NaN không hợp lệ trong JSON
+    return total, edges
+
+class TrafficRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Phục vụ file tĩnh cho dashboard: nén, ETag/Last-Modified (304), Range, Cache-Control."""
+    protocol_version = 'HTTP/1.1' # giữ kết nối (keep-alive) cho nhiều request mảnh liên tiếp
+    extensions_map = {
+        **http.server.SimpleHTTPRequestHandler.extensions_map,
+        '.json': 'application/json',
+        '.ndjson': 'application/x-ndjson',
+        '.bin': 'application/octet-stream', # mảnh nhị phân (chunkStore.BINARY_HEADER)
+    }
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/api/edges':
+            return self.api_edges(parse_qs(url.query))
+        if url.path == '/api/range':
+            return self.api_range(parse_qs(url.query))
+        if url.path in ('/api/tile', '/api/bbox'):
+            return self.api_tiles(url.path, parse_qs(url.query))
+        if url.path == '/api/vehicle':
+            return self.api_vehicle(parse_qs(url.query))
+        if url.path == '/api/anomalies':
+            return self.api_anomalies(parse_qs(url.query))
+        return super().do_GET()
+
+    def api_edges(self, query):
+        """/api/edges?date=&hour=&min_count=&max_speed=&limit= -> các cạnh agg thỏa điều kiện.
+
+        Khi đã dựng baseline (genBaseline), mỗi cạnh kèm z-score / anomaly / base.
+        """
+        try:
+            date_key = query_param(query, 'date', str)
+            h = query_param(query, 'hour', int)
+            min_count = query_param(query, 'min_count', int)
+            max_speed = query_param(query, 'max_speed', float)
+            limit = query_param(query, 'limit', int)
+        except ValueError as e:
+            return self.send_json({"error": f"Tham số không hợp lệ: {e}"}, 400)
+        if date_key is None or not DATE_PATTERN.fullmatch(date_key) or h is None or not 0 <= h <= 23:
+            return self.send_json({"error": "Cần date=YYYY-MM-DD và hour=0..23"}, 400)
+        if limit is not None and limit < 0:
+            return self.send_json({"error": "limit phải >= 0"}, 400)
+
+        agg = self.server.hour_cache.get(date_key, h)
+        if agg is None:
+            return self.send_json({"error": f"Không có dữ liệu {date_key} {h}:00"}, 404)
+        scores = self.server.baseline_cache.score(date_key, h, agg)
+        total, edges = filter_edges(agg, min_count, max_speed, limit, scores=scores)
+        self.send_json({"date": date_key, "hour": h, "total": total, "edges": edges})
+
+    def api_range(self, query):
+        """/api/range?date_from=&date_to=&hour_from=&hour_to=&weekdays=&min_count=&max_speed=&limit=
+
+        Trung bình theo cạnh trên nhiều ngày/giờ, cộng từ các khối rollup (genRollup).
+        hour_to không bao gồm (7-9h: hour_from=7&hour_to=9), weekdays dạng 0,1,2 (0 = thứ Hai).
+        """
+        try:
+            date_from = query_param(query, 'date_from', str)
+            date_to = query_param(query, 'date_to', str)
+            hour_from = query_param(query, 'hour_from', int)
+            hour_to = query_param(query, 'hour_to', int)
+            weekdays = query_param(query, 'weekdays', int_list)
+            min_count = query_param(query, 'min_count', int)
+            max_speed = query_param(query, 'max_speed', float)
+            limit = query_param(query, 'limit', int)
+        except ValueError as e:
+            return self.send_json({"error": f"Tham số không hợp lệ: {e}"}, 400)
+        if any(d is not None and not DATE_PATTERN.fullmatch(d) for d in (date_from, date_to)):
+            return self.send_json({"error": "date_from/date_to phải dạng YYYY-MM-DD"}, 400)
+        if limit is not None and limit < 0:
+            return self.send_json({"error": "limit phải >= 0"}, 400)
+        # hour_to không bao gồm nên nhận tới 24 (20-24h: hour_from=20&hour_to=24)
+        if (hour_from is not None and not 0 <= hour_from <= 23) or (hour_to is not None and not 1 <= hour_to <= 24):
+            return self.send_json({"error": "Cần hour_from=0..23 và hour_to=1..24"}, 400)
+        if hour_from is not None and hour_to is not None and hour_from >= hour_to:
+            return self.send_json({"error": "hour_from phải nhỏ hơn hour_to"}, 400)
+        if weekdays is not None and not all(0 <= w <= 6 for w in weekdays):
+            return self.send_json({"error": "weekdays gồm các số 0..6 (0 = thứ Hai)"}, 400)
+        hours = range(0 if hour_from is None else hour_from, 24 if hour_to is None else hour_to)
+
+        out_dir = self.server.data_dir
+        try:
+            state = genRollup.load_state(out_dir)
+        except OSError:
+            return self.send_json({"error": "Chưa dựng rollup (genRollup.build_rollups)"}, 404)
+        cols, plan = genRollup.query_range(out_dir, date_from, date_to, hours, weekdays, state)
+        total, edges = filter_edges(cols, min_count, max_speed, limit)
+        self.send_json({"blocks": [kind if key is None else f"{kind}/{key}" for kind, key in plan],
+                        "total": total, "edges": edges})
+
+    def api_tiles(self, path, query):
+        """Cạnh của một giờ theo ô bản đồ, cạnh ít lượt bị lược bớt ở zoom thấp (genTiles).
+
+        /api/tile?date=&hour=&z=&x=&y=            : một ô z/x/y
+        /api/bbox?date=&hour=&zoom=&bbox=w,s,e,n  : mọi ô phủ khung nhìn
+        Cả hai nhận thêm min_count, max_speed, limit như /api/edges.
+        """
+        try:
+            date_key = query_param(query, 'date', str)
+            h = query_param(query, 'hour', int)
+            min_count = query_param(query, 'min_count', int)
+            max_speed = query_param(query, 'max_speed', float)
+            limit = query_param(query, 'limit', int)
+            if path == '/api/tile':
+                z, x, y = (query_param(query, k, int) for k in ('z', 'x', 'y'))
+                bbox = None
+            else:
+                z = query_param(query, 'zoom', int)
+                bbox = query_param(query, 'bbox', lambda v: [float(c) for c in v.split(',')])
+        except ValueError as e:
+            return self.send_json({"error": f"Tham số không hợp lệ: {e}"}, 400)
+        if date_key is None or not DATE_PATTERN.fullmatch(date_key) or h is None or not 0 <= h <= 23:
+            return self.send_json({"error": "Cần date=YYYY-MM-DD và hour=0..23"}, 400)
+        if z is None or not 0 <= z <= 24:
+            return self.send_json({"error": "Cần zoom 0..24"}, 400)
+        if path == '/api/tile' and (x is None or y is None or not (0 <= x < 1 << z and 0 <= y < 1 << z)):
+            return self.send_json({"error": "Ô x/y không hợp lệ"}, 400)
+        if path == '/api/bbox' and (bbox is None or len(bbox) != 4):
+            return self.send_json({"error": "Cần bbox=west,south,east,north"}, 400)
+
+        tiles = self.server.tile_cache.get(date_key, h)
+        if tiles is None:
+            return self.send_json({"error": f"Không có dữ liệu {date_key} {h}:00"}, 404)
+        idx = genTiles.tile_slice(tiles, z, x, y) if bbox is None else genTiles.bbox_slice(tiles, *bbox, z)
+        scores = self.server.baseline_cache.score(date_key, h, tiles)
+        total, edges = filter_edges(tiles, min_count, max_speed, limit, idx, scores)
+        self.send_json({"date": date_key, "hour": h, "zoom": z, "total": total, "edges": edges})
+
+    def api_vehicle(self, query):
+        """/api/vehicle?date=&vid= -> mọi chuyến trong ngày của một xe.
+
+        Dùng chỉ mục `{date}.vehicles.json` nên chỉ đọc đúng các đoạn byte của xe
+        trong từng mảnh giờ, không parse cả mảnh.
+        """
+        date_key = query_param(query, 'date', str)
+        vid = query_param(query, 'vid', str)
+        if date_key is None or not DATE_PATTERN.fullmatch(date_key) or not vid:
+            return self.send_json({"error": "Cần date=YYYY-MM-DD và vid"}, 400)
+        hours = chunkStore.read_vehicle_trips(self.server.data_dir, date_key, vid)
+        if hours is None:
+            return self.send_json({"error": f"Không có chỉ mục xe cho ngày {date_key}"}, 404)
+        if not hours:
+            return self.send_json({"error": f"Xe {vid} không có chuyến nào ngày {date_key}"}, 404)
+        self.send_json({"date": date_key, "vid": vid, "hours": [{"hour": h, "trips": trips} for h, trips in hours]})
+
+    def api_anomalies(self, query):
+        """/api/anomalies?date=&hour=&min_count=&limit= -> các cạnh chậm bất thường, z tăng dần.
+
+        So với hồ sơ (cạnh, giờ-trong-tuần) của genBaseline thay vì ngưỡng tốc độ cố định.
+        """
+        try:
+            date_key = query_param(query, 'date', str)
+            h = query_param(query, 'hour', int)
+            min_count = query_param(query, 'min_count', int)
+            limit = query_param(query, 'limit', int)
+        except ValueError as e:
+            return self.send_json({"error": f"Tham số không hợp lệ: {e}"}, 400)
+        if date_key is None or not DATE_PATTERN.fullmatch(date_key) or h is None or not 0 <= h <= 23:
+            return self.send_json({"error": "Cần date=YYYY-MM-DD và hour=0..23"}, 400)
+        if limit is not None and limit < 0:
+            return self.send_json({"error": "limit phải >= 0"}, 400)
+
+        agg = self.server.hour_cache.get(date_key, h)
+        if agg is None:
+            return self.send_json({"error": f"Không có dữ liệu {date_key} {h}:00"}, 404)
+        scores = self.server.baseline_cache.score(date_key, h, agg)
+        if scores is None:
+            return self.send_json({"error": "Chưa dựng baseline (genBaseline.build_baseline)"}, 404)
+        idx = np.flatnonzero(scores['anomaly'])
+        idx = idx[np.argsort(scores['z'][idx], kind='stable')]
+        total, edges = filter_edges(agg, min_count, None, limit, idx, scores)
+        self.send_json({"date": date_key, "hour": h, "threshold": -genBaseline.Z_THRESHOLD, "total": total,
+                        "edges": edges})
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+        encoding = None
+        if len(body) >= MIN_COMPRESS_SIZE and self.accepts('gzip'):
+            body = gzip.compress(body, compresslevel=5, mtime=0)
+            encoding = 'gzip'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def accepts(self, encoding):
+        """Client có nhận Content-Encoding này không (theo Accept-Encoding, tôn trọng q=0)."""
+        for part in self.headers.get('Accept-Encoding', '').split(','):
+            name, *params = part.strip().split(';')
+            if name.strip().lower() != encoding:
+                continue
+            q = 1.0
+            for param in params:
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            return q > 0
+        return False
+
+    def cache_control(self, path):
+        return SHARD_CACHE_CONTROL if SHARD_PATTERN.match(os.path.basename(path)) else DEFAULT_CACHE_CONTROL
+
+    def not_modified(self, etag, mtime):
+        inm = self.headers.get('If-None-Match')
+        if inm is not None:
+            return etag in [t.strip() for t in inm.split(',')] or inm.strip() == '*'
+        ims = self.headers.get('If-Modified-Since')
+        if ims:
+            try:
+                return int(mtime) <= parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+        return False
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or not os.path.isfile(path):
+            return super().send_head() # thư mục / 404 như cũ
+
+        ctype = self.guess_type(path)
+        range_header = self.headers.get('Range')
+
+        # Chọn bản gửi: bản nén sẵn (.br/.gz) nếu client nhận, Range luôn dùng bản gốc
+        encoding, file_path = None, path
+        if not range_header:
+            for enc, ext in PRECOMPRESSED:
+                if os.path.isfile(path + ext) and self.accepts(enc):
+                    encoding, file_path = enc, path + ext
+                    break
+
+        try:
+            f = open(file_path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        suffix = f"-{encoding}" if encoding else ''
+        etag = f'"{st.st_mtime_ns:x}-{size:x}{suffix}"'
+        body = None
+
+        # Nén tại chỗ cho file text lớn không có bản nén sẵn
+        if encoding is None and not range_header and size >= MIN_COMPRESS_SIZE \
+                and ctype.startswith(COMPRESSIBLE_TYPES) and self.accepts('gzip'):
+            encoding = 'gzip'
+            etag = f'"{st.st_mtime_ns:x}-{size:x}-gzip"'
+
+        if self.not_modified(etag, st.st_mtime):
+            f.close()
+            self.send_response(304)
+            self.send_common_headers(etag, st.st_mtime, path, encoding)
+            self.end_headers()
+            return None
+
+        if encoding == 'gzip' and file_path == path:
+            body = self.server.gzip_cache.get(path, etag)
+            if body is None and self.command == 'HEAD':
+                # HEAD không cần thân: không nén chỉ để biết độ dài, bỏ Content-Length
+                f.close()
+                self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                self.send_common_headers(etag, st.st_mtime, path, encoding)
+                self.end_headers()
+                return None
+            if body is None:
+                body = gzip.compress(f.read(), compresslevel=5, mtime=0)
+                self.server.gzip_cache.put(path, etag, body)
+            f.close()
+            f = io.BytesIO(body)
+            size = len(body)
+
+        status, length, content_range = 200, size, None
+        if range_header and self.headers.get('If-Range', etag) == etag:
+            rng = parse_range(range_header, size)
+            if rng == 'invalid':
+                f.close()
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            if rng is not None:
+                start, end = rng
+                status, length = 206, end - start + 1
+                content_range = f'bytes {start}-{end}/{size}'
+                f = _RangeFile(f, start, length)
+
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(length))
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.send_common_headers(etag, st.st_mtime, path, encoding)
+        self.end_headers()
+        return f
+
+    def send_common_headers(self, etag, mtime, path, encoding):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(mtime, usegmt=True))
+        self.send_header('Cache-Control', self.cache_control(path))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+
+def make_server(host=HOST, port=PORT, directory=None):
+    """Tạo server đa luồng phục vụ thư mục chứa script (mặc định)."""
     # Đảm bảo server chạy đúng thư mục chứa file script
-    directory = os.path.dirname(os.path.abspath(__file__))
-    
-    # Cấu hình Handler để phục vụ file từ thư mục hiện tại
-    handler = partial(http.server.SimpleHTTPRequestHandler, directory=directory)
-    
+    directory = directory or os.path.dirname(os.path.abspath(__file__))
+    handler = partial(TrafficRequestHandler, directory=directory)
+    httpd = http.server.ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    # Cache giờ dùng chung cho mọi luồng xử lý request (self.server.hour_cache)
+    httpd.data_dir = os.path.join(directory, DATA_DIR)
+    httpd.hour_cache = HourCache(httpd.data_dir, HOUR_CACHE_MB * 1024 * 1024)
+    httpd.tile_cache = HourCache(httpd.data_dir, HOUR_CACHE_MB * 1024 * 1024, genTiles.read_tile_index)
+    httpd.gzip_cache = GzipCache(GZIP_CACHE_MB * 1024 * 1024)
+    httpd.baseline_cache = BaselineCache(httpd.data_dir)
+    return httpd
+
+def start_server(host=HOST, port=PORT):
+    """Hàm chạy Local Server trong luồng riêng, trả về server (hoặc None nếu cổng bận)"""
     try:
-        with socketserver.TCPServer(("", PORT), handler) as httpd:
-            print(f"\n🚀 Server đang chạy tại: http://localhost:{PORT}")
-            print("❌ Nhấn Ctrl+C trong cửa sổ này để dừng chương trình.")
-            httpd.serve_forever()
+        httpd = make_server(host, port)
     except OSError as e:
-        print(f"\n⚠️ Cổng {PORT} đang bận. Có thể server đã chạy rồi.")
+        print(f"\n⚠️ Cổng {port} đang bận. Có thể server đã chạy rồi.")
+        return None
+
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"\n🚀 Server đang chạy tại: http://{host or 'localhost'}:{port}")
+    print("❌ Nhấn Ctrl+C trong cửa sổ này để dừng chương trình.")
+    return httpd
 
-def main():
+def main(host=HOST, port=PORT, open_browser=True):
 
     # 2. KHỞI ĐỘNG SERVER (Background)
     print(f"\n--- BƯỚC 2: KHỞI ĐỘNG WEB APP ---")
-    server_thread = threading.Thread(target=start_server)
-    server_thread.daemon = True # Tự tắt khi chương trình chính tắt
-    server_thread.start()
+    httpd = start_server(host, port)
 
     # Đợi xíu cho server lên sóng
-    time.sleep(1.5)
+    time.sleep(0.5)
 
     # 3. TỰ ĐỘNG MỞ TRÌNH DUYỆT
-    url = f"http://localhost:{PORT}/{HTML_FILE}"
-    print(f"Dang mở trình duyệt: {url}")
-    webbrowser.open(url)
+    url = f"http://{host or 'localhost'}:{port}/{HTML_FILE}"
+    if open_browser:
+        print(f"Dang mở trình duyệt: {url}")
+        webbrowser.open(url)
 
     # Giữ chương trình chạy để server không bị tắt
     try:
@@ -49,6 +587,10 @@ def main():
             time.sleep(1)
     except KeyboardInterrupt:
         print("\n🛑 Đã dừng chương trình.")
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
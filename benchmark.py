@@ -0,0 +1,148 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import contextlib
+import numpy as np
+import pandas as pd
+import genSynthetic
+import genCluster
+import genFullMap
+import genCSV
+import gpsLoader
+from nodeIndex import NodeIndex
+
+# --- CẤU HÌNH ---
+# Các quy mô dữ liệu giả (tham số của genSynthetic.generate)
+SCALES = {
+    'small': dict(n_routes=20, stops_per_route=15, n_stations=150, n_vehicles=100, points_per_vehicle=300, n_days=2),
+    'medium': dict(n_routes=60, stops_per_route=25, n_stations=600, n_vehicles=500, points_per_vehicle=1000, n_days=2),
+    'large': dict(n_routes=150, stops_per_route=30, n_stations=1500, n_vehicles=2000, points_per_vehicle=2000, n_days=3),
+}
+DEFAULT_SCALES = ('small', 'medium')
+CLUSTER_RADIUS = 200
+MATCH_RADIUS = 50
+RESULTS_DIR = 'benchmark_results'
+
+class StageTimer:
+    """Đo wall/CPU time của từng bước, in pipeline được gom lại cho gọn."""
+
+    def __init__(self, verbose=False):
+        self.stages = {}
+        self.verbose = verbose
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        out = io.StringIO()
+        wall, cpu = time.perf_counter(), time.process_time()
+        with contextlib.redirect_stdout(sys.stdout if self.verbose else out):
+            yield
+        self.stages[name] = {
+            "wall_s": round(time.perf_counter() - wall, 4),
+            "cpu_s": round(time.process_time() - cpu, 4),
+        }
+        print(f"   {name:<14} {self.stages[name]['wall_s']:>8.3f}s")
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_scale(name, params, seed, workers=1, verbose=False):
+    """Sinh dữ liệu một quy mô rồi đo từng bước pipeline trong thư mục tạm."""
+    print(f"\n📏 Quy mô '{name}': {params}")
+    timer = StageTimer(verbose)
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    old_cwd = os.getcwd()
+    counts = {}
+    try:
+        # genFullMap / genCSV dùng đường dẫn tương đối (traffic_data_chunks/, *.csv)
+        os.chdir(work_dir)
+        with timer.stage('generate'):
+            routes_dir, gps_dir = genSynthetic.generate(work_dir, seed=seed, **params)
+        gps_files = sorted(os.path.join(gps_dir, f) for f in os.listdir(gps_dir))
+        nodes_file = os.path.join(work_dir, 'grouped_stops_nested.csv')
+
+        with timer.stage('clustering'):
+            genCluster.group_stops_nested_structure(routes_dir, nodes_file, radius_meters=CLUSTER_RADIUS)
+
+        # Tách từng bước trên file GPS đầu tiên
+        with timer.stage('node_index'):
+            index = NodeIndex.from_csv(nodes_file)
+        with timer.stage('load_gps'):
+            df = gpsLoader.load_gps(gps_files[0])
+        with timer.stage('map_matching'):
+            df['node_id'] = index.match(df['lat'].values, df['lng'].values, MATCH_RADIUS)
+        with timer.stage('transitions'):
+            df = df.sort_values(['anonymized_vehicle', 'datetime'])
+            veh_codes, veh_keys = pd.factorize(df['anonymized_vehicle'], sort=False)
+            trans = genFullMap.extract_transitions(veh_codes, df['node_id'].values, df['datetime'].values, 5, 5400)
+        with timer.stage('build_chunks'):
+            chunks = genFullMap.build_hourly_chunks(trans, [str(v) for v in veh_keys], index.node_lat, index.node_lng)
+        os.makedirs(genFullMap.OUTPUT_DIR, exist_ok=True)
+        with timer.stage('write_shards'):
+            for h, chunk in chunks.items():
+                genFullMap.write_chunk('bench', h, chunk)
+        shutil.rmtree(genFullMap.OUTPUT_DIR)
+        counts.update({
+            "gps_rows_per_file": int(len(df)), "match_rate": round(float((df['node_id'] != -1).mean()), 4),
+            "nodes": len(index), "transitions_per_file": int(len(trans['veh'])),
+        })
+
+        # Toàn bộ pipeline trên mọi ngày rồi xuất CSV
+        with timer.stage('pipeline'):
+            genFullMap.create_sharded_traffic_map(nodes_file, gps_dir, radius=MATCH_RADIUS, workers=workers, rebuild=True)
+        with timer.stage('export_csv'):
+            genCSV.export_data()
+        counts["gps_files"] = len(gps_files)
+        counts["shard_bytes"] = sum(
+            os.path.getsize(os.path.join(genFullMap.OUTPUT_DIR, f)) for f in os.listdir(genFullMap.OUTPUT_DIR)
+            if os.path.isfile(os.path.join(genFullMap.OUTPUT_DIR, f))
+        )
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {"params": params, "counts": counts, "stages": timer.stages}
+
+def run_benchmark(scales=DEFAULT_SCALES, seed=0, workers=1, out_file=None, verbose=False):
+    """Chạy benchmark các quy mô, ghi kết quả JSON (mặc định benchmark_results/bench_<thời gian>.json)."""
+    results = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "git_commit": git_commit(),
+        "seed": seed,
+        "workers": workers,
+        "env": {
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "numpy": np.__version__, "pandas": pd.__version__,
+            "pyarrow": gpsLoader.has_pyarrow(),
+        },
+        "scales": {},
+    }
+    for name in scales:
+        results["scales"][name] = run_scale(name, SCALES[name], seed, workers, verbose)
+
+    if out_file is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out_file = os.path.join(RESULTS_DIR, f"bench_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n✔ Đã ghi kết quả benchmark: {out_file}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pipeline trên dữ liệu giả lập")
+    parser.add_argument('--scales', nargs='+', default=list(DEFAULT_SCALES), choices=list(SCALES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--out', default=None, help="file JSON kết quả")
+    parser.add_argument('--verbose', action='store_true', help="hiện log của từng bước")
+    args = parser.parse_args()
+    run_benchmark(args.scales, args.seed, args.workers, args.out, args.verbose)
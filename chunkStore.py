@@ -0,0 +1,428 @@
+import os
+import json
+import gzip
+import shutil
+import struct
+import numpy as np
+try:
+    import orjson # tùy chọn: mã hóa mảnh JSON nhanh hơn
+except ImportError:
+    orjson = None
+
+# --- CẤU HÌNH ---
+# 'npy': mỗi cột một file .npy trong thư mục `{date}_{h}.cols/` (đọc bằng memory-map, không cần thư viện ngoài)
+# 'parquet': `{date}_{h}.agg.parquet` + `{date}_{h}.trips.parquet` (cần pyarrow)
+COLUMNAR_FORMATS = ('npy', 'parquet')
+# Bản nén đi kèm `.ndjson` cho viewer: 'gz' (stdlib) và 'br' (cần gói brotli)
+NDJSON_COMPRESSIONS = ('gz', 'br')
+
+# Mảnh nhị phân `{date}_{h}.bin` cho viewer (little-endian, mọi đoạn căn 4 byte để
+# trình duyệt đọc thẳng vào Uint32Array/Float32Array/Uint16Array):
+#   header 32 byte: magic 'TRFB', version u16, header_size u16,
+#                   n_agg u32, n_trips u32, n_vehicles u32, vehicles_bytes u32, 8 byte trống
+#   agg  : f u32[n_agg], t u32[n_agg], s f32[n_agg], tm f32[n_agg], c u16[n_agg] (+ đệm),
+#          p50 f32[n_agg], p85 f32[n_agg], var f64[n_agg] (từ version 2, NaN nếu mảnh không có)
+#   trips: f u32[n_trips], t u32[n_trips], s f32[n_trips], tm f32[n_trips], vehicle_code u32[n_trips]
+#   vehicles: mảng JSON (UTF-8) mã xe, vị trí = vehicle_code
+BINARY_MAGIC = b'TRFB'
+BINARY_VERSION = 2
+BINARY_HEADER = struct.Struct('<4sHHIIII8x')
+BINARY_AGG_V1 = (('from', '<u4'), ('to', '<u4'), ('speed', '<f4'), ('time', '<f4'), ('count', '<u2'))
+BINARY_AGG = BINARY_AGG_V1 + (('p50', '<f4'), ('p85', '<f4'), ('var', '<f8'))
+BINARY_TRIPS = (('from', '<u4'), ('to', '<u4'), ('speed', '<f4'), ('time', '<f4'), ('vehicle_code', '<u4'))
+
+AGG_COLUMNS = {'from': np.int32, 'to': np.int32, 'speed': np.float32, 'time': np.float32, 'count': np.int32}
+# Thống kê thêm của agg (edgeStats): cột -> khóa JSON; mảnh cũ không có thì bỏ qua.
+# Lưu float64 vì phương sai có thể lớn tới mức float32 không giữ được chữ số thập phân.
+AGG_STAT_COLUMNS = {'p50': 'p50', 'p85': 'p85', 'var': 'var'}
+TRIP_COLUMNS = {'from': np.int32, 'to': np.int32, 'speed': np.float32, 'time': np.float32, 'vehicle_code': np.int32}
+
+def chunk_to_columns(chunk):
+    """{"agg": [...], "veh": {vid: [...]}} -> (cột agg, cột trips, danh sách vid).
+
+    Thứ tự dòng trips giữ đúng thứ tự trong `veh`, vehicle_code là vị trí của
+    xe trong danh sách vid nên dựng lại được đúng dict ban đầu.
+    """
+    aggs = chunk["agg"]
+    agg = {
+        'from': np.fromiter((e["f"] for e in aggs), AGG_COLUMNS['from'], len(aggs)),
+        'to': np.fromiter((e["t"] for e in aggs), AGG_COLUMNS['to'], len(aggs)),
+        'speed': np.fromiter((e["s"] for e in aggs), AGG_COLUMNS['speed'], len(aggs)),
+        'time': np.fromiter((e["tm"] for e in aggs), AGG_COLUMNS['time'], len(aggs)),
+        'count': np.fromiter((e["c"] for e in aggs), AGG_COLUMNS['count'], len(aggs)),
+    }
+    for name, key in AGG_STAT_COLUMNS.items():
+        agg[name] = np.fromiter((e.get(key, np.nan) for e in aggs), np.float64, len(aggs))
+
+    vehicles = list(chunk["veh"])
+    trips = [(code, e) for code, vid in enumerate(vehicles) for e in chunk["veh"][vid]]
+    trip = {
+        'from': np.fromiter((e["f"] for _, e in trips), TRIP_COLUMNS['from'], len(trips)),
+        'to': np.fromiter((e["t"] for _, e in trips), TRIP_COLUMNS['to'], len(trips)),
+        'speed': np.fromiter((e["s"] for _, e in trips), TRIP_COLUMNS['speed'], len(trips)),
+        'time': np.fromiter((e["tm"] for _, e in trips), TRIP_COLUMNS['time'], len(trips)),
+        'vehicle_code': np.fromiter((c for c, _ in trips), TRIP_COLUMNS['vehicle_code'], len(trips)),
+    }
+    return agg, trip, vehicles
+
+def restore_float(arr):
+    """float32 đã lưu -> đúng giá trị float64 làm tròn 1 chữ số như trong JSON."""
+    return np.round(np.asarray(arr, dtype=np.float64), 1)
+
+def _npy_dir(out_dir, date_key, h):
+    return os.path.join(out_dir, f"{date_key}_{h}.cols")
+
+def _parquet_paths(out_dir, date_key, h):
+    base = os.path.join(out_dir, f"{date_key}_{h}")
+    return f"{base}.agg.parquet", f"{base}.trips.parquet"
+
+def write_columnar(out_dir, date_key, h, chunk, fmt='npy'):
+    """Ghi một mảnh giờ ở dạng cột bên cạnh file JSON."""
+    agg, trip, vehicles = chunk_to_columns(chunk)
+
+    if fmt == 'npy':
+        final_dir = _npy_dir(out_dir, date_key, h)
+        tmp_dir = f"{final_dir}.tmp{os.getpid()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for table, cols in (('agg', agg), ('trips', trip)):
+            for name, arr in cols.items():
+                np.save(os.path.join(tmp_dir, f"{table}_{name}.npy"), arr)
+        with open(os.path.join(tmp_dir, 'vehicles.json'), 'w', encoding='utf-8') as f:
+            json.dump(vehicles, f)
+        # Thay cả thư mục một lần để reader không thấy mảnh ghi dở
+        if os.path.exists(final_dir):
+            shutil.rmtree(final_dir)
+        os.replace(tmp_dir, final_dir)
+
+    elif fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        agg_path, trip_path = _parquet_paths(out_dir, date_key, h)
+        meta = {b'vehicles': json.dumps(vehicles).encode('utf-8')}
+        for path, table in ((agg_path, pa.table(agg)), (trip_path, pa.table(trip).replace_schema_metadata(meta))):
+            tmp_path = f"{path}.tmp{os.getpid()}"
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+
+    else:
+        raise ValueError(f"Định dạng cột không hỗ trợ: {fmt} (chọn trong {COLUMNAR_FORMATS})")
+
+def has_columnar(out_dir, date_key, h):
+    return os.path.isdir(_npy_dir(out_dir, date_key, h)) or os.path.exists(_parquet_paths(out_dir, date_key, h)[0])
+
+def read_columnar(out_dir, date_key, h, mmap=True):
+    """Đọc mảnh dạng cột nếu có, trả về (agg, trips, vehicles) hoặc None.
+
+    Cột speed/time được trả về float64 đã làm tròn như JSON, các cột số
+    nguyên được memory-map trực tiếp (npy) nên không phải parse gì.
+    """
+    npy_dir = _npy_dir(out_dir, date_key, h)
+    if os.path.isdir(npy_dir):
+        mode = 'r' if mmap else None
+        agg = {name: np.load(os.path.join(npy_dir, f"agg_{name}.npy"), mmap_mode=mode) for name in AGG_COLUMNS}
+        agg.update(_load_stat_columns(npy_dir, mode))
+        trip = {name: np.load(os.path.join(npy_dir, f"trips_{name}.npy"), mmap_mode=mode) for name in TRIP_COLUMNS}
+        with open(os.path.join(npy_dir, 'vehicles.json'), 'r', encoding='utf-8') as f:
+            vehicles = json.load(f)
+    else:
+        agg_path, trip_path = _parquet_paths(out_dir, date_key, h)
+        if not os.path.exists(agg_path):
+            return None
+        import pyarrow.parquet as pq
+        agg_table = pq.read_table(agg_path, memory_map=mmap)
+        trip_table = pq.read_table(trip_path, memory_map=mmap)
+        agg = {name: agg_table.column(name).to_numpy() for name in AGG_COLUMNS}
+        agg.update({name: agg_table.column(name).to_numpy() for name in AGG_STAT_COLUMNS
+                    if name in agg_table.column_names})
+        trip = {name: trip_table.column(name).to_numpy() for name in TRIP_COLUMNS}
+        vehicles = json.loads(trip_table.schema.metadata[b'vehicles'].decode('utf-8'))
+
+    for cols in (agg, trip):
+        cols['speed'] = restore_float(cols['speed'])
+        cols['time'] = restore_float(cols['time'])
+    _restore_stat_columns(agg)
+    return agg, trip, vehicles
+
+def _load_stat_columns(npy_dir, mode=None):
+    paths = {name: os.path.join(npy_dir, f"agg_{name}.npy") for name in AGG_STAT_COLUMNS}
+    return {name: np.load(path, mmap_mode=mode) for name, path in paths.items() if os.path.exists(path)}
+
+def _restore_stat_columns(agg):
+    for name in AGG_STAT_COLUMNS:
+        if name in agg:
+            agg[name] = restore_float(agg[name])
+
+def read_agg(out_dir, date_key, h):
+    """Chỉ các cột agg của một mảnh giờ (đọc bản dạng cột nếu có, không thì parse JSON).
+
+    Không đọc phần chuyến đi của từng xe. Trả về mảng trong bộ nhớ (không mmap)
+    để giữ được lâu trong cache, speed/time là float64 như trong JSON.
+    """
+    npy_dir = _npy_dir(out_dir, date_key, h)
+    agg_path = _parquet_paths(out_dir, date_key, h)[0]
+    if os.path.isdir(npy_dir):
+        agg = {name: np.load(os.path.join(npy_dir, f"agg_{name}.npy")) for name in AGG_COLUMNS}
+        agg.update(_load_stat_columns(npy_dir))
+    elif os.path.exists(agg_path):
+        import pyarrow.parquet as pq
+        table = pq.read_table(agg_path)
+        agg = {name: table.column(name).to_numpy() for name in AGG_COLUMNS}
+        agg.update({name: table.column(name).to_numpy() for name in AGG_STAT_COLUMNS if name in table.column_names})
+    else:
+        with open(os.path.join(out_dir, f"{date_key}_{h}.json"), 'r') as f:
+            aggs = json.load(f)["agg"]
+        agg = {
+            'from': np.fromiter((e["f"] for e in aggs), AGG_COLUMNS['from'], len(aggs)),
+            'to': np.fromiter((e["t"] for e in aggs), AGG_COLUMNS['to'], len(aggs)),
+            'speed': np.fromiter((e["s"] for e in aggs), np.float64, len(aggs)),
+            'time': np.fromiter((e["tm"] for e in aggs), np.float64, len(aggs)),
+            'count': np.fromiter((e["c"] for e in aggs), AGG_COLUMNS['count'], len(aggs)),
+        }
+        if aggs and AGG_STAT_COLUMNS['p50'] in aggs[0]:
+            for name, key in AGG_STAT_COLUMNS.items():
+                agg[name] = np.fromiter((e[key] for e in aggs), np.float64, len(aggs))
+        return agg
+    agg['speed'] = restore_float(agg['speed'])
+    agg['time'] = restore_float(agg['time'])
+    _restore_stat_columns(agg)
+    return agg
+
+def columns_to_chunk(agg, trip, vehicles):
+    """Dựng lại dict {"agg", "veh"} đúng như JSON gốc (dùng cho reader cũ / kiểm tra)."""
+    aggs = [
+        {"f": f, "t": t, "s": s, "tm": tm, "c": c}
+        for f, t, s, tm, c in zip(agg['from'].tolist(), agg['to'].tolist(), agg['speed'].tolist(),
+                                   agg['time'].tolist(), agg['count'].tolist())
+    ]
+    for name, key in AGG_STAT_COLUMNS.items():
+        if name not in agg:
+            continue
+        for e, v in zip(aggs, agg[name].tolist()):
+            if v == v: # NaN: mảnh gốc không có thống kê này
+                e[key] = v
+    veh = {}
+    for f, t, s, tm, code in zip(trip['from'].tolist(), trip['to'].tolist(), trip['speed'].tolist(),
+                                 trip['time'].tolist(), trip['vehicle_code'].tolist()):
+        veh.setdefault(vehicles[code], []).append({"f": f, "t": t, "tm": tm, "s": s})
+    return {"agg": aggs, "veh": veh}
+
+def remove_columnar(out_dir, date_key, h):
+    npy_dir = _npy_dir(out_dir, date_key, h)
+    if os.path.isdir(npy_dir):
+        shutil.rmtree(npy_dir)
+    for path in _parquet_paths(out_dir, date_key, h):
+        if os.path.exists(path):
+            os.remove(path)
+
+def _binary_path(out_dir, date_key, h):
+    return os.path.join(out_dir, f"{date_key}_{h}.bin")
+
+def _pad4(n):
+    return -n % 4
+
+def chunk_to_binary(chunk):
+    """Đóng gói một mảnh giờ theo định dạng `.bin` (xem BINARY_HEADER)."""
+    agg, trip, vehicles = chunk_to_columns(chunk)
+    if len(agg['count']) and int(agg['count'].max()) > np.iinfo(np.uint16).max:
+        # c là u16: số lượt quá lớn bị chặn ở 65535
+        print("   ⚠️ count vượt 65535 trong mảnh nhị phân, đã chặn trên")
+        agg['count'] = np.minimum(agg['count'], np.iinfo(np.uint16).max)
+    vehicles_bytes = json.dumps(vehicles).encode('utf-8')
+
+    parts = [BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BINARY_HEADER.size, len(agg['count']),
+                                len(trip['vehicle_code']), len(vehicles), len(vehicles_bytes))]
+    for cols, layout in ((agg, BINARY_AGG), (trip, BINARY_TRIPS)):
+        for name, dtype in layout:
+            data = np.ascontiguousarray(cols[name], dtype=dtype).tobytes()
+            parts.append(data + b'\0' * _pad4(len(data)))
+    parts.append(vehicles_bytes)
+    return b''.join(parts)
+
+def binary_to_columns(data):
+    """bytes `.bin` -> (agg, trips, vehicles) như read_columnar (speed/time float64 đã làm tròn)."""
+    magic, version, header_size, n_agg, n_trips, n_vehicles, vehicles_len = BINARY_HEADER.unpack_from(data, 0)
+    if magic != BINARY_MAGIC or version not in (1, BINARY_VERSION):
+        raise ValueError(f"Không phải mảnh nhị phân hợp lệ (magic={magic!r}, version={version})")
+    offset = header_size
+    tables = []
+    for n, layout in ((n_agg, BINARY_AGG if version >= 2 else BINARY_AGG_V1), (n_trips, BINARY_TRIPS)):
+        cols = {}
+        for name, dtype in layout:
+            arr = np.frombuffer(data, dtype=dtype, count=n, offset=offset)
+            offset += arr.nbytes + _pad4(arr.nbytes)
+            cols[name] = arr.astype(AGG_COLUMNS.get(name, TRIP_COLUMNS.get(name, np.float64)))
+        cols['speed'] = restore_float(cols['speed'])
+        cols['time'] = restore_float(cols['time'])
+        tables.append(cols)
+    _restore_stat_columns(tables[0])
+    vehicles = json.loads(bytes(data[offset:offset + vehicles_len]).decode('utf-8'))
+    if len(vehicles) != n_vehicles:
+        raise ValueError("Bảng mã xe không khớp header")
+    return tables[0], tables[1], vehicles
+
+def write_binary(out_dir, date_key, h, chunk):
+    path = _binary_path(out_dir, date_key, h)
+    write_atomic(path, chunk_to_binary(chunk))
+    return path
+
+def read_binary(out_dir, date_key, h):
+    """Đọc `{date}_{h}.bin` -> (agg, trips, vehicles); dùng columns_to_chunk để dựng lại dict JSON."""
+    with open(_binary_path(out_dir, date_key, h), 'rb') as f:
+        return binary_to_columns(f.read())
+
+def remove_binary(out_dir, date_key, h):
+    path = _binary_path(out_dir, date_key, h)
+    if os.path.exists(path):
+        os.remove(path)
+
+def has_orjson():
+    return orjson is not None
+
+def dumps_rows(rows, cls=None):
+    """json.dumps(rows, cls=cls) cho mảng bản ghi số của mảnh (agg / chuyến của một xe).
+
+    Dùng orjson nếu có cài: orjson viết gọn không khoảng trắng nên chèn lại ', ' và ': '
+    (an toàn vì bản ghi chỉ có khóa ngắn và số, không có chuỗi). Khi orjson không viết
+    giống stdlib (NaN/inf -> null, số nhỏ hơn 1e-4 viết khác dạng mũ) hoặc không nhận giá
+    trị (kiểu numpy, số nguyên quá 64 bit) thì quay về json.dumps. Bộ mã hóa mặc định của
+    stdlib được thử trước `cls`: tạo encoder mới cho mỗi lần gọi tốn hơn cả việc mã hóa
+    một xe, còn `cls` chỉ cần khi còn sót số numpy.
+    """
+    if orjson is not None:
+        try:
+            data = orjson.dumps(rows)
+        except TypeError:
+            data = None
+        if data is not None and b'null' not in data and b'e-' not in data and b'0.0000' not in data:
+            return data.decode('ascii').replace(',', ', ').replace(':', ': ')
+    try:
+        return json.dumps(rows)
+    except TypeError:
+        if cls is None:
+            raise
+        return json.dumps(rows, cls=cls)
+
+def write_atomic(path, data):
+    """Ghi bytes / str qua file tạm rồi os.replace: reader không bao giờ thấy file dở."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def chunk_to_json(chunk, cls=None):
+    """Chuỗi JSON của mảnh (giống hệt json.dumps(chunk, cls=cls)) + vị trí chuyến từng xe.
+
+    Trả về (text, {vid: (offset, length)}): text[offset:offset + length] là mảng
+    chuyến `veh[vid]`, các chuyến của một xe nằm liền nhau nên đọc được bằng một
+    lần seek hoặc một Range request. JSON chỉ có ký tự ASCII nên offset ký tự = byte.
+    """
+    head = '{"agg": ' + dumps_rows(chunk["agg"], cls) + ', "veh": {'
+    parts = [head]
+    pos = len(head)
+    ranges = {}
+    for i, (vid, rows) in enumerate(chunk["veh"].items()):
+        key = (', ' if i else '') + json.dumps(str(vid)) + ': '
+        body = dumps_rows(rows, cls)
+        pos += len(key)
+        ranges[vid] = (pos, len(body))
+        pos += len(body)
+        parts += [key, body]
+    parts.append('}}')
+    return ''.join(parts), ranges
+
+def _vehicle_index_path(out_dir, date_key):
+    return os.path.join(out_dir, f"{date_key}.vehicles.json")
+
+def write_vehicle_index(out_dir, date_key, hour_ranges):
+    """Cập nhật chỉ mục xe của một ngày `{date}.vehicles.json` với các giờ vừa ghi.
+
+    hour_ranges: {h: {vid: (offset, length)}} từ chunk_to_json. Giờ đã có trong
+    chỉ mục được thay hẳn (file GPS sau ghi đè giờ của file trước).
+    Chỉ mục: {"hours": [...], "vehicles": {vid: [[h, offset, length], ...]}}.
+    """
+    index = read_vehicle_index(out_dir, date_key) or {"hours": [], "vehicles": {}}
+    hours = {int(h) for h in hour_ranges}
+    vehicles = {}
+    for vid, entries in index["vehicles"].items():
+        kept = [e for e in entries if e[0] not in hours]
+        if kept:
+            vehicles[vid] = kept
+    for h, ranges in hour_ranges.items():
+        for vid, (offset, length) in ranges.items():
+            vehicles.setdefault(vid, []).append([int(h), offset, length])
+    for entries in vehicles.values():
+        entries.sort()
+    index = {"hours": sorted(hours.union(index["hours"])), "vehicles": vehicles}
+
+    path = _vehicle_index_path(out_dir, date_key)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+def read_vehicle_index(out_dir, date_key):
+    path = _vehicle_index_path(out_dir, date_key)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def remove_vehicle_index(out_dir, date_key):
+    path = _vehicle_index_path(out_dir, date_key)
+    if os.path.exists(path):
+        os.remove(path)
+
+def read_vehicle_trips(out_dir, date_key, vid, index=None):
+    """Các chuyến của một xe trong ngày, chỉ đọc đúng các đoạn byte trong mảnh JSON.
+
+    Trả về [(h, [chuyến...]), ...] theo giờ, None nếu ngày chưa có chỉ mục.
+    """
+    index = index or read_vehicle_index(out_dir, date_key)
+    if index is None:
+        return None
+    out = []
+    for h, offset, length in index["vehicles"].get(vid, []):
+        with open(os.path.join(out_dir, f"{date_key}_{h}.json"), 'rb') as f:
+            f.seek(offset)
+            out.append((h, json.loads(f.read(length))))
+    return out
+
+def _row_bodies(rows):
+    # '[{a}, {b}]' -> ['a', 'b']: bản ghi phẳng chỉ có số nên '}, {' chỉ nằm giữa hai bản ghi
+    return dumps_rows(rows)[2:-2].split('}, {') if rows else []
+
+def chunk_to_ndjson(chunk):
+    """Dòng NDJSON cho viewer: các cạnh agg trước, rồi từng chuyến kèm "vid".
+
+    Mỗi mảng bản ghi được mã hóa một lần rồi tách dòng, giống hệt json.dumps từng dòng.
+    """
+    lines = ['{' + body + '}' for body in _row_bodies(chunk["agg"])]
+    for vid, arr in chunk["veh"].items():
+        head = '{"vid": ' + json.dumps(vid) + ', '
+        lines += [head + body + '}' for body in _row_bodies(arr)]
+    return "\n".join(lines)
+
+def has_brotli():
+    try:
+        import brotli # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def write_ndjson(out_dir, date_key, h, chunk, compress=()):
+    """Ghi `{date}_{h}.ndjson` và các bản nén `.ndjson.gz` / `.ndjson.br` nếu được yêu cầu."""
+    data = chunk_to_ndjson(chunk).encode('utf-8')
+    path = os.path.join(out_dir, f"{date_key}_{h}.ndjson")
+    write_atomic(path, data)
+    if 'gz' in compress:
+        write_atomic(f"{path}.gz", gzip.compress(data, compresslevel=6, mtime=0))
+    if 'br' in compress:
+        import brotli
+        write_atomic(f"{path}.br", brotli.compress(data, quality=9))
+    return path
+
+def remove_ndjson(out_dir, date_key, h):
+    path = os.path.join(out_dir, f"{date_key}_{h}.ndjson")
+    for p in (path, f"{path}.gz", f"{path}.br"):
+        if os.path.exists(p):
+            os.remove(p)
@@ -0,0 +1,220 @@
+import os
+import numpy as np
+
+# --- CẤU HÌNH ---
+# Phác thảo phân vị kiểu DDSketch: bucket logarit cố định, sai số tương đối SKETCH_ALPHA.
+# Mỗi cạnh giữ tối đa N_BUCKETS ô đếm (lưu thưa) nên kích thước không tăng theo số
+# mẫu, và gộp hai phác thảo chỉ là cộng số đếm theo bucket -> kết quả không phụ
+# thuộc thứ tự gộp (khác t-digest/KLL).
+SKETCH_ALPHA = 0.01
+SKETCH_MIN = 0.1      # km/h; nhỏ hơn rơi vào bucket 0
+SKETCH_MAX = 10000.0  # lớn hơn rơi vào bucket cuối (min/max vẫn chính xác)
+GAMMA = (1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA)
+N_BUCKETS = int(np.ceil(np.log(SKETCH_MAX / SKETCH_MIN) / np.log(GAMMA))) + 1
+QUANTILES = (('p50', 0.5), ('p85', 0.85))
+
+SUM_COLUMNS = ('count', 'sum_speed', 'sumsq_speed')
+SKETCH_COLUMNS = ('sk_ptr', 'sk_bucket', 'sk_count')
+STATS_COLUMNS = ('from', 'to') + SUM_COLUMNS + ('min_speed', 'max_speed') + SKETCH_COLUMNS
+# Cột tùy chọn: tổng thời gian đi cạnh theo từng chuyến (file stats cũ không có)
+OPTIONAL_SUMS = ('sum_time',)
+
+# Bảng accumulator = dict cột numpy, mỗi dòng một cạnh (from, to):
+#   count, sum_speed, sumsq_speed, min_speed, max_speed, [sum_time]
+#   sk_ptr[i]:sk_ptr[i+1] là các cặp (sk_bucket, sk_count) của cạnh i (CSR)
+
+def bucket_of(values):
+    """Tốc độ -> chỉ số bucket: bucket i >= 1 phủ (MIN·γ^(i-1), MIN·γ^i]."""
+    values = np.maximum(np.asarray(values, dtype=np.float64), SKETCH_MIN)
+    idx = np.ceil(np.log(values / SKETCH_MIN) / np.log(GAMMA))
+    return np.clip(idx, 0, N_BUCKETS - 1).astype(np.int16)
+
+def bucket_value(idx):
+    """Giá trị đại diện của bucket (sai số tương đối <= SKETCH_ALPHA)."""
+    idx = np.asarray(idx, dtype=np.float64)
+    return np.where(idx == 0, SKETCH_MIN, SKETCH_MIN * 2 * GAMMA ** idx / (GAMMA + 1))
+
+def empty_stats():
+    return {
+        'from': np.empty(0, np.int32), 'to': np.empty(0, np.int32), 'count': np.empty(0, np.int64),
+        'sum_speed': np.empty(0), 'sumsq_speed': np.empty(0), 'min_speed': np.empty(0), 'max_speed': np.empty(0),
+        'sk_ptr': np.zeros(1, np.int64), 'sk_bucket': np.empty(0, np.int16), 'sk_count': np.empty(0, np.int64),
+    }
+
+def _sketch(group, buckets, counts, n_groups):
+    """Gộp các bộ (cạnh, bucket, số đếm) thành CSR theo cạnh, bucket tăng dần."""
+    pair = group.astype(np.int64) * N_BUCKETS + buckets
+    uniq, inverse = np.unique(pair, return_inverse=True)
+    sk_count = np.bincount(inverse.reshape(-1), counts, len(uniq)).astype(np.int64)
+    sk_edge = uniq // N_BUCKETS
+    return {
+        'sk_ptr': np.searchsorted(sk_edge, np.arange(n_groups + 1)).astype(np.int64),
+        'sk_bucket': (uniq % N_BUCKETS).astype(np.int16),
+        'sk_count': sk_count,
+    }
+
+def from_samples(f, t, speed, time=None):
+    """Các mẫu tốc độ theo chuyến -> bảng accumulator, cạnh theo thứ tự xuất hiện đầu tiên.
+
+    Tổng cộng một lượt bằng np.bincount theo nhóm cạnh (cộng tuần tự, có thể lệch
+    bit cuối so với np.mean cộng theo cặp trước đây).
+    time: thời gian đi cạnh của từng chuyến (giây) -> thêm cột sum_time.
+    """
+    f = np.asarray(f)
+    t = np.asarray(t)
+    speed = np.asarray(speed, dtype=np.float64)
+    if not len(speed):
+        return empty_stats()
+    key = (f.astype(np.int64) << 32) | t.astype(np.int64)
+    uniq, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+    n = len(uniq)
+    rank = np.empty(n, dtype=np.int64)
+    rank[np.argsort(first, kind='stable')] = np.arange(n)
+    group = rank[inverse.reshape(-1)]
+
+    order = np.argsort(group, kind='stable')
+    grouped = speed[order]
+    counts = np.bincount(group, minlength=n)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    firsts = np.sort(first)
+    stats = {
+        'from': f[firsts].astype(np.int32), 'to': t[firsts].astype(np.int32), 'count': counts.astype(np.int64),
+        'sum_speed': np.bincount(group, speed, n),
+        'sumsq_speed': np.bincount(group, speed * speed, n),
+        'min_speed': np.minimum.reduceat(grouped, offsets[:-1]),
+        'max_speed': np.maximum.reduceat(grouped, offsets[:-1]),
+    }
+    if time is not None:
+        stats['sum_time'] = np.bincount(group, np.asarray(time, dtype=np.float64), n)
+    stats.update(_sketch(group[order], bucket_of(grouped), np.ones(len(grouped)), n))
+    return stats
+
+def merge(tables, extra_sums=()):
+    """Gộp nhiều bảng accumulator theo cạnh; kết quả sắp theo (from, to).
+
+    count, min/max và số đếm của phác thảo gộp chính xác (cộng số nguyên /
+    so sánh), nên thứ tự gộp giữa các file hay worker không đổi phân vị.
+    extra_sums: các cột cộng dồn khác đi kèm bảng; cột OPTIONAL_SUMS được gộp
+    khi mọi bảng đều có.
+    """
+    tables = [tb for tb in tables if len(tb['count'])]
+    extra_sums = tuple(extra_sums) + tuple(
+        name for name in OPTIONAL_SUMS if name not in extra_sums and tables and all(name in tb for tb in tables))
+    if not tables:
+        return {**empty_stats(), **{name: np.empty(0) for name in extra_sums}}
+    f = np.concatenate([tb['from'] for tb in tables]).astype(np.int64)
+    t = np.concatenate([tb['to'] for tb in tables]).astype(np.int64)
+    keys, inverse = np.unique((f << 32) | t, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    n = len(keys)
+
+    merged = {'from': (keys >> 32).astype(np.int32), 'to': (keys & 0xFFFFFFFF).astype(np.int32)}
+    for name in SUM_COLUMNS + tuple(extra_sums):
+        merged[name] = np.bincount(inverse, np.concatenate([tb[name] for tb in tables]), n)
+    merged['count'] = merged['count'].astype(np.int64)
+    merged['min_speed'] = np.full(n, np.inf)
+    merged['max_speed'] = np.full(n, -np.inf)
+    np.minimum.at(merged['min_speed'], inverse, np.concatenate([tb['min_speed'] for tb in tables]))
+    np.maximum.at(merged['max_speed'], inverse, np.concatenate([tb['max_speed'] for tb in tables]))
+
+    # Dòng thứ i của từng bảng -> vị trí trong bảng gộp
+    offsets = np.cumsum([0] + [len(tb['count']) for tb in tables])
+    group = np.concatenate([
+        inverse[offsets[k]:offsets[k + 1]][np.repeat(np.arange(len(tb['count'])), np.diff(tb['sk_ptr']))]
+        for k, tb in enumerate(tables)
+    ])
+    merged.update(_sketch(group, np.concatenate([tb['sk_bucket'] for tb in tables]),
+                          np.concatenate([tb['sk_count'] for tb in tables]), n))
+    return merged
+
+def take(stats, rows):
+    """Các dòng `rows` của bảng accumulator theo thứ tự cho (kèm phác thảo của từng dòng)."""
+    rows = np.asarray(rows, dtype=np.int64)
+    ptr = stats['sk_ptr']
+    lens = ptr[rows + 1] - ptr[rows]
+    ends = np.cumsum(lens)
+    sk_idx = np.repeat(ptr[rows] - (ends - lens), lens) + np.arange(ends[-1] if len(ends) else 0)
+    out = {name: col[rows] for name, col in stats.items() if name not in SKETCH_COLUMNS}
+    out.update({'sk_ptr': np.concatenate(([0], ends)).astype(np.int64),
+                'sk_bucket': stats['sk_bucket'][sk_idx], 'sk_count': stats['sk_count'][sk_idx]})
+    return out
+
+def update(acc, new):
+    """Gộp bảng `new` vào `acc` (đã sắp theo (from, to) như kết quả merge).
+
+    Chỉ các cạnh `new` chạm tới được gộp lại; các cạnh còn lại chép nguyên, nên
+    cập nhật liên tục (liveIngest) không phải gộp lại cả accumulator mỗi lô.
+    Kết quả trùng với merge([acc, new]).
+    """
+    if not len(acc['count']) or not len(new['count']):
+        return merge([acc, new])
+    keys = (acc['from'].astype(np.int64) << 32) | acc['to'].astype(np.int64)
+    new_keys = (new['from'].astype(np.int64) << 32) | new['to'].astype(np.int64)
+    pos = np.minimum(np.searchsorted(keys, new_keys), len(keys) - 1)
+    touched = np.zeros(len(keys), dtype=bool)
+    touched[pos[keys[pos] == new_keys]] = True
+    merged = merge([take(acc, np.flatnonzero(touched)), new])
+    rest = take(acc, np.flatnonzero(~touched))
+
+    # Hai bảng cùng sắp theo khóa, không trùng cạnh -> trộn bằng searchsorted
+    m_keys = (merged['from'].astype(np.int64) << 32) | merged['to'].astype(np.int64)
+    r_keys = keys[~touched]
+    order = np.empty(len(m_keys) + len(r_keys), dtype=np.int64)
+    order[np.arange(len(r_keys)) + np.searchsorted(m_keys, r_keys)] = np.arange(len(r_keys))
+    order[np.arange(len(m_keys)) + np.searchsorted(r_keys, m_keys)] = len(r_keys) + np.arange(len(m_keys))
+    names = [name for name in merged if name in rest and name not in SKETCH_COLUMNS]
+    both = {name: np.concatenate((rest[name], merged[name])) for name in names}
+    both.update({
+        'sk_ptr': np.concatenate((rest['sk_ptr'], merged['sk_ptr'][1:] + rest['sk_ptr'][-1])),
+        'sk_bucket': np.concatenate((rest['sk_bucket'], merged['sk_bucket'])),
+        'sk_count': np.concatenate((rest['sk_count'], merged['sk_count'])),
+    })
+    return take(both, order)
+
+def quantile(stats, q):
+    """Phân vị q của tốc độ mỗi cạnh từ phác thảo (kẹp trong [min, max] chính xác)."""
+    n = stats['count']
+    if not len(n):
+        return np.empty(0)
+    cum = np.cumsum(stats['sk_count'])
+    before = np.concatenate(([0], cum))[stats['sk_ptr'][:-1]]
+    # Hạng gần nhất (nearest-rank): mẫu thứ ceil(q·n) theo thứ tự tăng dần
+    target = before + np.maximum(np.ceil(q * n).astype(np.int64) - 1, 0)
+    idx = np.searchsorted(cum, target, side='right')
+    return np.clip(bucket_value(stats['sk_bucket'][idx]), stats['min_speed'], stats['max_speed'])
+
+def variance(stats):
+    """Phương sai (tổng thể) của tốc độ mỗi cạnh từ count / sum / sum bình phương."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = stats['sum_speed'] / stats['count']
+        return np.maximum(stats['sumsq_speed'] / stats['count'] - mean * mean, 0.0)
+
+def summary(stats):
+    """{"p50": ..., "p85": ..., "var": ...} - các mảng thống kê thêm cho bản ghi agg."""
+    out = {name: quantile(stats, q) for name, q in QUANTILES}
+    out['var'] = variance(stats)
+    return out
+
+def _stats_path(out_dir, date_key, h):
+    return os.path.join(out_dir, f"{date_key}_{h}.stats.npz")
+
+def write_stats(out_dir, date_key, h, stats):
+    """Lưu accumulator của một mảnh giờ (`{date}_{h}.stats.npz`) để gộp lại về sau."""
+    path = _stats_path(out_dir, date_key, h)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **{name: stats[name] for name in STATS_COLUMNS + OPTIONAL_SUMS if name in stats})
+    os.replace(tmp_path, path)
+
+def read_stats(out_dir, date_key, h):
+    """Accumulator của một mảnh giờ, None nếu mảnh được dựng trước khi có file stats."""
+    path = _stats_path(out_dir, date_key, h)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {name: data[name] for name in STATS_COLUMNS + OPTIONAL_SUMS if name in data.files}
+
+def remove_stats(out_dir, date_key, h):
+    path = _stats_path(out_dir, date_key, h)
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,249 @@
+import os
+import json
+import shutil
+import datetime
+import numpy as np
+import chunkStore
+
+# --- CẤU HÌNH ---
+INPUT_DIR = 'traffic_data_chunks'
+BASELINE_DIRNAME = 'baseline'
+MIN_OBS = 3          # số giờ lịch sử tối thiểu của (cạnh, giờ-trong-tuần) mới chấm điểm
+MIN_STD = 2.0        # km/h; chặn dưới độ lệch chuẩn (cạnh quá ổn định không bị báo vì lệch vài km/h)
+Z_THRESHOLD = 2.0    # z <= -Z_THRESHOLD -> chậm bất thường so với chính cạnh đó ở giờ đó
+BASELINE_COLUMNS = ('how', 'from', 'to', 'n', 'sum', 'sumsq')
+SCORE_COLUMNS = ('z', 'anomaly', 'base')
+REBUILD_FRACTION = 0.25  # số ngày đã trừ (ghi lại / xóa) từ lần cộng lại trước vượt tỷ lệ này -> cộng lại từ days/
+
+# Hồ sơ tốc độ bình thường theo (cạnh, giờ-trong-tuần), how = thứ × 24 + giờ (0 = 0h thứ Hai).
+# Mỗi quan sát là tốc độ trung bình của cạnh trong một mảnh giờ; lưu n / tổng / tổng bình
+# phương nên cộng trừ được:
+#   baseline/baseline.npz    : bảng gộp, sắp theo (how, from, to)
+#   baseline/days/{date}.npz : đóng góp của từng ngày (how, from, to, speed)
+#   baseline/baseline.json   : mtime các mảnh đã nạp theo ngày
+# Làm mới chỉ đọc các ngày mới / có mảnh đổi (trừ đóng góp cũ từ days/, cộng đóng góp
+# mới); ngày đã biến mất thì chỉ trừ. Trừ nhiều lần làm sum/sumsq trôi dần (sai số
+# làm tròn không triệt tiêu) nên khi số ngày đã trừ vượt REBUILD_FRACTION số ngày, bảng
+# được cộng lại từ đầu từ các file days/ (không đọc lại mảnh).
+# Chấm điểm một giờ = một lần searchsorted trên đoạn how của bảng, z = (tốc độ - trung
+# bình) / độ lệch chuẩn, bỏ chính giờ đó khỏi trung bình nếu ngày đã nằm trong hồ sơ
+# (leave-one-out).
+
+def empty_baseline():
+    return {
+        'how': np.empty(0, np.int16), 'from': np.empty(0, np.int32), 'to': np.empty(0, np.int32),
+        'n': np.empty(0, np.int64), 'sum': np.empty(0), 'sumsq': np.empty(0)
+    }
+
+def hour_of_week(date_key, h):
+    return datetime.date.fromisoformat(date_key).weekday() * 24 + int(h)
+
+def combine(tables):
+    """Cộng các bảng (n/sum/sumsq có thể âm để trừ) theo (how, from, to); bỏ dòng n = 0."""
+    tables = [tb for tb in tables if len(tb['n'])]
+    if not tables:
+        return empty_baseline()
+    cols = {name: np.concatenate([tb[name] for tb in tables]) for name in BASELINE_COLUMNS}
+    order = np.lexsort((cols['to'], cols['from'], cols['how']))
+    cols = {name: arr[order] for name, arr in cols.items()}
+    new_key = np.ones(len(order), dtype=bool)
+    new_key[1:] = (np.diff(cols['how']) != 0) | (np.diff(cols['from']) != 0) | (np.diff(cols['to']) != 0)
+    starts = np.flatnonzero(new_key)
+    out = {name: cols[name][starts] for name in ('how', 'from', 'to')}
+    for name in ('n', 'sum', 'sumsq'):
+        out[name] = np.add.reduceat(cols[name], starts)
+    keep = out['n'] > 0
+    return {name: arr[keep] for name, arr in out.items()}
+
+def day_contribution(out_dir, date_key, hours):
+    """Tốc độ trung bình theo cạnh của từng mảnh giờ trong ngày -> (how, from, to, speed)."""
+    parts = []
+    for h in hours:
+        agg = chunkStore.read_agg(out_dir, date_key, h)
+        speed = np.asarray(agg['speed'], dtype=np.float64)
+        valid = np.isfinite(speed)
+        parts.append({
+            'how': np.full(int(valid.sum()), hour_of_week(date_key, h), dtype=np.int16),
+            'from': np.asarray(agg['from'], dtype=np.int32)[valid], 'to': np.asarray(agg['to'], dtype=np.int32)[valid],
+            'speed': speed[valid]
+        })
+    if not parts:
+        return {'how': np.empty(0, np.int16), 'from': np.empty(0, np.int32), 'to': np.empty(0, np.int32),
+                'speed': np.empty(0)}
+    return {name: np.concatenate([p[name] for p in parts]) for name in parts[0]}
+
+def as_delta(day, sign=1):
+    """Đóng góp của một ngày -> bảng cộng (sign=-1 để trừ)."""
+    speed = day['speed']
+    return {
+        'how': day['how'], 'from': day['from'], 'to': day['to'],
+        'n': np.full(len(speed), sign, dtype=np.int64), 'sum': sign * speed, 'sumsq': sign * speed * speed
+    }
+
+def _baseline_dir(out_dir):
+    return os.path.join(out_dir, BASELINE_DIRNAME)
+
+def _day_path(out_dir, date_key):
+    return os.path.join(_baseline_dir(out_dir), 'days', f"{date_key}.npz")
+
+def _write_npz(path, arrays):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+def _read_npz(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+def build_baseline(out_dir=INPUT_DIR, rebuild=False):
+    """Dựng / làm mới hồ sơ tốc độ theo (cạnh, giờ-trong-tuần) từ các mảnh trong `out_dir`.
+
+    Chỉ đọc mảnh của các ngày mới hoặc có mảnh bị ghi lại (so mtime trong baseline.json).
+    rebuild=True dựng lại toàn bộ từ các mảnh.
+    Trả về state {"dates": {date: {h: mtime}}, "subtracted": số ngày đã trừ từ lần cộng lại trước}.
+    """
+    with open(os.path.join(out_dir, 'index.json'), 'r') as f:
+        index_data = json.load(f)
+    root = _baseline_dir(out_dir)
+    state_path = os.path.join(root, 'baseline.json')
+    table_path = os.path.join(root, 'baseline.npz')
+
+    state = None
+    if not rebuild and os.path.exists(state_path) and os.path.exists(table_path):
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except Exception as e:
+            print(f"⚠️ baseline.json hỏng, dựng lại toàn bộ: {e}")
+    if state is None:
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        state = {"dates": {}}
+
+    current = {}
+    for date_key, hours in index_data.items():
+        mtimes = {}
+        for h in hours:
+            mtime = _shard_mtime(out_dir, date_key, h)
+            if mtime is not None:
+                mtimes[str(h)] = mtime
+        if mtimes:
+            current[date_key] = mtimes
+    changed = sorted(d for d, mtimes in current.items() if state["dates"].get(d) != mtimes)
+    removed = sorted(set(state["dates"]) - set(current))
+
+    subtract = [d for d in changed + removed if d in state["dates"]]
+    subtracted = state.get("subtracted", 0) + len(subtract)
+    recombine = bool(subtract) and subtracted > REBUILD_FRACTION * max(len(current), 1)
+
+    print(f"📈 Đang làm mới baseline: {len(changed)} ngày mới/đổi, {len(removed)} ngày bị xóa"
+          f"{' (cộng lại từ days/)' if recombine else ''}...")
+    deltas = [read_baseline(out_dir)] if state["dates"] and not recombine else []
+    for date_key in changed + removed:
+        path = _day_path(out_dir, date_key)
+        if date_key in state["dates"] and os.path.exists(path):
+            if not recombine:
+                deltas.append(as_delta(_read_npz(path), -1))
+            os.remove(path)
+    for date_key in changed:
+        day = day_contribution(out_dir, date_key, sorted(int(h) for h in current[date_key]))
+        _write_npz(_day_path(out_dir, date_key), day)
+        deltas.append(as_delta(day))
+    if recombine:
+        for date_key in sorted(set(current) - set(changed)):
+            path = _day_path(out_dir, date_key)
+            if os.path.exists(path):
+                day = _read_npz(path)
+            else:
+                day = day_contribution(out_dir, date_key, sorted(int(h) for h in current[date_key]))
+                _write_npz(path, day)
+            deltas.append(as_delta(day))
+        subtracted = 0
+
+    table = combine(deltas)
+    _write_npz(table_path, table)
+    state = {"dates": dict(sorted(current.items())), "subtracted": subtracted}
+    tmp_path = f"{state_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+    print(f"✔ Baseline: {len(current)} ngày, {len(table['n'])} dòng (cạnh × giờ-trong-tuần) -> {root}")
+    return state
+
+def read_baseline(out_dir=INPUT_DIR):
+    path = os.path.join(_baseline_dir(out_dir), 'baseline.npz')
+    return _read_npz(path) if os.path.exists(path) else empty_baseline()
+
+def load_state(out_dir=INPUT_DIR):
+    """{date: {h: mtime}} các mảnh đã nằm trong hồ sơ (rỗng nếu chưa dựng)."""
+    path = os.path.join(_baseline_dir(out_dir), 'baseline.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)["dates"]
+
+def _shard_mtime(out_dir, date_key, h):
+    try:
+        return os.stat(os.path.join(out_dir, f"{date_key}_{h}.json")).st_mtime_ns
+    except OSError:
+        return None
+
+def is_included(state, out_dir, date_key, h):
+    """Mảnh (date_key, h) đang nằm trong hồ sơ: đã nạp và chưa bị ghi lại từ lần làm mới trước.
+
+    Mảnh ghi lại sau khi dựng baseline có tốc độ khác quan sát đã cộng vào hồ sơ -> coi như
+    chưa nạp (không trừ leave-one-out) cho tới lần làm mới sau.
+    """
+    recorded = state.get(date_key, {}).get(str(int(h)))
+    return recorded is not None and recorded == _shard_mtime(out_dir, date_key, h)
+
+def score(baseline, date_key, h, f, t, speed, included=False):
+    """Chấm điểm các cạnh (f, t, speed) của mảnh (date_key, h) so với hồ sơ giờ-trong-tuần.
+
+    included: mảnh này đã được nạp vào hồ sơ -> trừ chính quan sát đó khỏi thống kê.
+    Trả về {"z": z-score (NaN nếu không đủ MIN_OBS quan sát), "anomaly": z <= -Z_THRESHOLD,
+    "base": tốc độ bình thường (NaN nếu không có)}.
+    """
+    f = np.asarray(f, dtype=np.int64)
+    t = np.asarray(t, dtype=np.int64)
+    speed = np.asarray(speed, dtype=np.float64)
+    how = hour_of_week(date_key, h)
+    lo, hi = np.searchsorted(baseline['how'], [how, how + 1])
+    keys_b = (baseline['from'][lo:hi].astype(np.int64) << 32) | baseline['to'][lo:hi].astype(np.int64)
+    keys = (f << 32) | t
+
+    n = np.zeros(len(keys))
+    total = np.zeros(len(keys))
+    total_sq = np.zeros(len(keys))
+    found = np.zeros(len(keys), dtype=bool)
+    if len(keys_b):
+        pos = np.minimum(np.searchsorted(keys_b, keys), len(keys_b) - 1)
+        found = keys_b[pos] == keys
+        rows = lo + pos[found]
+        n[found] = baseline['n'][rows]
+        total[found] = baseline['sum'][rows]
+        total_sq[found] = baseline['sumsq'][rows]
+    if included:
+        n -= found
+        total -= np.where(found, speed, 0.0)
+        total_sq -= np.where(found, speed * speed, 0.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / n
+        std = np.maximum(np.sqrt(np.maximum(total_sq / n - mean * mean, 0.0)), MIN_STD)
+        z = np.where(n >= MIN_OBS, (speed - mean) / std, np.nan)
+        base = np.where(n > 0, mean, np.nan)
+    return {'z': z, 'anomaly': z <= -Z_THRESHOLD, 'base': base}
+
+def score_hour(out_dir, date_key, h, baseline=None, state=None):
+    """Các cột agg của một mảnh + z / anomaly / base (đọc hồ sơ nếu không truyền)."""
+    baseline = read_baseline(out_dir) if baseline is None else baseline
+    state = load_state(out_dir) if state is None else state
+    agg = chunkStore.read_agg(out_dir, date_key, h)
+    scores = score(baseline, date_key, h, agg['from'], agg['to'], agg['speed'], is_included(state, out_dir, date_key, h))
+    return {**agg, **scores}
+
+if __name__ == "__main__":
+    build_baseline()
@@ -2,7 +2,12 @@ import json
 import os
 import glob
 import pandas as pd
+import numpy as np
 import re
+import chunkStore
+import pipelineMetrics
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 # --- CẤU HÌNH ---
 INPUT_DIR = 'traffic_data_chunks'
@@ -10,7 +15,127 @@ OUT_NODES = 'traffic_nodes.csv'
 OUT_EDGES = 'traffic_edges_summary.csv'
 OUT_TRIPS = 'traffic_trips_detailed.csv'
 
-def export_data():
+AGG_COLS = ['date', 'hour', 'from_id', 'to_id', 'from_name', 'to_name', 'avg_speed_kmh', 'avg_time_sec', 'trip_count',
+            'p50_speed_kmh', 'p85_speed_kmh', 'speed_variance']
+TRIP_COLS = ['date', 'hour', 'vehicle_id', 'from_id', 'to_id', 'from_name', 'to_name', 'speed_kmh', 'travel_time_sec']
+
+# Map ID -> Name dùng chung trong process con (gán qua initializer)
+_NODE_NAMES = {}
+
+def _init_worker(node_names):
+    global _NODE_NAMES
+    _NODE_NAMES = node_names
+
+def _lookup_names(ids):
+    return pd.Series(ids).map(_NODE_NAMES).fillna('Unknown').values
+
+def read_shard(file_path, date_str, hour):
+    """Đọc một mảnh giờ -> (df_agg, df_trips) đã gắn tên node và sắp sẵn.
+
+    Dùng bản dạng cột nếu có, không thì parse JSON. Mỗi (ngày, giờ) nằm trọn
+    trong một mảnh nên sắp ổn định trong mảnh theo from_name / vehicle_id rồi
+    nối các mảnh theo thứ tự (ngày, giờ) cho ra đúng thứ tự của sort toàn bảng.
+    """
+    cols = chunkStore.read_columnar(INPUT_DIR, date_str, hour)
+    if cols is not None:
+        agg, trip, vehicles = cols
+        nan = np.full(len(agg['count']), np.nan)
+        agg = {'f': agg['from'], 't': agg['to'], 's': agg['speed'], 'tm': agg['time'], 'c': agg['count'],
+               'p50': agg.get('p50', nan), 'p85': agg.get('p85', nan), 'var': agg.get('var', nan)}
+        trip_vid = np.asarray(vehicles, dtype=object)[trip['vehicle_code']]
+        trip = {'f': trip['from'], 't': trip['to'], 's': trip['speed'], 'tm': trip['time']}
+    else:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        aggs = data.get('agg', [])
+        agg = {k: [e[k] for e in aggs] for k in ('f', 't', 's', 'tm', 'c')}
+        # Mảnh dựng trước khi có edgeStats không có p50/p85/var
+        agg.update({k: [e.get(k, np.nan) for e in aggs] for k in ('p50', 'p85', 'var')})
+        # data['veh'] là dict: { "vehicle_id": [list of edges], ... }
+        trips = [(veh_id, e) for veh_id, edges in data.get('veh', {}).items() for e in edges]
+        trip_vid = [veh_id for veh_id, _ in trips]
+        trip = {k: [e[k] for _, e in trips] for k in ('f', 't', 's', 'tm')}
+
+    # A. Dữ liệu TỔNG HỢP (Aggregated)
+    df_agg = pd.DataFrame({
+        'date': date_str,
+        'hour': hour,
+        'from_id': agg['f'],
+        'to_id': agg['t'],
+        'from_name': _lookup_names(agg['f']),
+        'to_name': _lookup_names(agg['t']),
+        'avg_speed_kmh': agg['s'],
+        'avg_time_sec': agg['tm'],
+        'trip_count': agg['c'],
+        'p50_speed_kmh': agg['p50'],
+        'p85_speed_kmh': agg['p85'],
+        'speed_variance': agg['var']
+    }, columns=AGG_COLS)
+
+    # B. Dữ liệu CHI TIẾT (Vehicles) -> CÓ VEHICLE ID
+    df_trips = pd.DataFrame({
+        'date': date_str,
+        'hour': hour,
+        'vehicle_id': trip_vid,
+        'from_id': trip['f'],
+        'to_id': trip['t'],
+        'from_name': _lookup_names(trip['f']),
+        'to_name': _lookup_names(trip['t']),
+        'speed_kmh': trip['s'],
+        'travel_time_sec': trip['tm']
+    }, columns=TRIP_COLS)
+
+    return (df_agg.sort_values('from_name', kind='stable'),
+            df_trips.sort_values('vehicle_id', kind='stable'))
+
+def _read_shard_safe(args):
+    try:
+        return read_shard(*args), None
+    except Exception as e:
+        return None, str(e)
+
+class _CsvSink:
+    """Ghi nối tiếp một bảng ra một file CSV, hoặc mỗi ngày một file khi partition."""
+    def __init__(self, out_file, partition):
+        self.out_file = out_file
+        self.partition = partition
+        self.handle = None
+        self.current = None
+        self.rows = 0
+        self.files = 0
+
+    def write(self, df, date_str):
+        if df.empty:
+            return
+        key = date_str if self.partition == 'date' else None
+        if self.handle is None or key != self.current:
+            self.close()
+            path = self.out_file
+            if key is not None:
+                out_dir = os.path.splitext(self.out_file)[0]
+                os.makedirs(out_dir, exist_ok=True)
+                path = os.path.join(out_dir, f"{key}.csv")
+            # utf-8-sig: BOM chỉ ghi một lần ở đầu file
+            self.handle = open(path, 'w', encoding='utf-8-sig', newline='')
+            self.current = key
+            self.files += 1
+            df.to_csv(self.handle, index=False)
+        else:
+            df.to_csv(self.handle, index=False, header=False)
+        self.rows += len(df)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+def export_data(workers: int = None, partition: str = None):
+    """Xuất các mảnh trong INPUT_DIR ra CSV.
+
+    workers: số process đọc mảnh song song (mặc định = số CPU).
+    partition: None -> một file cho mỗi bảng; 'date' -> mỗi ngày một file
+    trong thư mục cùng tên (vd. traffic_trips_detailed/2025-04-01.csv).
+    """
     print("--- BẮT ĐẦU XUẤT DỮ LIỆU RA CSV ---")
     
     if not os.path.exists(INPUT_DIR):
@@ -41,79 +166,71 @@ def export_data():
     else:
         print("❌ Không tìm thấy file nodes.json")
         return
+    node_names = {int(k): v for k, v in nodes_map.items()}
 
     # 2. XỬ LÝ CHI TIẾT (EDGES & TRIPS)
     print("2. Đang quét dữ liệu phân mảnh...")
     
     all_files = glob.glob(os.path.join(INPUT_DIR, "*.json"))
-    chunk_files = [f for f in all_files if "nodes.json" not in f and "index.json" not in f]
-    
-    agg_rows = []   # Danh sách tổng hợp
-    trip_rows = []  # Danh sách chi tiết (có Vehicle ID)
-    
-    count = 0
-    for file_path in chunk_files:
-        filename = os.path.basename(file_path)
+    shards = []
+    for file_path in all_files:
         # Parse Ngày và Giờ từ tên file: 2025-04-01_8.json
-        match = re.search(r'(\d{4}-\d{2}-\d{2})_(\d+)', filename)
+        match = re.search(r'(\d{4}-\d{2}-\d{2})_(\d+)\.json$', os.path.basename(file_path))
         if not match: continue
-            
-        date_str = match.group(1)
-        hour_str = int(match.group(2))
-        
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-                # A. Lấy dữ liệu TỔNG HỢP (Aggregated)
-                if 'agg' in data:
-                    for e in data['agg']:
-                        agg_rows.append({
-                            'date': date_str,
-                            'hour': hour_str,
-                            'from_id': e['f'],
-                            'to_id': e['t'],
-                            'from_name': nodes_map.get(str(e['f']), 'Unknown'),
-                            'to_name': nodes_map.get(str(e['t']), 'Unknown'),
-                            'avg_speed_kmh': e['s'],
-                            'avg_time_sec': e['tm'],
-                            'trip_count': e['c']
-                        })
-
-                # B. Lấy dữ liệu CHI TIẾT (Vehicles) -> CÓ VEHICLE ID
-                if 'veh' in data:
-                    # data['veh'] là dict: { "vehicle_id": [list of edges], ... }
-                    for veh_id, edges in data['veh'].items():
-                        for e in edges:
-                            trip_rows.append({
-                                'date': date_str,
-                                'hour': hour_str,
-                                'vehicle_id': veh_id,   # <--- ID XE Ở ĐÂY
-                                'from_id': e['f'],
-                                'to_id': e['t'],
-                                'from_name': nodes_map.get(str(e['f']), 'Unknown'),
-                                'to_name': nodes_map.get(str(e['t']), 'Unknown'),
-                                'speed_kmh': e['s'],
-                                'travel_time_sec': e['tm']
-                            })
-                            
-        except Exception as e:
-            print(f"⚠️ Lỗi file {filename}: {e}")
-            
-        count += 1
-        if count % 100 == 0: print(f"   ... Đã đọc {count}/{len(chunk_files)} file", end='\r')
+        shards.append((file_path, match.group(1), int(match.group(2))))
+    # Thứ tự (ngày, giờ) của tên mảnh = thứ tự sort của file CSV -> ghi nối tiếp, không cần giữ cả bảng
+    shards.sort(key=lambda x: (x[1], x[2]))
 
-    # 3. LƯU FILE CSV
-    print(f"\n3. Đang ghi file...")
-    
-    # Lưu file Tổng hợp
-    if agg_rows:
-        df_agg = pd.DataFrame(agg_rows)
-        df_agg.sort_values(['date', 'hour', 'from_name']).to_csv(OUT_EDGES, index=False, encoding='utf-8-sig')
-        print(f"✔ File Tổng hợp: {OUT_EDGES} ({len(df_agg)} dòng)")
-        
-    # Lưu file Chi tiết
-    if trip_rows:
-        df_trips = pd.DataFrame(trip_rows)
-        df_trips.sort_values(['date', 'hour', 'vehicle_id']).to_csv(OUT_TRIPS, index=False, encoding='utf-8-sig')
-        print(f"✔ File Chi tiết: {OUT_TRIPS} ({len(df_trips)} dòng)")
\ No newline at end of file
+    workers = workers or os.cpu_count() or 1
+    st = pipelineMetrics.start('export_data', shards=len(shards), workers=workers, partition=partition)
+    agg_sink = _CsvSink(OUT_EDGES, partition)
+    trip_sink = _CsvSink(OUT_TRIPS, partition)
+
+    def consume(args, result, error):
+        if error is not None:
+            print(f"⚠️ Lỗi file {os.path.basename(args[0])}: {error}")
+            return
+        df_agg, df_trips = result
+        agg_sink.write(df_agg, args[1])
+        trip_sink.write(df_trips, args[1])
+
+    count = 0
+    try:
+        if workers > 1 and len(shards) > 1:
+            # Giới hạn số mảnh đang xử lý để bộ nhớ không phình khi ghi chậm hơn đọc
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(node_names,)) as pool:
+                pending = deque()
+                for args in shards:
+                    pending.append((args, pool.submit(_read_shard_safe, args)))
+                    if len(pending) >= 2 * workers:
+                        done_args, fut = pending.popleft()
+                        consume(done_args, *fut.result())
+                        count += 1
+                        if count % 100 == 0: print(f"   ... Đã đọc {count}/{len(shards)} file", end='\r')
+                while pending:
+                    done_args, fut = pending.popleft()
+                    consume(done_args, *fut.result())
+                    count += 1
+        else:
+            _init_worker(node_names)
+            for args in shards:
+                consume(args, *_read_shard_safe(args))
+                count += 1
+                if count % 100 == 0: print(f"   ... Đã đọc {count}/{len(shards)} file", end='\r')
+    finally:
+        agg_sink.close()
+        trip_sink.close()
+
+    written = [OUT_NODES] + [
+        os.path.splitext(sink.out_file)[0] if partition == 'date' else sink.out_file for sink in (agg_sink, trip_sink)
+    ]
+    st.done(agg_rows=agg_sink.rows, trip_rows=trip_sink.rows, files=agg_sink.files + trip_sink.files,
+            bytes_written=pipelineMetrics.file_bytes(*written) if pipelineMetrics.enabled() else 0)
+
+    # 3. KẾT QUẢ
+    print(f"\n3. Đã ghi file...")
+    where = " (theo ngày)" if partition == 'date' else ""
+    if agg_sink.rows:
+        print(f"✔ File Tổng hợp: {OUT_EDGES}{where} ({agg_sink.rows} dòng, {agg_sink.files} file)")
+    if trip_sink.rows:
+        print(f"✔ File Chi tiết: {OUT_TRIPS}{where} ({trip_sink.rows} dòng, {trip_sink.files} file)")
@@ -2,14 +2,72 @@ import pandas as pd
 import numpy as np
 from sklearn.cluster import DBSCAN
 import os
+import pipelineMetrics
+from concurrent.futures import ThreadPoolExecutor
 
-def group_stops_nested_structure(root_folder, output_file='grouped_stops_nested.csv', radius_meters=200):
-    print(f"Đang quét cấu trúc thư mục tại: {root_folder}...")
+# Định nghĩa 2 file cần tìm
+FILE_MAP = {
+    'stops_by_var.csv': 'Luot_Di',    # Gán nhãn hướng đi
+    'rev_stops_by_var.csv': 'Luot_Ve' # Gán nhãn hướng về
+}
+
+def read_route_file(file_path, route_id, direction):
+    """Đọc một file trạm của một tuyến/hướng, gắn thêm RouteId + Direction."""
+    # Đọc file CSV
+    df = pd.read_csv(file_path, skipinitialspace=True)
+    df.columns = df.columns.str.strip() # Chuẩn hóa tên cột
     
-    df_list = []
+    # Chọn các cột cần thiết
+    cols_needed = ['StopId', 'Code', 'Name', 'Lat', 'Lng', 'StopType', 'Street', 'Routes']
+    available_cols = [c for c in cols_needed if c in df.columns]
+    temp_df = df[available_cols].copy()
+    
+    # --- QUAN TRỌNG: Thêm thông tin ngữ cảnh ---
+    temp_df['RouteId'] = route_id   # Lấy từ tên thư mục
+    temp_df['Direction'] = direction # Lấy từ tên file
+    return temp_df
+
+def _read_route_file_safe(args):
+    try:
+        return read_route_file(*args), None
+    except Exception as e:
+        return None, e
+
+def cluster_unique_coords(lat, lng, radius_meters, n_jobs=None):
+    """DBSCAN haversine trên các tọa độ đã gộp trùng, trả về nhãn cho từng dòng gốc.
+
+    Cùng một trạm xuất hiện lại ở mỗi tuyến/hướng nên chỉ chạy DBSCAN trên tọa
+    độ duy nhất (sample_weight = số lần lặp). Tọa độ duy nhất giữ thứ tự xuất
+    hiện đầu tiên nên nhãn cluster đánh số y hệt khi chạy trên toàn bộ dòng.
+    """
+    coords = np.column_stack((lat, lng))
+    uniq, first_idx, inverse = np.unique(coords, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(first_idx, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    uniq = uniq[order]
+    weights = np.bincount(rank[inverse], minlength=len(uniq))
+
+    kms_per_radian = 6371.0088
+    epsilon = (radius_meters / 1000) / kms_per_radian
+
+    db = DBSCAN(eps=epsilon, min_samples=1, metric='haversine', algorithm='ball_tree', n_jobs=n_jobs)
+    db.fit(np.radians(uniq), sample_weight=weights)
+    return db.labels_[rank[inverse]], len(uniq)
+
+def group_stops_nested_structure(root_folder, output_file='grouped_stops_nested.csv', radius_meters=200,
+                                 n_jobs=None, read_workers=8):
+    """Gom nhóm trạm của mọi tuyến trong `root_folder` bằng DBSCAN.
+
+    read_workers: số luồng đọc các file stops_by_var.csv song song.
+    n_jobs: số CPU cho DBSCAN (-1 = tất cả).
+    """
+    print(f"Đang quét cấu trúc thư mục tại: {root_folder}...")
     
     # 1. Duyệt qua tất cả thư mục con bằng os.walk
     # os.walk sẽ đi vào từng ngóc ngách của thư mục root_folder
+    tasks = []
     for current_root, dirs, files in os.walk(root_folder):
         
         # Lấy tên thư mục hiện tại làm RouteID (ví dụ: thư mục "01" -> RouteID = "01")
@@ -19,33 +77,21 @@ def group_stops_nested_structure(root_folder, output_file='grouped_stops_nested.
         if current_root == root_folder:
             continue
 
-        # Định nghĩa 2 file cần tìm
-        file_map = {
-            'stops_by_var.csv': 'Luot_Di',    # Gán nhãn hướng đi
-            'rev_stops_by_var.csv': 'Luot_Ve' # Gán nhãn hướng về
-        }
-
-        for filename, direction in file_map.items():
+        for filename, direction in FILE_MAP.items():
             if filename in files:
-                file_path = os.path.join(current_root, filename)
-                try:
-                    # Đọc file CSV
-                    df = pd.read_csv(file_path, skipinitialspace=True)
-                    df.columns = df.columns.str.strip() # Chuẩn hóa tên cột
-                    
-                    # Chọn các cột cần thiết
-                    cols_needed = ['StopId', 'Code', 'Name', 'Lat', 'Lng', 'StopType', 'Street', 'Routes']
-                    available_cols = [c for c in cols_needed if c in df.columns]
-                    temp_df = df[available_cols].copy()
-                    
-                    # --- QUAN TRỌNG: Thêm thông tin ngữ cảnh ---
-                    temp_df['RouteId'] = route_id   # Lấy từ tên thư mục
-                    temp_df['Direction'] = direction # Lấy từ tên file
-                    
-                    df_list.append(temp_df)
-                    
-                except Exception as e:
-                    print(f"Lỗi đọc file {file_path}: {e}")
+                tasks.append((os.path.join(current_root, filename), route_id, direction))
+
+    # Đọc song song, giữ đúng thứ tự duyệt để bảng Master không đổi
+    df_list = []
+    with pipelineMetrics.stage('read_routes', files=len(tasks)) as st:
+        with ThreadPoolExecutor(max_workers=max(1, read_workers)) as pool:
+            for (file_path, _, _), (temp_df, error) in zip(tasks, pool.map(_read_route_file_safe, tasks)):
+                if error is not None:
+                    print(f"Lỗi đọc file {file_path}: {error}")
+                    continue
+                df_list.append(temp_df)
+        st['rows'] = sum(len(df) for df in df_list)
+        st['errors'] = len(tasks) - len(df_list)
 
     if not df_list:
         print("Không tìm thấy dữ liệu nào trong các thư mục con!")
@@ -58,14 +104,16 @@ def group_stops_nested_structure(root_folder, output_file='grouped_stops_nested.
     print(f"Tổng số trạm tìm thấy từ {len(df_list)} file con: {len(combined_df)}")
     print("Đang chạy thuật toán gom nhóm vị trí (DBSCAN)...")
 
-    # 3. Chuẩn bị DBSCAN
-    coords = np.radians(combined_df[['Lat', 'Lng']].values)
-    kms_per_radian = 6371.0088
-    epsilon = (radius_meters / 1000) / kms_per_radian
-
-    # 4. Chạy DBSCAN
-    db = DBSCAN(eps=epsilon, min_samples=1, metric='haversine', algorithm='ball_tree').fit(coords)
-    combined_df['cluster_label'] = db.labels_
+    # 3-4. Chạy DBSCAN trên tọa độ duy nhất rồi trả nhãn về từng dòng
+    with pipelineMetrics.stage('dbscan', rows=len(combined_df)) as st:
+        labels, n_unique = cluster_unique_coords(
+            combined_df['Lat'].to_numpy(dtype=np.float64), combined_df['Lng'].to_numpy(dtype=np.float64),
+            radius_meters, n_jobs
+        )
+        st['unique_coords'] = n_unique
+        st['clusters'] = int(labels.max()) + 1 if len(labels) else 0
+    print(f"   -> {n_unique} tọa độ duy nhất sau khi gộp trùng")
+    combined_df['cluster_label'] = labels
 
     # 5. Tính tọa độ trung tâm
     centroids = combined_df.groupby('cluster_label')[['Lat', 'Lng']].mean().reset_index()
@@ -82,7 +130,9 @@ def group_stops_nested_structure(root_folder, output_file='grouped_stops_nested.
     final_df = final_df[cols_order]
 
     # 7. Xuất file
-    final_df.to_csv(output_file, index=False, encoding='utf-8-sig')
+    with pipelineMetrics.stage('write_clusters', rows=len(final_df)) as st:
+        final_df.to_csv(output_file, index=False, encoding='utf-8-sig')
+        st['bytes_written'] = os.path.getsize(output_file)
     print(f"Hoàn tất! Đã lưu file tổng hợp tại: {output_file}")
     print(f"Số điểm dừng duy nhất (Cluster): {len(centroids)}")
     return output_file
@@ -5,10 +5,23 @@ import os
 import glob
 import re
 import shutil
-from scipy.spatial import cKDTree
+import traceback
+import tempfile
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import gpsLoader
+import chunkStore
+import edgeStats
+import tripStore
+import pipelineMetrics
+from nodeIndex import NodeIndex
 
 # --- CẤU HÌNH ---
 OUTPUT_DIR = 'traffic_data_chunks'
+MANIFEST_FILE = 'manifest.json'
+STREAM_ROW_BYTES = 200 # ước lượng bộ nhớ pandas cho một dòng GPS khi đọc theo chunk
+WRITER_QUEUE = 2       # số lô mảnh tối đa chờ luồng ghi nền (0 = ghi ngay trên luồng chính)
 
 # Class hỗ trợ convert số numpy sang số python tự động
 class NpEncoder(json.JSONEncoder):
@@ -29,182 +42,677 @@ def haversine_np(lon1, lat1, lon2, lat2):
     c = 2 * np.arcsin(np.sqrt(a))
     return 6371000 * c
 
+def extract_transitions(veh_codes, node_ids, times, min_time, max_time):
+    """Tìm mọi chuyến trạm -> trạm của tất cả xe cùng lúc.
+
+    Đầu vào đã sắp theo (xe, thời gian). Tương đương vòng lặp last_node /
+    departure_time cũ: với hai lần khớp trạm liên tiếp của cùng một xe, nếu
+    khác trạm thì sinh chuyến, khởi hành tại lần khớp trước.
+    Trả về dict các mảng: veh, f, t, dep, tm (giây), hour.
+    """
+    matched = np.flatnonzero(node_ids != -1)
+    veh = veh_codes[matched]
+    nodes = node_ids[matched]
+    tms = times[matched]
+
+    # Cặp (prev, curr) liên tiếp trong cùng một xe và đổi trạm
+    step = (veh[1:] == veh[:-1]) & (nodes[1:] != nodes[:-1])
+    curr = np.flatnonzero(step) + 1
+    prev = curr - 1
+
+    travel_time = (tms[curr] - tms[prev]) / np.timedelta64(1, 's')
+    keep = (min_time < travel_time) & (travel_time < max_time)
+    curr, prev, travel_time = curr[keep], prev[keep], travel_time[keep]
+
+    dep = tms[prev]
+    hour = dep.astype('datetime64[h]').astype(np.int64) % 24
+    return {
+        "veh": veh[curr],
+        "f": nodes[prev],
+        "t": nodes[curr],
+        "dep": dep,
+        "tm": travel_time,
+        "hour": hour,
+    }
+
+def build_hourly_chunks(trans, vid_strs, node_lat, node_lng, stats=None):
+    """Gom các chuyến thành {h: {"agg": [...], "veh": {...}}} theo đúng thứ tự cũ.
+
+    Thứ tự giờ / xe / cạnh là thứ tự xuất hiện đầu tiên khi duyệt theo
+    (xe, thời gian). Mỗi bản ghi agg có thêm p50/p85 và phương sai tốc độ;
+    nếu truyền dict `stats`, accumulator của từng giờ (edgeStats) được gán vào stats[h].
+    """
+    f, t, tm, hour, veh = trans["f"], trans["t"], trans["tm"], trans["hour"], trans["veh"]
+    dist_m = haversine_np(node_lng[f], node_lat[f], node_lng[t], node_lat[t])
+    speed = (dist_m / 1000) / (tm / 3600)
+
+    uniq_h, first_h = np.unique(hour, return_index=True)
+    chunks = {}
+    for h in uniq_h[np.argsort(first_h)].tolist():
+        sel = np.flatnonzero(hour == h)
+        hf, ht, hv = f[sel], t[sel], veh[sel]
+        hs, htm = speed[sel], tm[sel]
+
+        # Chi tiết từng xe (các chuyến của một xe nằm liền nhau)
+        vehicles = {}
+        rows = [
+            {"f": a, "t": b, "tm": round(c, 1), "s": round(d, 1)}
+            for a, b, c, d in zip(hf.tolist(), ht.tolist(), htm.tolist(), hs.tolist())
+        ]
+        bounds = np.flatnonzero(np.diff(hv)) + 1
+        starts = np.concatenate(([0], bounds)).tolist()
+        ends = np.concatenate((bounds, [len(hv)])).tolist()
+        for s0, e0 in zip(starts, ends):
+            vehicles[vid_strs[hv[s0]]] = rows[s0:e0]
+
+        # Tổng hợp theo cạnh (accumulator gộp được), giữ thứ tự xuất hiện đầu tiên
+        acc = edgeStats.from_samples(hf, ht, hs, htm)
+        if stats is not None:
+            stats[str(h)] = acc
+        chunks[str(h)] = {"agg": agg_records(acc, node_lat, node_lng), "veh": vehicles}
+    return chunks
+
+def agg_records(acc, node_lat, node_lng):
+    """Accumulator theo cạnh (edgeStats) -> danh sách bản ghi agg {f, t, s, tm, c, p50, p85, var}."""
+    counts = acc['count']
+    avg = acc['sum_speed'] / counts
+    extra = edgeStats.summary(acc)
+
+    eu, ev = acc['from'], acc['to']
+    e_dist = haversine_np(node_lng[eu], node_lat[eu], node_lng[ev], node_lat[ev])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_t = np.where(avg > 0, (e_dist / 1000) / (avg / 3600), 0)
+
+    aggs = []
+    for i in range(len(counts)):
+        aggs.append({
+            "f": int(eu[i]),
+            "t": int(ev[i]),
+            "s": round(float(avg[i]), 1),
+            "tm": round(float(avg_t[i]), 1),
+            "c": int(counts[i]),
+            "p50": round(float(extra['p50'][i]), 1),
+            "p85": round(float(extra['p85'][i]), 1),
+            "var": round(float(extra['var'][i]), 1)
+        })
+    return aggs
+
+def write_chunk(date_key, h, chunk, columnar=None, ndjson=True, ndjson_compress=(), binary=False, stats=None,
+                sqlite=False, vehicle_ranges=None):
+    """Ghi một mảnh giờ `YYYY-MM-DD_H.json`.
+
+    Kèm theo: `.ndjson` cho viewer (và bản `.gz`/`.br` theo `ndjson_compress`),
+    bản dạng cột nếu `columnar` là 'npy'/'parquet', `.bin` nhị phân nếu `binary`,
+    accumulator theo cạnh `.stats.npz` nếu có `stats`, các dòng trong
+    `traffic.sqlite` (tripStore) nếu `sqlite`. Vị trí byte các chuyến của từng
+    xe trong file JSON được gán vào vehicle_ranges[h] (cho chỉ mục xe theo ngày).
+    """
+    chunk_filename = f"{date_key}_{h}.json"
+    # NpEncoder chỉ dùng khi còn sót số numpy; ghi qua file tạm để reader không thấy mảnh dở
+    text, ranges = chunkStore.chunk_to_json(chunk, cls=NpEncoder)
+    chunkStore.write_atomic(os.path.join(OUTPUT_DIR, chunk_filename), text)
+    if vehicle_ranges is not None:
+        vehicle_ranges[h] = ranges
+    if ndjson:
+        chunkStore.write_ndjson(OUTPUT_DIR, date_key, h, chunk, ndjson_compress)
+    if columnar:
+        chunkStore.write_columnar(OUTPUT_DIR, date_key, h, chunk, columnar)
+    if binary:
+        chunkStore.write_binary(OUTPUT_DIR, date_key, h, chunk)
+    if stats is not None:
+        edgeStats.write_stats(OUTPUT_DIR, date_key, h, stats)
+    if sqlite:
+        tripStore.write_chunk(tripStore.db_path(OUTPUT_DIR), date_key, h, chunk)
+    return chunk_bytes(date_key, h) if pipelineMetrics.enabled() else 0
+
+def chunk_bytes(date_key, h):
+    """Số byte của mọi file thuộc một mảnh giờ (JSON, NDJSON, bản cột, .bin)."""
+    base = os.path.join(OUTPUT_DIR, f"{date_key}_{h}")
+    return pipelineMetrics.file_bytes(
+        f"{base}.json", f"{base}.ndjson", f"{base}.ndjson.gz", f"{base}.ndjson.br", f"{base}.bin",
+        f"{base}.stats.npz", f"{base}.cols", f"{base}.agg.parquet", f"{base}.trips.parquet"
+    )
+
+def process_gps_file(file_path, date_key, ctx, opts):
+    """Map-matching + cắt theo giờ cho một file GPS, ghi các mảnh JSON.
+
+    `ctx` chứa chỉ mục node dùng chung (ctx['index'] là NodeIndex),
+    `opts` là tham số build (radius, min_time, max_time, ...).
+    Trả về danh sách giờ đã ghi.
+    """
+    if opts.get("stream"):
+        return process_gps_file_streaming(file_path, date_key, ctx, opts)
+
+    fname = os.path.basename(file_path)
+    with pipelineMetrics.stage('load_gps', file=fname) as st:
+        df = gpsLoader.load_gps(file_path)
+        st['rows'] = len(df)
+        st['bytes_read'] = os.path.getsize(file_path)
+
+    # Map Matching
+    with pipelineMetrics.stage('map_matching', file=fname) as st:
+        df['node_id'] = ctx['index'].match(df['lat'].values, df['lng'].values, opts['radius'])
+        df = df.drop(columns=['lat', 'lng']) # không cần sau khi khớp -> bớt bộ nhớ khi sắp xếp
+        st['rows'] = len(df)
+        st['matched'] = int((df['node_id'].values != -1).sum())
+        st['match_rate'] = round(st['matched'] / len(df), 4) if len(df) else 0.0
+
+    with pipelineMetrics.stage('transitions', file=fname) as st:
+        df = df.sort_values(['anonymized_vehicle', 'datetime'])
+        df = df[df['anonymized_vehicle'].notna()] # groupby cũ bỏ qua xe NaN
+
+        # Mã hóa xe thành số nguyên theo thứ tự đã sắp
+        veh_codes, veh_keys = pd.factorize(df['anonymized_vehicle'], sort=False)
+        vid_strs = [str(v) for v in veh_keys]
+
+        trans = extract_transitions(
+            veh_codes, df['node_id'].values, df['datetime'].values, opts['min_time'], opts['max_time']
+        )
+        hourly_stats = {}
+        hourly_data = build_hourly_chunks(trans, vid_strs, ctx['index'].node_lat, ctx['index'].node_lng, hourly_stats)
+        st['vehicles'] = len(vid_strs)
+        st['transitions'] = len(trans['veh'])
+
+    # Save Chunks (serialize + ghi trên luồng nền, chồng lên việc đọc / khớp file kế tiếp)
+    _writer(ctx).submit(file_path, write_hours, date_key, hourly_data, hourly_stats, opts, fname)
+    return [int(h) for h in hourly_data]
+
+def write_hours(date_key, hourly_data, hourly_stats, opts, fname=None):
+    """Ghi các mảnh giờ của một file rồi cập nhật chỉ mục xe của ngày."""
+    vehicle_ranges = {}
+    with pipelineMetrics.stage('write_shards', file=fname) as st:
+        written_bytes = 0
+        for h, chunk in hourly_data.items():
+            written_bytes += write_chunk(date_key, h, chunk, opts.get('columnar'), opts.get('ndjson', True),
+                                         opts.get('ndjson_compress', ()), opts.get('binary', False), hourly_stats[h],
+                                         opts.get('sqlite', False), vehicle_ranges)
+        chunkStore.write_vehicle_index(OUTPUT_DIR, date_key, vehicle_ranges)
+        st['hours'] = len(hourly_data)
+        st['bytes_written'] = written_bytes
+
+class ShardWriter:
+    """Luồng ghi nền cho các mảnh giờ: serialize JSON + ghi file chạy song song với file GPS kế tiếp.
+
+    Mọi việc chạy lần lượt trên một luồng theo đúng thứ tự gửi (ghi lại cùng một giờ
+    vẫn ra kết quả cuối đúng); submit() chặn khi đã có `max_pending` việc chưa xong để
+    giới hạn bộ nhớ giữ các mảnh chờ ghi. Việc được gom theo khóa (đường dẫn file GPS),
+    wait(khóa) trả về lỗi ghi của file đó. max_pending=0: chạy ngay trên luồng gọi.
+    """
+
+    def __init__(self, max_pending=None):
+        max_pending = WRITER_QUEUE if max_pending is None else max_pending
+        if pipelineMetrics.profiling():
+            # cProfile / tracemalloc đo theo process hoặc luồng chính: ghi đồng bộ để không lẫn số đo
+            max_pending = 0
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shard-writer') if max_pending else None
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self._pending = {}
+
+    def submit(self, key, fn, *args):
+        if self._pool is None:
+            fn(*args)
+            return
+        self._slots.acquire()
+        fut = self._pool.submit(fn, *args)
+        fut.add_done_callback(lambda _: self._slots.release())
+        self._pending.setdefault(key, []).append(fut)
+
+    def wait(self, key):
+        """Chờ mọi việc của `key`; trả về lỗi đầu tiên (kèm traceback) hoặc None."""
+        error = None
+        for fut in self._pending.pop(key, []):
+            try:
+                fut.result()
+            except Exception as e:
+                error = error or f"{e}\n{traceback.format_exc()}"
+        return error
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+def _writer(ctx):
+    # ctx không có luồng ghi (gọi process_gps_file từ ngoài) -> ghi đồng bộ như trước
+    return ctx.get('writer') or ShardWriter(0)
+
+def stream_chunk_rows(memory_budget_mb):
+    """Số dòng CSV mỗi lần đọc sao cho một chunk chiếm khoảng nửa ngân sách bộ nhớ."""
+    return max(10_000, int(memory_budget_mb * 2**20) // (2 * STREAM_ROW_BYTES))
+
+def process_gps_file_streaming(file_path, date_key, ctx, opts):
+    """Như process_gps_file nhưng đọc file theo từng chunk, bộ nhớ không phụ thuộc kích thước file.
+
+    Chỉ giữ lại các điểm đã khớp trạm. Dữ liệu có thể lệch thứ tự thời gian
+    tối đa `max_lateness` giây: điểm cũ hơn mốc watermark (thời gian lớn nhất
+    đã thấy - max_lateness) mới được sắp theo (xe, thời gian) và đưa qua
+    trạng thái last_node/departure_time của từng xe. Một giờ được ghi ra đĩa
+    ngay khi watermark vượt quá cuối giờ + max_time (không còn chuyến nào có
+    thể khởi hành trong giờ đó). Điểm đến trễ hơn watermark bị bỏ qua.
+    """
+    min_time, max_time = opts['min_time'], opts['max_time']
+    lateness = np.timedelta64(int(opts.get('max_lateness', 0)), 's')
+    horizon = np.timedelta64(int(np.ceil(max_time)), 's')
+    chunk_rows = opts.get('chunk_rows') or stream_chunk_rows(opts.get('memory_budget_mb', 512))
+
+    vid_codes = {}              # vid -> mã số nguyên
+    vid_strs = []
+    last_node = np.zeros(0, dtype=np.int64)   # trạng thái theo mã xe
+    last_time = np.zeros(0, dtype='datetime64[ns]')
+
+    buf = []                    # các điểm đã khớp, chưa qua watermark
+    hour_trans = {}             # giờ -> list các dict mảng chuyến
+    hour_last = {}              # giờ -> giờ tuyệt đối muộn nhất của chuyến khởi hành
+    written = []
+    vehicle_ranges = {}         # giờ -> vị trí chuyến từng xe (lần ghi cuối của giờ đó)
+    seq_offset = 0
+    max_seen = None
+    watermark = None
+    dropped = 0
+    st = pipelineMetrics.start('stream_file', file=os.path.basename(file_path))
+    counts = {"rows": 0, "matched": 0, "transitions": 0, "bytes_written": 0}
+
+    def finalize(batch):
+        nonlocal last_node, last_time
+        veh, node, tms, seq = batch
+        # Ghép điểm cuối cùng đã biết của mỗi xe vào đầu lô để nối chuyến qua các chunk
+        carried = np.unique(veh)
+        carried = carried[last_node[carried] != -1]
+        veh = np.concatenate((carried, veh))
+        node = np.concatenate((last_node[carried], node))
+        tms = np.concatenate((last_time[carried], tms))
+        seq = np.concatenate((np.full(len(carried), -1, dtype=np.int64), seq))
+        order = np.lexsort((seq, tms, veh))
+        veh, node, tms = veh[order], node[order], tms[order]
+
+        trans = extract_transitions(veh, node, tms, min_time, max_time)
+        counts["transitions"] += len(trans["veh"])
+        abs_hour = trans["dep"].astype('datetime64[h]')
+        for h in np.unique(trans["hour"]).tolist():
+            sel = trans["hour"] == h
+            hour_trans.setdefault(h, []).append({k: v[sel] for k, v in trans.items()})
+            latest = abs_hour[sel].max()
+            hour_last[h] = max(hour_last.get(h, latest), latest)
+
+        # Trạng thái mới = điểm cuối của mỗi xe trong lô
+        tail = np.flatnonzero(np.append(veh[1:] != veh[:-1], True))
+        last_node[veh[tail]] = node[tail]
+        last_time[veh[tail]] = tms[tail]
+
+    def flush(h):
+        parts = hour_trans.pop(h)
+        hour_last.pop(h)
+        # File vắt qua nửa đêm: giờ này đã ghi trước đó -> gộp lại với phần đã xả ra đĩa
+        spill_path = os.path.join(spill_dir, f"{h}.npz")
+        if os.path.exists(spill_path):
+            with np.load(spill_path) as old:
+                parts.insert(0, {k: old[k] for k in old.files})
+        trans = {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+        np.savez(spill_path, **trans)
+        # Sắp như bản batch: theo tên xe rồi thời điểm khởi hành
+        names = np.array(vid_strs)
+        rank = np.empty(len(names), dtype=np.int64)
+        rank[np.argsort(names, kind='stable')] = np.arange(len(names))
+        order = np.lexsort((trans["dep"], rank[trans["veh"]]))
+        trans = {k: v[order] for k, v in trans.items()}
+        hourly_stats = {}
+        hourly_data = build_hourly_chunks(trans, vid_strs, ctx['index'].node_lat, ctx['index'].node_lng, hourly_stats)
+        writer.submit(file_path, write_flushed, hourly_data, hourly_stats)
+        if h not in written:
+            written.append(h)
+
+    def write_flushed(hourly_data, hourly_stats):
+        # Chạy trên luồng ghi: vehicle_ranges / bytes_written chỉ bị sửa ở đây
+        for hk, chunk in hourly_data.items():
+            counts["bytes_written"] += write_chunk(date_key, hk, chunk, opts.get('columnar'), opts.get('ndjson', True),
+                                                   opts.get('ndjson_compress', ()), opts.get('binary', False),
+                                                   hourly_stats[hk], opts.get('sqlite', False), vehicle_ranges)
+
+    def finish():
+        chunkStore.write_vehicle_index(OUTPUT_DIR, date_key, vehicle_ranges)
+        st.done(**counts, dropped=dropped, hours=len(written), bytes_read=os.path.getsize(file_path),
+                match_rate=round(counts["matched"] / counts["rows"], 4) if counts["rows"] else 0.0)
+
+    writer = _writer(ctx)
+    spill_dir = tempfile.mkdtemp(prefix='gps_stream_')
+    try:
+        for df in gpsLoader.iter_gps_chunks(file_path, chunk_rows):
+            df = df[df['anonymized_vehicle'].notna()]
+            if df.empty:
+                continue
+            tms = df['datetime'].values.astype('datetime64[ns]')
+            node = ctx['index'].match(df['lat'].values, df['lng'].values, opts['radius'])
+            counts["rows"] += len(df)
+            counts["matched"] += int((node != -1).sum())
+            seq = seq_offset + np.arange(len(df), dtype=np.int64)
+            seq_offset += len(df)
+
+            chunk_max = tms.max()
+            max_seen = chunk_max if max_seen is None else max(max_seen, chunk_max)
+
+            keep = node != -1
+            if watermark is not None:
+                late = keep & (tms < watermark)
+                dropped += int(late.sum())
+                keep &= ~late
+            if not keep.any():
+                continue
+
+            # Mã hóa xe (mã cố định suốt file)
+            codes, uniques = pd.factorize(df['anonymized_vehicle'].values[keep])
+            mapping = np.empty(len(uniques), dtype=np.int64)
+            for i, vid in enumerate(uniques):
+                if vid not in vid_codes:
+                    vid_codes[vid] = len(vid_strs)
+                    vid_strs.append(vid)
+                mapping[i] = vid_codes[vid]
+            if len(vid_strs) > len(last_node):
+                grow = len(vid_strs) - len(last_node)
+                last_node = np.concatenate((last_node, np.full(grow, -1, dtype=np.int64)))
+                last_time = np.concatenate((last_time, np.zeros(grow, dtype='datetime64[ns]')))
+            buf.append((mapping[codes], node[keep], tms[keep], seq[keep]))
+
+            # Đưa các điểm đã qua watermark vào trạng thái xe
+            watermark = max_seen - lateness
+            veh_b, node_b, tms_b, seq_b = (np.concatenate(c) for c in zip(*buf))
+            ready = tms_b < watermark
+            if ready.any():
+                finalize((veh_b[ready], node_b[ready], tms_b[ready], seq_b[ready]))
+            rest = ~ready
+            buf = [(veh_b[rest], node_b[rest], tms_b[rest], seq_b[rest])]
+
+            # Ghi các giờ đã hoàn tất
+            for h in [h for h, last in hour_last.items() if last + np.timedelta64(1, 'h') + horizon <= watermark]:
+                flush(h)
+
+        if buf:
+            veh_b, node_b, tms_b, seq_b = (np.concatenate(c) for c in zip(*buf))
+            if len(veh_b):
+                finalize((veh_b, node_b, tms_b, seq_b))
+        for h in list(hour_trans):
+            flush(h)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    if dropped:
+        print(f"   ⚠️ {os.path.basename(file_path)}: bỏ {dropped} điểm đến trễ quá {int(opts.get('max_lateness', 0))}s")
+    # Chỉ mục xe + số đo của file được ghi sau khi luồng ghi xong mọi giờ của file
+    writer.submit(file_path, finish)
+    return written
+
+# Bảng node dùng chung trong mỗi process con (gán một lần qua initializer)
+_WORKER_CTX = None
+
+def _init_worker(ctx):
+    global _WORKER_CTX
+    # Mỗi process con có luồng ghi nền riêng (ThreadPoolExecutor không pickle được)
+    _WORKER_CTX = {**ctx, "writer": ShardWriter()}
+    pipelineMetrics.configure(**ctx.get("metrics", {}))
+
+def _process_date(date_key, file_paths, ctx, opts, wait=True):
+    """Xử lý lần lượt các file của một ngày; lỗi của file nào trả về cho file đó.
+
+    wait=False: trả về ngay khi mọi file đã được khớp, các mảnh có thể còn đang ghi
+    trên luồng nền -> gọi _wait_writes trước khi đưa ngày vào index.json.
+    """
+    if ctx is None:
+        ctx = _WORKER_CTX
+    # Mọi file của ngày được xử lý lại từ đầu -> dựng lại chỉ mục xe của ngày
+    chunkStore.remove_vehicle_index(OUTPUT_DIR, date_key)
+    results = []
+    for file_path in file_paths:
+        try:
+            hours = process_gps_file(file_path, date_key, ctx, opts)
+            results.append((file_path, hours, None))
+        except Exception as e:
+            results.append((file_path, None, f"{e}\n{traceback.format_exc()}"))
+    return _wait_writes(results, ctx) if wait else results
+
+def _wait_writes(results, ctx):
+    """Chờ luồng ghi nền xong các file của một ngày; lỗi ghi được gán cho file tương ứng."""
+    writer = ctx.get('writer')
+    if writer is None:
+        return results
+    out = []
+    for file_path, hours, error in results:
+        write_error = writer.wait(file_path)
+        if error is None and write_error is not None:
+            hours, error = None, write_error
+        out.append((file_path, hours, error))
+    return out
+
+def file_fingerprint(path, with_hash=True):
+    """Dấu vân tay của file: size, mtime và (tùy chọn) sha1 nội dung."""
+    st = os.stat(path)
+    fp = {"size": st.st_size, "mtime": st.st_mtime_ns}
+    if with_hash:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        fp["sha1"] = h.hexdigest()
+    return fp
+
+def _same_file(path, old_fp):
+    """So với manifest: size/mtime khớp thì coi như không đổi, lệch thì so sha1."""
+    if old_fp is None:
+        return False
+    new_fp = file_fingerprint(path, with_hash=False)
+    if new_fp["size"] != old_fp.get("size"):
+        return False
+    if new_fp["mtime"] == old_fp.get("mtime"):
+        return True
+    if file_fingerprint(path)["sha1"] != old_fp.get("sha1"):
+        return False
+    old_fp["mtime"] = new_fp["mtime"] # chỉ bị touch: nhớ mtime mới để lần sau khỏi hash lại
+    return True
+
+def write_json_atomic(path, obj):
+    """Ghi JSON qua file tạm rồi os.replace để không bao giờ để lại file dở dang."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, cls=NpEncoder)
+    os.replace(tmp_path, path)
+
+def _remove_chunks(date_key, hours):
+    for h in hours:
+        chunk_path = os.path.join(OUTPUT_DIR, f"{date_key}_{h}.json")
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+        chunkStore.remove_ndjson(OUTPUT_DIR, date_key, h)
+        chunkStore.remove_columnar(OUTPUT_DIR, date_key, h)
+        chunkStore.remove_binary(OUTPUT_DIR, date_key, h)
+        edgeStats.remove_stats(OUTPUT_DIR, date_key, h)
+    tripStore.remove_hours(tripStore.db_path(OUTPUT_DIR), date_key, hours)
+
 def create_sharded_traffic_map(
     nodes_file: str,
     gps_folder: str,
     radius: int = 50,
     max_time: int = 5400,
-    min_time: int = 5
+    min_time: int = 5,
+    workers: int = 1,
+    rebuild: bool = False,
+    stream: bool = False,
+    memory_budget_mb: int = 512,
+    max_lateness: int = 300,
+    columnar: str = None,
+    ndjson: bool = True,
+    ndjson_compress: tuple = (),
+    binary: bool = False,
+    sqlite: bool = False
 ):
     print(f"\n--- [TrafficMap Sharding] Bắt đầu xử lý Big Data ---")
-    
-    if os.path.exists(OUTPUT_DIR):
-        shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
-    print(f"✔ Đã tạo thư mục output: {OUTPUT_DIR}")
+
+    if columnar and columnar not in chunkStore.COLUMNAR_FORMATS:
+        print(f"❌ columnar phải là một trong {chunkStore.COLUMNAR_FORMATS}")
+        return
+    if columnar == 'parquet' and not gpsLoader.has_pyarrow():
+        print("❌ columnar='parquet' cần cài pyarrow")
+        return
+    if any(c not in chunkStore.NDJSON_COMPRESSIONS for c in ndjson_compress or ()):
+        print(f"❌ ndjson_compress chỉ nhận {chunkStore.NDJSON_COMPRESSIONS}")
+        return
+    if 'br' in (ndjson_compress or ()) and not chunkStore.has_brotli():
+        print("❌ ndjson_compress='br' cần cài brotli")
+        return
+
+    # 0. MANIFEST: chỉ dựng lại khi tham số hoặc file node thay đổi (hoặc rebuild=True)
+    manifest_path = os.path.join(OUTPUT_DIR, MANIFEST_FILE)
+    ndjson_compress = tuple(ndjson_compress or ()) if ndjson else ()
+    params = {
+        "radius": radius, "min_time": min_time, "max_time": max_time, "columnar": columnar,
+        "ndjson": ndjson, "ndjson_compress": list(ndjson_compress), "binary": binary,
+        "sqlite": sqlite
+    }
+    nodes_fp = file_fingerprint(nodes_file) if os.path.exists(nodes_file) else None
+
+    manifest = None
+    if not rebuild and os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Manifest hỏng, dựng lại toàn bộ: {e}")
+        if manifest is not None:
+            old_nodes = manifest.get("nodes") or {}
+            if manifest.get("params") != params or nodes_fp is None or old_nodes.get("sha1") != nodes_fp["sha1"]:
+                print("   Tham số hoặc file node đã đổi -> dựng lại toàn bộ")
+                manifest = None
+
+    index_data = {}
+    if manifest is None:
+        tripStore.close(tripStore.db_path(OUTPUT_DIR))
+        if os.path.exists(OUTPUT_DIR):
+            shutil.rmtree(OUTPUT_DIR)
+        os.makedirs(OUTPUT_DIR)
+        manifest = {"params": params, "nodes": nodes_fp, "dates": {}}
+        print(f"✔ Đã tạo thư mục output: {OUTPUT_DIR}")
+    else:
+        index_path = os.path.join(OUTPUT_DIR, 'index.json')
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index_data = json.load(f)
+        print(f"✔ Cập nhật tăng dần thư mục: {OUTPUT_DIR}")
+
+    run_stage = pipelineMetrics.start('create_sharded_traffic_map')
 
     # 1. LOAD NODES
     print("1. Đang đọc dữ liệu Node...")
     try:
-        nodes_df = pd.read_csv(nodes_file)
-        unique_nodes = nodes_df.groupby('cluster_label').agg({
-            'centroid_lat': 'first', 'centroid_lng': 'first', 'Name': 'first'
-        }).reset_index()
-        
-        nodes_meta = {}
-        for _, row in unique_nodes.iterrows():
-            # Ép kiểu int() cho Key để tránh lỗi
-            nodes_meta[int(row['cluster_label'])] = {
-                "lat": float(row['centroid_lat']),
-                "lng": float(row['centroid_lng']),
-                "name": str(row['Name'])
-            }
+        with pipelineMetrics.stage('node_index') as st:
+            index = NodeIndex.load(nodes_file)
+            st['nodes'] = len(index)
+        nodes_meta = index.nodes_meta()
             
         # Lưu file nodes.json
         with open(os.path.join(OUTPUT_DIR, 'nodes.json'), 'w', encoding='utf-8') as f:
             json.dump(nodes_meta, f, cls=NpEncoder) # Dùng NpEncoder
-
-        # KDTree Setup
-        R = 6371000
-        phi = np.radians(unique_nodes['centroid_lat'])
-        theta = np.radians(unique_nodes['centroid_lng'])
-        tree_data = np.column_stack((
-            R * np.cos(phi) * np.cos(theta),
-            R * np.cos(phi) * np.sin(theta),
-            R * np.sin(phi)
-        ))
-        tree = cKDTree(tree_data)
-        idx_to_label = unique_nodes['cluster_label'].to_dict()
         
     except Exception as e:
         print(f"❌ Node Error: {e}")
         return
 
+    ctx = {"index": index, "metrics": pipelineMetrics.config()}
+    opts = {
+        **params, "stream": stream, "max_lateness": max_lateness,
+        "chunk_rows": stream_chunk_rows(memory_budget_mb)
+    }
+
     # 2. PROCESS FILES & SPLIT
     search_path = os.path.join(gps_folder, "*.csv")
     gps_files = sorted(glob.glob(search_path))
-    
-    index_data = {} 
-    print(f"2. Đang xử lý {len(gps_files)} file GPS...")
 
+    # Gom file theo ngày: các ngày độc lập nhau nên chạy song song được
+    date_files = {}
     for file_path in gps_files:
-        filename = os.path.basename(file_path)
-        match = re.search(r'(\d{4}-\d{2}-\d{2})', filename)
+        match = re.search(r'(\d{4}-\d{2}-\d{2})', os.path.basename(file_path))
         if not match: continue
-        date_key = match.group(1)
-        
-        try:
-            df = pd.read_csv(file_path)
-            df['datetime'] = pd.to_datetime(df['datetime'])
-            
-            # Map Matching
-            phi_gps = np.radians(df['lat'])
-            theta_gps = np.radians(df['lng'])
-            gx = R * np.cos(phi_gps) * np.cos(theta_gps)
-            gy = R * np.cos(phi_gps) * np.sin(theta_gps)
-            gz = R * np.sin(phi_gps)
-            
-            dists, idxs = tree.query(np.column_stack((gx, gy, gz)), k=1, distance_upper_bound=radius)
-            valid = idxs < len(unique_nodes)
-            df['node_id'] = -1
-            df.loc[valid, 'node_id'] = np.array([idx_to_label[i] for i in idxs[valid]])
-            
-            df = df.sort_values(['anonymized_vehicle', 'datetime'])
-            
-            hourly_data = {} 
-            agg_store = {} 
-
-            for vid, group in df.groupby('anonymized_vehicle'):
-                vid_str = str(vid)
-                node_ids = group['node_id'].values
-                times = group['datetime'].values
-                
-                last_node = -1
-                departure_time = None
-                
-                for i in range(len(node_ids)):
-                    curr_node = node_ids[i]
-                    curr_time = times[i]
-                    
-                    if curr_node != -1:
-                        if last_node != -1 and last_node != curr_node:
-                            if departure_time is not None:
-                                travel_time = (curr_time - departure_time) / np.timedelta64(1, 's')
-                                if min_time < travel_time < max_time:
-                                    dt_obj = pd.to_datetime(departure_time)
-                                    h = str(dt_obj.hour)
-                                    
-                                    if h not in hourly_data: hourly_data[h] = {"vehicles": {}, "aggregated": []}
-                                    if h not in agg_store: agg_store[h] = {}
-
-                                    # Lấy tọa độ để tính vận tốc
-                                    # Ép kiểu int() cho last_node, curr_node khi truy cập dict
-                                    u_info = nodes_meta[int(last_node)]
-                                    v_info = nodes_meta[int(curr_node)]
-                                    
-                                    dist_m = haversine_np(u_info['lng'], u_info['lat'], v_info['lng'], v_info['lat'])
-                                    speed_kmh = (dist_m / 1000) / (travel_time / 3600)
-                                    
-                                    # --- KHU VỰC SỬA LỖI ---
-                                    # Ép kiểu thủ công về int/float python thuần
-                                    edge_obj = {
-                                        "f": int(last_node),    # int64 -> int
-                                        "t": int(curr_node),    # int64 -> int
-                                        "tm": round(float(travel_time), 1),
-                                        "s": round(float(speed_kmh), 1)
-                                    }
-                                    
-                                    if vid_str not in hourly_data[h]["vehicles"]: 
-                                        hourly_data[h]["vehicles"][vid_str] = []
-                                    hourly_data[h]["vehicles"][vid_str].append(edge_obj)
-                                    
-                                    # Key dictionary cũng phải là kiểu chuẩn (tuple of ints)
-                                    ek = (int(last_node), int(curr_node))
-                                    if ek not in agg_store[h]: agg_store[h][ek] = []
-                                    agg_store[h][ek].append(speed_kmh)
-
-                        if curr_node != last_node: last_node = curr_node
-                        departure_time = curr_time
-
-            # Save Chunks
-            available_hours = []
-            
-            for h, data_h in hourly_data.items():
-                aggs = []
-                if h in agg_store:
-                    for (u, v), speeds in agg_store[h].items():
-                        avg_s = np.mean(speeds)
-                        # u, v đã được ép kiểu int ở trên
-                        u_info = nodes_meta[u]
-                        v_info = nodes_meta[v]
-                        dist_m = haversine_np(u_info['lng'], u_info['lat'], v_info['lng'], v_info['lat'])
-                        avg_t = (dist_m / 1000) / (avg_s / 3600) if avg_s > 0 else 0
-                        
-                        aggs.append({
-                            "f": int(u),
-                            "t": int(v),
-                            "s": round(float(avg_s), 1),
-                            "tm": round(float(avg_t), 1),
-                            "c": int(len(speeds))
-                        })
-                
-                chunk_filename = f"{date_key}_{h}.json"
-                with open(os.path.join(OUTPUT_DIR, chunk_filename), 'w') as f:
-                    # Dùng NpEncoder để an toàn tuyệt đối
-                    json.dump({"agg": aggs, "veh": data_h["vehicles"]}, f, cls=NpEncoder)
-                
-                available_hours.append(int(h))
+        date_files.setdefault(match.group(1), []).append(file_path)
+
+    def save_state():
+        # index.json + manifest được ghi nguyên tử sau mỗi ngày -> chạy lại tiếp được khi crash
+        write_json_atomic(os.path.join(OUTPUT_DIR, 'index.json'), dict(sorted(index_data.items())))
+        write_json_atomic(manifest_path, manifest)
+
+    # Ngày không còn file nguồn -> xóa mảnh cũ
+    for date_key in [d for d in manifest["dates"] if d not in date_files]:
+        _remove_chunks(date_key, manifest["dates"].pop(date_key).get("hours", []))
+        chunkStore.remove_vehicle_index(OUTPUT_DIR, date_key)
+        index_data.pop(date_key, None)
+        print(f"   -> Xóa: {date_key} (không còn file GPS)")
+
+    # Chỉ xử lý ngày mới hoặc có file thay đổi
+    pending = {}
+    for date_key, files in date_files.items():
+        old = manifest["dates"].get(date_key)
+        if old is not None and set(old["files"]) == {os.path.basename(p) for p in files} \
+                and all(_same_file(p, old["files"][os.path.basename(p)]) for p in files):
+            continue
+        pending[date_key] = files
+    save_state()
 
+    print(f"2. Đang xử lý {len(pending)}/{len(date_files)} ngày thay đổi (workers={workers})...")
+
+    def collect(date_key, results):
+        ok = True
+        new_hours = set()
+        for file_path, available_hours, error in results:
+            if error is not None:
+                ok = False
+                print(f"⚠️ Lỗi file {os.path.basename(file_path)}: {error}")
+                continue
             if available_hours:
-                index_data[date_key] = sorted(available_hours)
+                new_hours.update(available_hours)
                 print(f"   -> OK: {date_key} ({len(available_hours)} khung giờ)")
+        if not ok:
+            # Ngày lỗi không vào manifest và giữ nguyên index.json cũ -> không phục vụ ngày dở,
+            # lần chạy sau thử lại
+            save_state()
+            return
+        old = manifest["dates"].get(date_key)
+        if old is not None:
+            _remove_chunks(date_key, set(old.get("hours", [])) - new_hours)
+        if new_hours:
+            # Hợp các giờ của mọi file trong ngày (khớp manifest và chỉ mục xe)
+            index_data[date_key] = sorted(new_hours)
+        else:
+            index_data.pop(date_key, None)
+        manifest["dates"][date_key] = {
+            "files": {os.path.basename(p): file_fingerprint(p) for p in date_files[date_key]},
+            "hours": sorted(new_hours)
+        }
+        save_state()
 
-        except Exception as e:
-            print(f"⚠️ Lỗi file {filename}: {e}")
-            import traceback
-            traceback.print_exc()
-
-    with open(os.path.join(OUTPUT_DIR, 'index.json'), 'w') as f:
-        json.dump(index_data, f, cls=NpEncoder)
-    
-    print(f"✔ HOÀN TẤT! Dữ liệu: {OUTPUT_DIR}")
\ No newline at end of file
+    if workers > 1 and len(pending) > 1:
+        # KDTree + bảng node được dựng một lần và chuyển cho worker qua initializer
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(ctx,)) as pool:
+            futures = {
+                pool.submit(_process_date, date_key, files, None, opts): date_key
+                for date_key, files in pending.items()
+            }
+            for fut in as_completed(futures):
+                date_key = futures[fut]
+                try:
+                    collect(date_key, fut.result())
+                except Exception as e:
+                    print(f"⚠️ Lỗi ngày {date_key}: {e}")
+    else:
+        # Ngày trước chỉ được chốt (index.json / manifest) sau khi ngày sau đã khớp xong,
+        # để luồng ghi nền có việc chạy song song với đọc + map-matching
+        ctx = {**ctx, "writer": ShardWriter()}
+        previous = None
+        try:
+            for date_key, files in pending.items():
+                results = _process_date(date_key, files, ctx, opts, wait=False)
+                if previous is not None:
+                    collect(previous[0], _wait_writes(previous[1], ctx))
+                previous = (date_key, results)
+            if previous is not None:
+                collect(previous[0], _wait_writes(previous[1], ctx))
+        finally:
+            ctx["writer"].close()
+
+    save_state()
+    tripStore.close(tripStore.db_path(OUTPUT_DIR))
+    run_stage.done(files=len(gps_files), dates=len(date_files), dates_processed=len(pending), workers=workers)
+    print(f"✔ HOÀN TẤT! Dữ liệu: {OUTPUT_DIR}")
@@ -0,0 +1,226 @@
+import os
+import glob
+import json
+import shutil
+import numpy as np
+import matplotlib.pyplot as plt
+import gpsLoader
+from genTiles import mercator
+
+# --- CẤU HÌNH ---
+GPS_FOLDER = 'raw_GPS'
+OUTPUT_DIR = 'heatmap'
+GRID_FILE = 'density.npz'
+META_FILE = 'heatmap.json'
+BBOX = (10.60, 106.50, 11.00, 106.90)  # (lat_min, lng_min, lat_max, lng_max); điểm ngoài khung bị bỏ
+BASE_ZOOM = 14       # 1 ô lưới = 1 pixel của tile ở zoom này (~9.5 m tại TP.HCM)
+MIN_ZOOM = 10        # zoom nhỏ nhất có tile
+TILE_SIZE = 256
+CHUNK_ROWS = 1_000_000
+COLORMAP = 'inferno'
+VMAX_PERCENTILE = 99.5  # mức bão hòa màu (phân vị của các ô khác 0 ở mỗi zoom)
+HOURS = 24
+
+# Bản đồ mật độ GPS dạng raster thay cho scatter từng điểm: lưới đếm cố định
+# (uint32, kích thước chỉ phụ thuộc BBOX và BASE_ZOOM) căn theo pixel Web Mercator
+# của BASE_ZOOM, đọc từng chunk raw_GPS rồi cộng dồn -> bộ nhớ không đổi dù có bao
+# nhiêu tỷ điểm. Với per_hour=True lưới có thêm trục giờ (24 lớp, tốn gấp 24 lần ->
+# nên hạ base_zoom, vd. 12). Zoom nhỏ hơn có được bằng cách cộng khối 2×2 liên tiếp.
+# Kết quả:
+#   heatmap/density.npz           : lưới đếm + tọa độ gốc, dựng lại tile không cần đọc GPS
+#   heatmap/all/{z}/{x}/{y}.png   : tile XYZ (bỏ tile rỗng), dùng với L.tileLayer
+#   heatmap/{h}/{z}/{x}/{y}.png   : tile theo giờ (per_hour=True)
+#   heatmap/overview.png          : ảnh toàn khung (zoom lớn nhất có cạnh <= 2048 px)
+#   heatmap/heatmap.json          : khung overview, dải zoom, có tile theo giờ không (genMap đọc)
+
+def pixel_xy(lat, lng, zoom):
+    """Lat/Lng -> pixel Web Mercator toàn cục (số nguyên) ở `zoom`; NaN -> -1."""
+    mx, my = mercator(lat, lng)
+    scale = float(TILE_SIZE << zoom)
+    px, py = np.floor(mx * scale), np.floor(my * scale)
+    bad = ~(np.isfinite(px) & np.isfinite(py))
+    px[bad] = -1
+    py[bad] = -1
+    return px.astype(np.int64), py.astype(np.int64)
+
+class DensityGrid:
+    """Lưới đếm điểm GPS theo pixel Web Mercator ở một zoom (tùy chọn thêm trục giờ)."""
+
+    def __init__(self, counts, zoom, x0, y0):
+        self.counts = counts   # [lớp, H, W]; lớp = giờ khi per_hour, ngược lại 1 lớp
+        self.zoom = int(zoom)
+        self.x0, self.y0 = int(x0), int(y0)   # pixel toàn cục của ô [0, 0]
+
+    @classmethod
+    def empty(cls, bbox=BBOX, zoom=BASE_ZOOM, per_hour=False):
+        lat_min, lng_min, lat_max, lng_max = bbox
+        x_lo, y_hi = pixel_xy([lat_min], [lng_min], zoom)
+        x_hi, y_lo = pixel_xy([lat_max], [lng_max], zoom)
+        # Căn theo biên tile của zoom gốc để cắt tile không cần dịch
+        x0, y0 = int(x_lo[0]) // TILE_SIZE * TILE_SIZE, int(y_lo[0]) // TILE_SIZE * TILE_SIZE
+        width = (int(x_hi[0]) // TILE_SIZE + 1) * TILE_SIZE - x0
+        height = (int(y_hi[0]) // TILE_SIZE + 1) * TILE_SIZE - y0
+        layers = HOURS if per_hour else 1
+        return cls(np.zeros((layers, height, width), dtype=np.uint32), zoom, x0, y0)
+
+    @property
+    def per_hour(self):
+        return self.counts.shape[0] == HOURS
+
+    def add(self, lat, lng, hours=None):
+        """Cộng dồn một lô điểm; trả về số điểm nằm trong khung."""
+        _, height, width = self.counts.shape
+        px, py = pixel_xy(lat, lng, self.zoom)
+        ix, iy = px - self.x0, py - self.y0
+        inside = (ix >= 0) & (ix < width) & (iy >= 0) & (iy < height)
+        if self.per_hour:
+            hours = np.asarray(hours, dtype=np.float64)
+            inside &= np.isfinite(hours)   # NaT -> bỏ
+        flat = iy[inside] * width + ix[inside]
+        if self.per_hour:
+            flat += hours[inside].astype(np.int64) * (height * width)
+        # np.unique trên lô (không phải bincount cỡ cả lưới) -> chi phí theo số điểm
+        cells, n = np.unique(flat, return_counts=True)
+        self.counts.reshape(-1)[cells] += n.astype(np.uint32)
+        return int(inside.sum())
+
+    def layer(self, h=None):
+        """Lưới [H, W] của giờ h (None = mọi giờ)."""
+        if h is None:
+            return self.counts.sum(axis=0, dtype=np.uint64) if self.per_hour else self.counts[0]
+        return self.counts[h]
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, counts=self.counts, zoom=self.zoom, x0=self.x0, y0=self.y0)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['counts'], int(data['zoom']), int(data['x0']), int(data['y0']))
+
+def downsample(grid, x0, y0):
+    """Lưới ở zoom z (gốc pixel x0, y0) -> zoom z - 1 bằng cách cộng khối 2×2."""
+    top, left = y0 % 2, x0 % 2
+    grid = np.pad(grid, ((top, (top + grid.shape[0]) % 2), (left, (left + grid.shape[1]) % 2)))
+    height, width = grid.shape
+    return grid.reshape(height // 2, 2, width // 2, 2).sum(axis=(1, 3), dtype=np.uint64), x0 // 2, y0 // 2
+
+def pyramid(grid, zoom, x0, y0, min_zoom=MIN_ZOOM):
+    """Sinh (zoom, lưới, x0, y0) từ zoom gốc xuống min_zoom."""
+    while True:
+        yield zoom, grid, x0, y0
+        if zoom <= min_zoom:
+            return
+        grid, x0, y0 = downsample(grid, x0, y0)
+        zoom -= 1
+
+def colorize(counts, vmax, cmap=COLORMAP):
+    """Số điểm -> ảnh RGBA (thang log, ô rỗng trong suốt)."""
+    intensity = np.clip(np.log1p(counts) / np.log1p(max(vmax, 1)), 0, 1)
+    rgba = plt.get_cmap(cmap)(intensity)
+    rgba[..., 3] = np.where(counts > 0, 0.35 + 0.65 * intensity, 0)
+    return rgba
+
+def _vmax(grid):
+    nonzero = grid[grid > 0]
+    return float(np.percentile(nonzero, VMAX_PERCENTILE)) if len(nonzero) else 1.0
+
+def _save_png(path, rgba):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        plt.imsave(f, rgba, format='png')
+    os.replace(tmp_path, path)
+
+def write_tiles(grid, zoom, x0, y0, out_dir, min_zoom=MIN_ZOOM):
+    """Ghi tile XYZ {z}/{x}/{y}.png cho mọi zoom [min_zoom, zoom]; trả về số tile đã ghi."""
+    written = 0
+    for z, level, lx0, ly0 in pyramid(grid, zoom, x0, y0, min_zoom):
+        vmax = _vmax(level)
+        height, width = level.shape
+        for ty in range(ly0 // TILE_SIZE, (ly0 + height - 1) // TILE_SIZE + 1):
+            for tx in range(lx0 // TILE_SIZE, (lx0 + width - 1) // TILE_SIZE + 1):
+                # Ô tile (tx, ty) trong tọa độ lưới; phần nằm ngoài lưới để trống
+                top, left = ty * TILE_SIZE - ly0, tx * TILE_SIZE - lx0
+                tile = np.zeros((TILE_SIZE, TILE_SIZE), dtype=level.dtype)
+                part = level[max(top, 0):top + TILE_SIZE, max(left, 0):left + TILE_SIZE]
+                tile[max(-top, 0):max(-top, 0) + part.shape[0], max(-left, 0):max(-left, 0) + part.shape[1]] = part
+                if not tile.any():
+                    continue
+                _save_png(os.path.join(out_dir, str(z), str(tx), f"{ty}.png"), colorize(tile, vmax))
+                written += 1
+    return written
+
+def write_overview(grid, zoom, x0, y0, path, max_size=2048):
+    """Ảnh toàn khung ở zoom lớn nhất có cạnh <= max_size; trả về (lat_min, lng_min, lat_max, lng_max)."""
+    for z, level, lx0, ly0 in pyramid(grid, zoom, x0, y0, min_zoom=0):
+        if max(level.shape) <= max_size:
+            break
+    _save_png(path, colorize(level, _vmax(level)))
+    return pixel_bounds(lx0, ly0, level.shape[1], level.shape[0], z)
+
+def pixel_bounds(x0, y0, width, height, zoom):
+    """Khung pixel -> (lat_min, lng_min, lat_max, lng_max)."""
+    scale = float(TILE_SIZE << zoom)
+    lng = np.array([x0, x0 + width]) / scale * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.array([y0 + height, y0]) / scale))))
+    return float(lat[0]), float(lng[0]), float(lat[1]), float(lng[1])
+
+def render(grid, out_dir=OUTPUT_DIR, min_zoom=MIN_ZOOM):
+    """Ghi lại toàn bộ tile (all/ và từng giờ) + overview.png từ một DensityGrid."""
+    layers = [('all', None)] + ([(str(h), h) for h in range(HOURS)] if grid.per_hour else [])
+    total = 0
+    for name, h in layers:
+        layer_dir = os.path.join(out_dir, name)
+        if os.path.exists(layer_dir):
+            shutil.rmtree(layer_dir)
+        total += write_tiles(grid.layer(h), grid.zoom, grid.x0, grid.y0, layer_dir, min_zoom)
+    bounds = write_overview(grid.layer(), grid.zoom, grid.x0, grid.y0, os.path.join(out_dir, 'overview.png'))
+    meta = {"bounds": bounds, "min_zoom": int(min_zoom), "max_zoom": grid.zoom, "per_hour": grid.per_hour}
+    meta_path = os.path.join(out_dir, META_FILE)
+    tmp_path = f"{meta_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+    print(f"🖼️ Đã ghi {total} tile (zoom {min_zoom}-{grid.zoom}) + overview.png -> {out_dir}")
+    return meta
+
+def build_heatmap(gps_folder=GPS_FOLDER, out_dir=OUTPUT_DIR, bbox=BBOX, base_zoom=BASE_ZOOM, min_zoom=MIN_ZOOM,
+                  per_hour=False, chunk_rows=CHUNK_ROWS):
+    """Đọc lần lượt mọi file GPS theo chunk, cộng vào lưới mật độ rồi ghi tile PNG.
+
+    Bộ nhớ = lưới cố định + một chunk, không phụ thuộc tổng số điểm.
+    Trả về DensityGrid (đã lưu vào out_dir/density.npz).
+    """
+    grid = DensityGrid.empty(bbox, base_zoom, per_hour)
+    layers, height, width = grid.counts.shape
+    print(f"🔥 Lưới mật độ {width}×{height} (zoom {base_zoom}, {layers} lớp, "
+          f"{grid.counts.nbytes / 2**20:.0f} MB)")
+    gps_files = sorted(glob.glob(os.path.join(gps_folder, "*.csv")))
+    total = inside = 0
+    for i, gps_file in enumerate(gps_files):
+        print(f"   [{i + 1}/{len(gps_files)}] {os.path.basename(gps_file)}")
+        for df in gpsLoader.iter_gps_chunks(gps_file, chunk_rows):
+            hours = df['datetime'].dt.hour.values if per_hour else None
+            inside += grid.add(df['lat'].values, df['lng'].values, hours)
+            total += len(df)
+    print(f"   -> {inside:,}/{total:,} điểm nằm trong khung")
+
+    os.makedirs(out_dir, exist_ok=True)
+    grid.save(os.path.join(out_dir, GRID_FILE))
+    render(grid, out_dir, min_zoom)
+    return grid
+
+def load_meta(out_dir=OUTPUT_DIR):
+    """heatmap.json của lần render gần nhất (None nếu chưa dựng heatmap)."""
+    path = os.path.join(out_dir, META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+if __name__ == "__main__":
+    build_heatmap()
@@ -2,9 +2,21 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import json
 import os
+import genHeatmap
 
 # Define file path
 file_path = 'grouped_stops_nested.csv'
+heatmap_dir = genHeatmap.OUTPUT_DIR
+
+def join_unique(df, key, col, sep):
+    """Sorted unique stripped values of `col` per `key`, joined with `sep` (NaN skipped).
+
+    Vectorized: dedupe + sort the whole column once, then a single groupby join
+    instead of a Python lambda over every group.
+    """
+    values = df[[key, col]].dropna(subset=[col])
+    values = values.assign(**{col: values[col].astype(str).str.strip()}).drop_duplicates()
+    return values.sort_values([key, col]).groupby(key)[col].agg(sep.join)
 
 # Check if file exists
 if not os.path.exists(file_path):
@@ -19,18 +31,24 @@ else:
         # We join unique Names, RouteIds, and Codes for the popup info
         nodes_df = df.groupby('cluster_label').agg({
             'centroid_lat': 'first',
-            'centroid_lng': 'first',
-            'Name': lambda x: ' | '.join(sorted(list(set(str(val).strip() for val in x if pd.notna(val))))),
-            'RouteId': lambda x: ', '.join(sorted(list(set(str(val).strip() for val in x if pd.notna(val))))),
-            'Code': lambda x: ', '.join(sorted(list(set(str(val).strip() for val in x if pd.notna(val)))))
-        }).reset_index()
+            'centroid_lng': 'first'
+        })
+        for col, sep in (('Name', ' | '), ('RouteId', ', '), ('Code', ', ')):
+            nodes_df[col] = join_unique(df, 'cluster_label', col, sep).reindex(nodes_df.index, fill_value='')
+        nodes_df = nodes_df.reset_index()
         
         print(f"Processed {len(df)} rows into {len(nodes_df)} unique nodes.")
         
         # --- 1. Create Static Map (Matplotlib) ---
+        # GPS density raster (genHeatmap) as background instead of plotting raw points
         plt.figure(figsize=(12, 10))
+        heatmap_meta = genHeatmap.load_meta(heatmap_dir)
+        if heatmap_meta:
+            lat_min, lng_min, lat_max, lng_max = heatmap_meta['bounds']
+            plt.imshow(plt.imread(os.path.join(heatmap_dir, 'overview.png')),
+                       extent=(lng_min, lng_max, lat_min, lat_max), aspect='auto', zorder=0)
         plt.scatter(nodes_df['centroid_lng'], nodes_df['centroid_lat'], 
-                    c='red', s=40, alpha=0.7, edgecolors='black', linewidth=0.5)
+                    c='red', s=40, alpha=0.7, edgecolors='black', linewidth=0.5, zorder=1)
         plt.title('Mạng lưới Trạm dừng Xe buýt (Bus Network Nodes)')
         plt.xlabel('Longitude')
         plt.ylabel('Latitude')
@@ -42,17 +60,24 @@ else:
         
         # --- 2. Create Interactive Map (Leaflet HTML) ---
         # Prepare data for JSON injection
-        map_nodes = []
-        for _, row in nodes_df.iterrows():
-            map_nodes.append({
-                'id': str(row['cluster_label']),
-                'lat': row['centroid_lat'],
-                'lng': row['centroid_lng'],
-                'name': row['Name'],
-                'routes': row['RouteId'],
-                'codes': row['Code']
-            })
+        map_nodes = pd.DataFrame({
+            'id': nodes_df['cluster_label'].astype(str),
+            'lat': nodes_df['centroid_lat'],
+            'lng': nodes_df['centroid_lng'],
+            'name': nodes_df['Name'],
+            'routes': nodes_df['RouteId'],
+            'codes': nodes_df['Code']
+        }).to_dict('records')
             
+        # GPS density tiles (genHeatmap) as an overlay layer, if they have been built
+        heatmap_layer = ''
+        if heatmap_meta:
+            heatmap_layer = (
+                f"\n\n        L.tileLayer('{heatmap_dir}/all/{{z}}/{{x}}/{{y}}.png', "
+                f"{{minNativeZoom: {heatmap_meta['min_zoom']}, maxNativeZoom: {heatmap_meta['max_zoom']}, "
+                f"opacity: 0.8}}).addTo(map);"
+            )
+        
         # Calculate map center
         center_lat = nodes_df['centroid_lat'].mean()
         center_lng = nodes_df['centroid_lng'].mean()
@@ -87,7 +112,7 @@ else:
 
         L.tileLayer('https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
             attribution: '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
-        }}).addTo(map);
+        }}).addTo(map);{heatmap_layer}
 
         var nodes = {json.dumps(map_nodes)};
 
@@ -1,100 +1,217 @@
-import pandas as pd
+import os
+import glob
+import heapq
 import numpy as np
+import pandas as pd
 import networkx as nx
-from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+import gpsLoader
+from nodeIndex import NodeIndex
+from genFullMap import extract_transitions
+
+# --- CẤU HÌNH ---
+GRAPH_FILE = 'travel_time_graph.npz'
+HOURS = 24
+MAX_TRAVEL_TIME = 7200 # lọc nhiễu (chuyến đi < 2 tiếng)
+MIN_TRIPS = 1          # giờ có ít chuyến hơn trên một cạnh -> dùng trung bình cả ngày
+
+# Đồ thị thời gian di chuyển phụ thuộc giờ: mọi giờ dùng chung một cấu trúc CSR
+# (indptr, indices) gồm các cạnh từng thấy, trọng số là ma trận weight[HOURS + 1, nnz]
+# (giây, dòng HOURS = trung bình mọi giờ), trips đếm số chuyến tương ứng (0 = giờ đó
+# không có chuyến, weight lấy từ trung bình cả ngày). Lưu bằng np.savez nên nạp lại
+# chỉ là đọc vài mảng.
 
+def file_transitions(index, gps_file, radius, max_time=MAX_TRAVEL_TIME):
+    """Map-matching một file GPS rồi tách chuyến trạm -> trạm (giống vòng lặp iterrows cũ)."""
+    gps_df = gpsLoader.load_gps(gps_file)
+    # Chỉ lấy điểm nằm trong bán kính quy định, -1 nghĩa là đang đi trên đường
+    gps_df['node_id'] = index.match(gps_df['lat'].values, gps_df['lng'].values, radius)
+    gps_df = gps_df.drop(columns=['lat', 'lng']) # không cần sau khi khớp -> bớt bộ nhớ khi sắp xếp
+    valid = int((gps_df['node_id'].values != -1).sum())
+    print(f"   -> Tỷ lệ map thành công: {valid}/{len(gps_df)} điểm GPS.")
 
+    df = gps_df[gps_df['anonymized_vehicle'].notna()].sort_values(['anonymized_vehicle', 'datetime'])
+    veh_codes, _ = pd.factorize(df['anonymized_vehicle'], sort=False)
+    return extract_transitions(veh_codes, df['node_id'].values, df['datetime'].values, 0, max_time)
+
+def _sum_by_key(keys, values, counts=None):
+    """Cộng theo khóa -> (khóa tăng dần, tổng values, tổng counts; counts=None nghĩa là đếm)."""
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if counts is None:
+        counts = np.ones(len(keys))
+    return uniq, np.bincount(inverse, values, len(uniq)), np.bincount(inverse, counts, len(uniq)).astype(np.int64)
 
 def build_graph_with_unified_radius(nodes_file, gps_file, output_file='traffic_graph.gexf', UNIFIED_RADIUS=200):
     print(f"--- BẮT ĐẦU QUY TRÌNH VỚI BÁN KÍNH: {UNIFIED_RADIUS} MÉT ---")
 
     # 1. Load dữ liệu Node (Cluster)
     # Đây là kết quả của bước gom nhóm trước đó (cũng dùng UNIFIED_RADIUS)
-    nodes_df = pd.read_csv(nodes_file)
-    
-    # Lấy tọa độ trung tâm của các Node
-    unique_nodes = nodes_df.groupby('cluster_label').agg({
-        'centroid_lat': 'first',
-        'centroid_lng': 'first'
-    }).reset_index()
-    
-    print(f"1. Đã load {len(unique_nodes)} node (Cluster).")
-
-    # 2. Xây dựng KDTree (Spatial Indexing)
-    # Chuyển đổi Lat/Lng sang hệ tọa độ Descartes (X, Y, Z) để tính khoảng cách mét chính xác
-    R = 6371000 # Bán kính Trái Đất (m)
-    phi = np.radians(unique_nodes['centroid_lat'])
-    theta = np.radians(unique_nodes['centroid_lng'])
-    
-    unique_nodes['x'] = R * np.cos(phi) * np.cos(theta)
-    unique_nodes['y'] = R * np.cos(phi) * np.sin(theta)
-    unique_nodes['z'] = R * np.sin(phi)
-    
-    # Tạo cây tìm kiếm không gian
-    tree = cKDTree(unique_nodes[['x', 'y', 'z']].values)
-    
+    # 2. KDTree (Spatial Indexing) trên tọa độ Descartes (X, Y, Z): dựng một lần,
+    # lưu cache trên đĩa theo sha1 của file node và dùng chung với genFullMap
+    index = NodeIndex.load(nodes_file)
+
+    print(f"1. Đã load {len(index)} node (Cluster).")
+
     # 3. Xử lý dữ liệu GPS
     print("2. Đang xử lý dữ liệu GPS...")
-    gps_df = pd.read_csv(gps_file)
-    gps_df['datetime'] = pd.to_datetime(gps_df['datetime'])
-    
-    # Chuyển đổi tọa độ GPS sang Descartes
-    phi_gps = np.radians(gps_df['lat'])
-    theta_gps = np.radians(gps_df['lng'])
-    gps_x = R * np.cos(phi_gps) * np.cos(theta_gps)
-    gps_y = R * np.cos(phi_gps) * np.sin(theta_gps)
-    gps_z = R * np.sin(phi_gps)
-    gps_coords = np.column_stack((gps_x, gps_y, gps_z))
-    
-    # --- QUAN TRỌNG: Map Matching dùng UNIFIED_RADIUS ---
-    # distance_upper_bound đảm bảo chỉ lấy điểm nằm trong bán kính quy định
-    dists, idxs = tree.query(gps_coords, k=1, distance_upper_bound=UNIFIED_RADIUS)
-    
-    # Gán Node ID cho các điểm GPS hợp lệ
-    gps_df['node_id'] = -1 # -1 nghĩa là đang đi trên đường
-    valid_mask = idxs < len(unique_nodes) # Chỉ lấy các index hợp lệ
-    
-    # Map từ index của KDTree sang Cluster Label thực tế
-    idx_to_label = unique_nodes['cluster_label'].to_dict()
-    gps_df.loc[valid_mask, 'node_id'] = gps_df.loc[valid_mask, 'nearest_node_idx'].map(idx_to_label) if 'nearest_node_idx' in gps_df else [idx_to_label[i] for i in idxs[valid_mask]]
-
-    print(f"   -> Tỷ lệ map thành công: {valid_mask.sum()}/{len(gps_df)} điểm GPS.")
-
     # 4. Tính toán cạnh (Edges) và Thời gian di chuyển
     # Logic: Nếu xe chuyển từ Node A (node_id X) sang Node B (node_id Y) -> Tạo cạnh X->Y
-    G = nx.DiGraph()
-    edge_times = {} # Lưu danh sách thời gian di chuyển
-
-    sorted_gps = gps_df.sort_values(['anonymized_vehicle', 'datetime'])
-    
-    for vid, group in sorted_gps.groupby('anonymized_vehicle'):
-        last_node = -1
-        departure_time = None
-        
-        for _, row in group.iterrows():
-            curr_node = row['node_id']
-            curr_time = row['datetime']
-            
-            if curr_node != -1: # Xe đang ở tại trạm
-                # Nếu trước đó xe ở trạm khác -> Hoàn thành chuyến đi
-                if last_node != -1 and last_node != curr_node:
-                    travel_time = (curr_time - departure_time).total_seconds()
-                    if 0 < travel_time < 7200: # Lọc nhiễu (chuyến đi < 2 tiếng)
-                        edge = (last_node, curr_node)
-                        if edge not in edge_times: edge_times[edge] = []
-                        edge_times[edge].append(travel_time)
-                
-                # Cập nhật trạng thái
-                if curr_node != last_node:
-                    last_node = curr_node
-                departure_time = curr_time # Cập nhật thời điểm cuối cùng thấy xe ở trạm này
-    
+    trans = file_transitions(index, gps_file, UNIFIED_RADIUS)
+    n = len(index.node_lat)
+    keys, sums, counts = _sum_by_key(trans['f'] * n + trans['t'], trans['tm'])
+
     # 5. Tổng hợp đồ thị
-    for (u, v), times in edge_times.items():
-        G.add_edge(u, v, weight=np.mean(times), trips=len(times))
-        
+    G = nx.DiGraph()
+    G.add_edges_from(
+        (u, v, {"weight": w, "trips": c})
+        for u, v, w, c in zip((keys // n).tolist(), (keys % n).tolist(), (sums / counts).tolist(), counts.tolist())
+    )
+
     print(f"3. Hoàn tất! Đồ thị có {G.number_of_nodes()} node và {G.number_of_edges()} cạnh.")
     nx.write_gexf(G, output_file)
 
+class TravelTimeGraph:
+    """Đồ thị thời gian di chuyển theo giờ khởi hành (CSR dùng chung, trọng số theo giờ)."""
+
+    def __init__(self, indptr, indices, weight, trips):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weight = np.asarray(weight, dtype=np.float64)
+        self.trips = np.asarray(trips, dtype=np.int64)
+        self.n_nodes = len(self.indptr) - 1
+
+    @classmethod
+    def from_sums(cls, n_nodes, hour, f, t, sums, counts, min_trips=MIN_TRIPS):
+        """Tổng thời gian / số chuyến theo (giờ, from, to) -> đồ thị."""
+        edge = f * n_nodes + t
+        keys, edge_inv = np.unique(edge, return_inverse=True)
+        edge_inv = edge_inv.reshape(-1)
+        nnz = len(keys)
+        # Cạnh sắp theo (from, to) nên keys chính là thứ tự CSR
+        rows = keys // n_nodes
+        indptr = np.searchsorted(rows, np.arange(n_nodes + 1)).astype(np.int64)
+
+        sum_h = np.zeros((HOURS + 1, nnz))
+        trips = np.zeros((HOURS + 1, nnz), dtype=np.int64)
+        np.add.at(sum_h, (hour, edge_inv), sums)
+        np.add.at(trips, (hour, edge_inv), counts)
+        sum_h[HOURS] = sum_h[:HOURS].sum(axis=0)
+        trips[HOURS] = trips[:HOURS].sum(axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = sum_h / trips
+        sparse_hours = trips[:HOURS] < min_trips
+        weight[:HOURS][sparse_hours] = np.broadcast_to(weight[HOURS], (HOURS, nnz))[sparse_hours]
+        return cls(indptr, keys % n_nodes, weight, trips)
+
+    @classmethod
+    def load(cls, path=GRAPH_FILE):
+        with np.load(path) as data:
+            return cls(data['indptr'], data['indices'], data['weight'], data['trips'])
+
+    def save(self, path=GRAPH_FILE):
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, indptr=self.indptr, indices=self.indices, weight=self.weight, trips=self.trips)
+        os.replace(tmp_path, path)
+
+    def matrix(self, hour=None):
+        """Ma trận CSR thời gian di chuyển (giây) của giờ `hour` (None = trung bình mọi giờ)."""
+        layer = HOURS if hour is None else int(hour) % HOURS
+        return csr_matrix((self.weight[layer], self.indices, self.indptr), shape=(self.n_nodes, self.n_nodes))
+
+    def travel_times(self, source, hour=None):
+        """Thời gian ngắn nhất (giây) từ `source` tới mọi node với trọng số của một giờ (inf nếu không tới được)."""
+        return dijkstra(self.matrix(hour), indices=source)
+
+    def shortest_path(self, source, target, hour=None, time_dependent=False):
+        """Đường đi nhanh nhất source -> target khi khởi hành lúc `hour` (có thể lẻ, vd. 7.5).
+
+        Mặc định dùng trọng số cố định của giờ khởi hành (scipy csgraph). Với
+        time_dependent=True mỗi cạnh lấy trọng số của giờ xe đến đầu cạnh đó.
+        Trả về (số giây, danh sách node), (inf, []) nếu không có đường.
+        """
+        if time_dependent and hour is not None:
+            return self._time_dependent_path(source, target, float(hour))
+        dist, pred = dijkstra(self.matrix(hour), indices=source, return_predecessors=True)
+        if not np.isfinite(dist[target]):
+            return float('inf'), []
+        path = [target]
+        while path[-1] != source:
+            path.append(int(pred[path[-1]]))
+        return float(dist[target]), path[::-1]
+
+    def _time_dependent_path(self, source, target, hour):
+        start = hour * 3600
+        best = {source: start}
+        prev = {}
+        heap = [(start, source)]
+        while heap:
+            t, u = heapq.heappop(heap)
+            if u == target:
+                path = [target]
+                while path[-1] != source:
+                    path.append(prev[path[-1]])
+                return t - start, path[::-1]
+            if t > best[u]:
+                continue
+            layer = int(t // 3600) % HOURS
+            lo, hi = self.indptr[u], self.indptr[u + 1]
+            for v, w in zip(self.indices[lo:hi].tolist(), self.weight[layer, lo:hi].tolist()):
+                arrival = t + w
+                if arrival < best.get(v, np.inf):
+                    best[v] = arrival
+                    prev[v] = u
+                    heapq.heappush(heap, (arrival, v))
+        return float('inf'), []
+
+    def to_networkx(self, hour=None):
+        """DiGraph (weight = giây, trips) của một giờ, như đồ thị GEXF cũ."""
+        layer = HOURS if hour is None else int(hour) % HOURS
+        rows = np.repeat(np.arange(self.n_nodes), np.diff(self.indptr))
+        G = nx.DiGraph()
+        G.add_edges_from(
+            (u, v, {"weight": w, "trips": c})
+            for u, v, w, c in zip(rows.tolist(), self.indices.tolist(), self.weight[layer].tolist(),
+                                  self.trips[layer].tolist())
+        )
+        return G
+
+def build_time_graph(nodes_file, gps_folder, radius=200, output_file=GRAPH_FILE, max_time=MAX_TRAVEL_TIME,
+                     gexf_file=None):
+    """Dựng đồ thị thời gian di chuyển theo giờ từ mọi file GPS trong `gps_folder` (nhiều ngày).
+
+    Mỗi file chỉ giữ lại tổng thời gian / số chuyến theo (giờ, from, to) nên bộ
+    nhớ không tăng theo số ngày. Ghi `output_file` (.npz) và, nếu có `gexf_file`,
+    thêm bản GEXF của trọng số trung bình mọi giờ.
+    """
+    print(f"--- ĐỒ THỊ THỜI GIAN DI CHUYỂN THEO GIỜ (bán kính {radius} m) ---")
+    index = NodeIndex.load(nodes_file)
+    n = len(index.node_lat)
+    gps_files = sorted(glob.glob(os.path.join(gps_folder, "*.csv")))
+    print(f"1. Đã load {len(index)} node, {len(gps_files)} file GPS.")
+
+    parts = []
+    for i, gps_file in enumerate(gps_files):
+        print(f"2. [{i + 1}/{len(gps_files)}] {os.path.basename(gps_file)}")
+        trans = file_transitions(index, gps_file, radius, max_time)
+        parts.append(_sum_by_key((trans['hour'] * n + trans['f']) * n + trans['t'], trans['tm']))
+
+    if parts:
+        keys, sums, counts = _sum_by_key(*(np.concatenate(c) for c in zip(*parts)))
+    else:
+        keys, sums, counts = np.empty(0, np.int64), np.empty(0), np.empty(0, np.int64)
+    graph = TravelTimeGraph.from_sums(n, keys // (n * n), (keys // n) % n, keys % n, sums, counts)
+    graph.save(output_file)
+    print(f"3. Hoàn tất! {graph.n_nodes} node, {len(graph.indices)} cạnh -> {output_file}")
+    if gexf_file:
+        nx.write_gexf(graph.to_networkx(), gexf_file)
+        print(f"   -> GEXF: {gexf_file}")
+    return graph
+
 # --- SỬ DỤNG ---
-# build_graph_with_unified_radius('grouped_stops_nested.csv', 'gps_data.csv')
\ No newline at end of file
+# build_graph_with_unified_radius('grouped_stops_nested.csv', 'gps_data.csv')
+# g = build_time_graph('grouped_stops_nested.csv', 'raw_GPS')
+# TravelTimeGraph.load().shortest_path(12, 345, hour=7.5)
@@ -0,0 +1,264 @@
+import os
+import json
+import shutil
+import datetime
+import numpy as np
+import chunkStore
+import edgeStats
+
+# --- CẤU HÌNH ---
+INPUT_DIR = 'traffic_data_chunks'
+ROLLUP_DIRNAME = 'rollup'
+BLOCK_COLUMNS = ('from', 'to', 'count', 'sum_speed', 'sum_time')
+ALL_HOURS = tuple(range(24))
+
+# Các loại khối (thư mục con trong rollup/):
+#   hour/{date}_{h}.npz  : một mảnh giờ (khối gốc)
+#   day/{date}.npz       : cả ngày
+#   hod/{h}.npz          : giờ h của mọi ngày (hour-of-day)
+#   how/{w}_{h}.npz      : giờ h của mọi ngày thứ w, 0 = thứ Hai (hour-of-week)
+#   all.npz              : toàn bộ khoảng ngày
+# Mỗi khối lưu tổng theo cạnh (count, sum_speed, sum_time) nên gộp được bằng phép cộng.
+# Nếu mảnh có accumulator `.stats.npz` (edgeStats), khối mang thêm sumsq/min/max và
+# phác thảo phân vị, gộp chính xác bằng edgeStats.merge -> có p50/p85/var cho mọi khoảng.
+
+def empty_block():
+    return {
+        'from': np.empty(0, np.int32), 'to': np.empty(0, np.int32), 'count': np.empty(0, np.int64),
+        'sum_speed': np.empty(0, np.float64), 'sum_time': np.empty(0, np.float64)
+    }
+
+def has_stats(block):
+    return 'sk_ptr' in block
+
+def block_from_agg(agg, stats=None):
+    """Cột agg của một mảnh -> khối tổng. Tổng = trung bình trong mảnh × số lượt.
+
+    stats: accumulator cùng mảnh (cùng thứ tự cạnh với agg) thì lấy tổng tốc độ,
+    tổng thời gian theo chuyến và phác thảo chính xác từ đó. Mảnh cũ chưa có
+    sum_time thì suy ra từ thời gian trung bình của agg (= quãng đường / tốc độ TB).
+    """
+    count = np.asarray(agg['count'], dtype=np.int64)
+    if stats is not None and np.array_equal(stats['from'], agg['from']) and np.array_equal(stats['to'], agg['to']):
+        if 'sum_time' in stats:
+            return stats
+        return {**stats, 'sum_time': np.asarray(agg['time'], dtype=np.float64) * count}
+    return {
+        'from': np.asarray(agg['from'], dtype=np.int32), 'to': np.asarray(agg['to'], dtype=np.int32),
+        'count': count,
+        'sum_speed': np.asarray(agg['speed'], dtype=np.float64) * count,
+        'sum_time': np.asarray(agg['time'], dtype=np.float64) * count,
+    }
+
+def merge_blocks(blocks):
+    """Cộng dồn nhiều khối theo cạnh (from, to); kết quả sắp theo (from, to)."""
+    blocks = [b for b in blocks if len(b['from'])]
+    if not blocks:
+        return empty_block()
+    if all(has_stats(b) for b in blocks):
+        return edgeStats.merge(blocks, extra_sums=('sum_time',))
+    f = np.concatenate([b['from'] for b in blocks]).astype(np.int64)
+    t = np.concatenate([b['to'] for b in blocks]).astype(np.int64)
+    keys, inverse = np.unique((f << 32) | t, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    n = len(keys)
+    return {
+        'from': (keys >> 32).astype(np.int32), 'to': (keys & 0xFFFFFFFF).astype(np.int32),
+        'count': np.bincount(inverse, np.concatenate([b['count'] for b in blocks]), n).astype(np.int64),
+        'sum_speed': np.bincount(inverse, np.concatenate([b['sum_speed'] for b in blocks]), n),
+        'sum_time': np.bincount(inverse, np.concatenate([b['sum_time'] for b in blocks]), n),
+    }
+
+def block_means(block):
+    """Khối tổng -> cột trung bình như agg trong mảnh (speed/time làm tròn 1 chữ số)."""
+    count = block['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = {
+            'from': block['from'], 'to': block['to'], 'count': count,
+            'speed': np.round(block['sum_speed'] / count, 1), 'time': np.round(block['sum_time'] / count, 1),
+        }
+    if has_stats(block):
+        means.update({name: np.round(arr, 1) for name, arr in edgeStats.summary(block).items()})
+    return means
+
+def _rollup_dir(out_dir):
+    return os.path.join(out_dir, ROLLUP_DIRNAME)
+
+def _block_path(out_dir, kind, key=None):
+    if kind == 'all':
+        return os.path.join(_rollup_dir(out_dir), 'all.npz')
+    return os.path.join(_rollup_dir(out_dir), kind, f"{key}.npz")
+
+def write_block(path, block):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **{name: block[name] for name in BLOCK_COLUMNS + edgeStats.STATS_COLUMNS if name in block})
+    os.replace(tmp_path, path)
+
+def read_block(path):
+    if not os.path.exists(path):
+        return empty_block()
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+def weekday(date_key):
+    return datetime.date.fromisoformat(date_key).weekday()
+
+def build_rollups(out_dir=INPUT_DIR, rebuild=False):
+    """Dựng / cập nhật các khối rollup từ các mảnh giờ trong `out_dir`.
+
+    Chạy sau create_sharded_traffic_map. Chỉ đọc lại các mảnh mới hoặc bị ghi
+    lại (so mtime lưu trong rollup/rollup.json), dựng lại khối ngày của các ngày
+    đó; khối how chỉ cộng thêm ngày mới (hoặc cộng lại thứ có ngày bị đổi), hod/all
+    cộng từ các khối how/hod -> chi phí theo số ngày đổi, không theo độ dài lịch sử.
+    """
+    with open(os.path.join(out_dir, 'index.json'), 'r') as f:
+        index_data = json.load(f)
+    root = _rollup_dir(out_dir)
+    state_path = os.path.join(root, 'rollup.json')
+
+    state = None
+    if not rebuild and os.path.exists(state_path):
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except Exception as e:
+            print(f"⚠️ rollup.json hỏng, dựng lại toàn bộ: {e}")
+    if state is None:
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        state = {"dates": {}, "shards": {}}
+
+    print("📊 Đang dựng rollup...")
+    # 1. Khối giờ: chỉ các mảnh mới / đổi
+    changed_dates = set()
+    shards = {}
+    for date_key, hours in sorted(index_data.items()):
+        for h in hours:
+            name = f"{date_key}_{h}"
+            try:
+                mtime = os.stat(os.path.join(out_dir, f"{name}.json")).st_mtime_ns
+            except OSError:
+                continue
+            shards[name] = mtime
+            if state["shards"].get(name) != mtime or not os.path.exists(_block_path(out_dir, 'hour', name)):
+                block = block_from_agg(chunkStore.read_agg(out_dir, date_key, h), edgeStats.read_stats(out_dir, date_key, h))
+                write_block(_block_path(out_dir, 'hour', name), block)
+                changed_dates.add(date_key)
+
+    # Mảnh / ngày đã biến mất
+    for name in set(state["shards"]) - set(shards):
+        path = _block_path(out_dir, 'hour', name)
+        if os.path.exists(path):
+            os.remove(path)
+        changed_dates.add(name.rsplit('_', 1)[0])
+
+    dates = {
+        date_key: sorted(int(name.rsplit('_', 1)[1]) for name in shards if name.rsplit('_', 1)[0] == date_key)
+        for date_key in sorted({name.rsplit('_', 1)[0] for name in shards})
+    }
+
+    # 2. Khối ngày cho các ngày có thay đổi
+    for date_key in sorted(changed_dates):
+        path = _block_path(out_dir, 'day', date_key)
+        if date_key in dates:
+            write_block(path, merge_blocks([read_block(_block_path(out_dir, 'hour', f"{date_key}_{h}"))
+                                            for h in dates[date_key]]))
+        elif os.path.exists(path):
+            os.remove(path)
+
+    # 3. how / hod / all: ngày mới chỉ cộng thêm vào khối how sẵn có; ngày bị ghi lại
+    #    hoặc xóa (min/max, phác thảo không trừ được) -> cộng lại riêng how của thứ đó.
+    #    hod = 7 khối how cùng giờ, all = 24 khối hod -> không đọc lại toàn bộ lịch sử.
+    added = {d for d in changed_dates if d in dates and d not in state["dates"]}
+    redo_weekdays = {weekday(d) for d in changed_dates - added}
+    how_parts = {}  # (w, h) -> khối giờ cần cộng
+    for w in redo_weekdays:
+        for h in ALL_HOURS:
+            how_parts[(w, h)] = []
+    for date_key, hours in dates.items():
+        w = weekday(date_key)
+        if w in redo_weekdays or date_key in added:
+            for h in hours:
+                how_parts.setdefault((w, h), []).append(read_block(_block_path(out_dir, 'hour', f"{date_key}_{h}")))
+    for (w, h), blocks in sorted(how_parts.items()):
+        path = _block_path(out_dir, 'how', f"{w}_{h}")
+        if w not in redo_weekdays:
+            blocks = [read_block(path)] + blocks
+        if blocks:
+            write_block(path, merge_blocks(blocks))
+        elif os.path.exists(path):
+            os.remove(path)
+    for h in sorted({h for _, h in how_parts}):
+        how_blocks = [_block_path(out_dir, 'how', f"{w}_{h}") for w in range(7)]
+        how_blocks = [read_block(path) for path in how_blocks if os.path.exists(path)]
+        path = _block_path(out_dir, 'hod', h)
+        if how_blocks:
+            write_block(path, merge_blocks(how_blocks))
+        elif os.path.exists(path):
+            os.remove(path)
+    if how_parts or not os.path.exists(_block_path(out_dir, 'all')):
+        write_block(_block_path(out_dir, 'all'),
+                    merge_blocks([read_block(_block_path(out_dir, 'hod', h)) for h in ALL_HOURS]))
+
+    state = {"dates": dates, "shards": shards}
+    os.makedirs(root, exist_ok=True)
+    tmp_path = f"{state_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+    print(f"✔ Rollup: {len(dates)} ngày, {len(changed_dates)} ngày cập nhật -> {root}")
+    return state
+
+def load_state(out_dir=INPUT_DIR):
+    with open(os.path.join(_rollup_dir(out_dir), 'rollup.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def plan_blocks(dates, date_from=None, date_to=None, hours=ALL_HOURS, weekdays=None):
+    """Chọn ít khối nhất phủ đúng khoảng thời gian hỏi.
+
+    dates: {date: [giờ có dữ liệu]} (rollup.json). Khoảng ngày [date_from, date_to]
+    bao gồm hai đầu, `hours` là các giờ trong ngày, `weekdays` lọc thứ (0 = thứ Hai).
+    Trả về danh sách (kind, key) trỏ tới các khối cần cộng.
+    """
+    hours = sorted(set(hours))
+    selected = [
+        d for d in sorted(dates)
+        if (date_from is None or d >= date_from) and (date_to is None or d <= date_to)
+        and (weekdays is None or weekday(d) in weekdays)
+    ]
+    if not selected or not hours:
+        return []
+    full_day = hours == list(ALL_HOURS)
+    all_dates = len(selected) == len(dates)
+    selected_weekdays = sorted({weekday(d) for d in selected})
+    # how dùng được khi tập ngày chọn = mọi ngày có thứ thuộc selected_weekdays
+    weekday_closed = len(selected) == sum(1 for d in dates if weekday(d) in selected_weekdays)
+
+    candidates = [[('hour', f"{d}_{h}") for d in selected for h in hours if h in dates[d]]]
+    if full_day:
+        candidates.append([('day', d) for d in selected])
+    if all_dates:
+        candidates.append([('hod', h) for h in hours])
+        if full_day:
+            candidates.append([('all', None)])
+    if weekday_closed:
+        candidates.append([('how', f"{w}_{h}") for w in selected_weekdays for h in hours])
+    return min(candidates, key=len)
+
+def query_range(out_dir=INPUT_DIR, date_from=None, date_to=None, hours=ALL_HOURS, weekdays=None, state=None):
+    """Trung bình theo cạnh cho một khoảng thời gian bất kỳ, cộng từ ít khối rollup nhất.
+
+    Ví dụ tốc độ trung bình ngày thường 7h-9h:
+        query_range(hours=range(7, 9), weekdays={0, 1, 2, 3, 4})
+    Trả về (cột {"from","to","count","speed","time"} + "p50","p85","var" khi mọi khối
+    có accumulator, danh sách khối đã dùng).
+    """
+    state = state or load_state(out_dir)
+    plan = plan_blocks(state["dates"], date_from, date_to, hours, weekdays)
+    block = merge_blocks([read_block(_block_path(out_dir, kind, key)) for kind, key in plan])
+    return block_means(block), plan
+
+if __name__ == "__main__":
+    build_rollups()
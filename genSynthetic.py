@@ -0,0 +1,142 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+# --- CẤU HÌNH ---
+# Khung tọa độ giả lập (khu vực TP.HCM)
+LAT_RANGE = (10.70, 10.88)
+LNG_RANGE = (106.60, 106.80)
+R_EARTH = 6371000
+START_DATE = '2025-04-01'
+
+# Sinh dữ liệu giả có cùng cấu trúc với HCMC_bus_routes/ và raw_GPS/ để đo hiệu
+# năng pipeline mà không cần dữ liệu thật. Cùng seed + tham số -> cùng từng byte.
+
+def _meters_to_deg(m):
+    return m / 111320.0
+
+def _haversine(lat1, lng1, lat2, lng2):
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lng2 - lng1) / 2) ** 2
+    return 2 * R_EARTH * np.arcsin(np.sqrt(a))
+
+def make_network(n_routes=20, stops_per_route=15, n_stations=150, seed=0):
+    """Sinh mạng tuyến: tọa độ trạm và danh sách trạm (theo thứ tự) của từng tuyến.
+
+    Mỗi tuyến đi từ một trạm ngẫu nhiên sang một trong các trạm gần nhất chưa
+    đi qua, nên tuyến có hình dạng hợp lý và các tuyến dùng chung trạm.
+    """
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(*LAT_RANGE, n_stations)
+    lng = rng.uniform(*LNG_RANGE, n_stations)
+    tree = cKDTree(np.column_stack((lat, lng)))
+    k = min(n_stations, 8)
+
+    routes = []
+    for _ in range(n_routes):
+        current = int(rng.integers(n_stations))
+        stops = [current]
+        while len(stops) < min(stops_per_route, n_stations):
+            _, near = tree.query([lat[current], lng[current]], k=k)
+            candidates = [int(i) for i in np.atleast_1d(near) if int(i) not in stops]
+            if not candidates:
+                candidates = [i for i in range(n_stations) if i not in stops]
+            current = candidates[int(rng.integers(len(candidates)))]
+            stops.append(current)
+        routes.append(np.array(stops))
+    return {"lat": lat, "lng": lng, "routes": routes}
+
+def write_route_tree(root_folder, network, seed=0):
+    """Ghi `root_folder/{RouteId}/stops_by_var.csv` + `rev_stops_by_var.csv` như đầu vào genCluster.
+
+    Cùng một trạm ở mỗi tuyến/hướng lệch nhau vài mét (hai bên đường).
+    """
+    rng = np.random.default_rng(seed + 1)
+    lat, lng = network["lat"], network["lng"]
+    for r, stops in enumerate(network["routes"]):
+        route_id = f"{r + 1:03d}"
+        route_dir = os.path.join(root_folder, route_id)
+        os.makedirs(route_dir, exist_ok=True)
+        for filename, order in (('stops_by_var.csv', stops), ('rev_stops_by_var.csv', stops[::-1])):
+            jitter = _meters_to_deg(rng.normal(0, 8, (len(order), 2)))
+            pd.DataFrame({
+                'StopId': order + 1,
+                'Code': [f"Q{s:04d}" for s in order],
+                'Name': [f"Tram {s}" for s in order],
+                'Lat': np.round(lat[order] + jitter[:, 0], 6),
+                'Lng': np.round(lng[order] + jitter[:, 1], 6),
+                'StopType': 'Tru dung',
+                'Street': [f"Duong {s % 97}" for s in order],
+                'Routes': route_id,
+            }).to_csv(os.path.join(route_dir, filename), index=False)
+    return root_folder
+
+def vehicle_track(lat, lng, rng, n_points, day_start):
+    """Quỹ đạo một xe chạy đi-về liên tục trên một tuyến (tọa độ trạm lat/lng theo thứ tự).
+
+    Trả về (thời điểm giây trong ngày, lat, lng) của n_points điểm GPS.
+    """
+    # Các mốc: đến trạm i rồi rời trạm i sau thời gian dừng
+    lap_lat = np.concatenate((lat, lat[-2::-1]))
+    lap_lng = np.concatenate((lng, lng[-2::-1]))
+    seg = _haversine(lap_lat[:-1], lap_lng[:-1], lap_lat[1:], lap_lng[1:])
+
+    interval = rng.integers(5, 31, n_points)
+    t_points = day_start + np.cumsum(interval)
+    knot_t, knot_lat, knot_lng = [day_start], [lap_lat[0]], [lap_lng[0]]
+    t = day_start
+    while t < t_points[-1]:
+        speeds = rng.uniform(10, 40, len(seg)) / 3.6 # m/s
+        dwell = rng.uniform(15, 60, len(seg))
+        for i in range(len(seg)):
+            t += seg[i] / speeds[i]
+            knot_t.append(t); knot_lat.append(lap_lat[i + 1]); knot_lng.append(lap_lng[i + 1])
+            t += dwell[i]
+            knot_t.append(t); knot_lat.append(lap_lat[i + 1]); knot_lng.append(lap_lng[i + 1])
+    noise = _meters_to_deg(rng.normal(0, 5, (n_points, 2)))
+    return (
+        t_points,
+        np.interp(t_points, knot_t, knot_lat) + noise[:, 0],
+        np.interp(t_points, knot_t, knot_lng) + noise[:, 1],
+    )
+
+def write_gps_days(gps_folder, network, n_vehicles=100, points_per_vehicle=300, n_days=2, seed=0,
+                   start_date=START_DATE):
+    """Ghi `anonymized_raw_{YYYY-MM-DD}.csv` (anonymized_vehicle,datetime,lat,lng) cho n_days ngày."""
+    rng = np.random.default_rng(seed + 2)
+    os.makedirs(gps_folder, exist_ok=True)
+    lat, lng = network["lat"], network["lng"]
+    vehicle_ids = [f"{v:016x}" for v in rng.integers(0, 2 ** 62, n_vehicles)]
+    vehicle_routes = rng.integers(len(network["routes"]), size=n_vehicles)
+
+    paths = []
+    for d in range(n_days):
+        date = np.datetime64(start_date) + np.timedelta64(d, 'D')
+        frames = []
+        for v in range(n_vehicles):
+            stops = network["routes"][vehicle_routes[v]]
+            day_start = float(rng.integers(5 * 3600, 20 * 3600))
+            t, la, ln = vehicle_track(lat[stops], lng[stops], rng, points_per_vehicle, day_start)
+            frames.append(pd.DataFrame({
+                'anonymized_vehicle': vehicle_ids[v],
+                'datetime': date + t.astype('timedelta64[s]'),
+                'lat': np.round(la, 6), 'lng': np.round(ln, 6),
+            }))
+        df = pd.concat(frames, ignore_index=True).sort_values('datetime', kind='stable')
+        path = os.path.join(gps_folder, f"anonymized_raw_{date}.csv")
+        df.to_csv(path, index=False, date_format='%Y-%m-%d %H:%M:%S')
+        paths.append(path)
+    return paths
+
+def generate(out_dir, n_routes=20, stops_per_route=15, n_stations=150, n_vehicles=100,
+             points_per_vehicle=300, n_days=2, seed=0):
+    """Sinh `out_dir/HCMC_bus_routes/` và `out_dir/raw_GPS/`, trả về hai đường dẫn."""
+    network = make_network(n_routes, stops_per_route, n_stations, seed)
+    routes_dir = write_route_tree(os.path.join(out_dir, 'HCMC_bus_routes'), network, seed)
+    gps_dir = os.path.join(out_dir, 'raw_GPS')
+    write_gps_days(gps_dir, network, n_vehicles, points_per_vehicle, n_days, seed)
+    return routes_dir, gps_dir
+
+if __name__ == "__main__":
+    generate('synthetic_data')
@@ -0,0 +1,199 @@
+import os
+import json
+import threading
+import numpy as np
+import chunkStore
+
+# --- CẤU HÌNH ---
+INPUT_DIR = 'traffic_data_chunks'
+TILES_DIRNAME = 'tiles'
+TILE_MAX_ZOOM = 16     # zoom sâu nhất có phân tầng; zoom lớn hơn thấy mọi cạnh
+TILE_EDGE_LIMIT = 500  # số cạnh tối đa của một ô ở mỗi zoom (giữ cạnh nhiều lượt nhất)
+TILE_COLUMNS = ('from', 'to', 'speed', 'time', 'count', 'minzoom', 'mx', 'my', 'hx', 'hy', 'morton')
+
+# Mỗi mảnh giờ có một file tiles/{date}_{h}.npz: các cạnh agg sắp theo mã Morton
+# (z-order) của ô chứa trung điểm cạnh ở TILE_MAX_ZOOM, nên mọi ô z/x/y với
+# z <= TILE_MAX_ZOOM là một đoạn liên tục -> cắt bằng searchsorted.
+# minzoom = zoom nhỏ nhất mà cạnh lọt vào top TILE_EDGE_LIMIT (theo count) của ô
+# chứa nó; ô càng nhỏ thì hạng càng cao nên đã hiện ở zoom z là hiện ở mọi zoom lớn hơn.
+# hx/hy = nửa khung bao của cạnh quanh trung điểm: truy vấn nới khoảng ô theo hx/hy lớn
+# nhất rồi lọc theo khung bao, nên cạnh dài đi xuyên qua ô vẫn được trả về.
+
+def load_node_coords(out_dir=INPUT_DIR):
+    """nodes.json -> (node_lat, node_lng) tra theo cluster_label (NaN nếu không có)."""
+    with open(os.path.join(out_dir, 'nodes.json'), 'r', encoding='utf-8') as f:
+        nodes = json.load(f)
+    labels = np.array([int(k) for k in nodes], dtype=np.int64)
+    size = int(labels.max()) + 1 if len(labels) else 0
+    node_lat = np.full(size, np.nan)
+    node_lng = np.full(size, np.nan)
+    node_lat[labels] = [n["lat"] for n in nodes.values()]
+    node_lng[labels] = [n["lng"] for n in nodes.values()]
+    return node_lat, node_lng
+
+def mercator(lat, lng):
+    """Lat/Lng -> tọa độ Web Mercator chuẩn hóa [0, 1) (x sang đông, y xuống nam)."""
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -85.05112878, 85.05112878)
+    mx = (np.asarray(lng, dtype=np.float64) + 180.0) / 360.0
+    my = (1.0 - np.log(np.tan(np.radians(lat)) + 1.0 / np.cos(np.radians(lat))) / np.pi) / 2.0
+    return np.clip(mx, 0, np.nextafter(1, 0)), np.clip(my, 0, np.nextafter(1, 0))
+
+def _spread_bits(v):
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+def morton(tx, ty):
+    """Mã z-order của ô (tx, ty): xen kẽ bit, tx ở bit chẵn."""
+    return _spread_bits(tx) | (_spread_bits(ty) << np.uint64(1))
+
+def tile_of(mx, my, z):
+    n = 1 << z
+    return (mx * n).astype(np.int64), (my * n).astype(np.int64)
+
+def build_tile_index(agg, node_lat, node_lng, max_zoom=TILE_MAX_ZOOM, edge_limit=TILE_EDGE_LIMIT):
+    """Cột agg của một mảnh -> chỉ mục ô (các cột TILE_COLUMNS, sắp theo morton).
+
+    Bỏ các cạnh có node không có tọa độ (viewer cũng không vẽ được).
+    """
+    f = np.asarray(agg['from'], dtype=np.int64)
+    t = np.asarray(agg['to'], dtype=np.int64)
+    in_range = (f < len(node_lat)) & (t < len(node_lat))
+    lat1 = np.full(len(f), np.nan)
+    lng1, lat2, lng2 = lat1.copy(), lat1.copy(), lat1.copy()
+    lat1[in_range], lng1[in_range] = node_lat[f[in_range]], node_lng[f[in_range]]
+    lat2[in_range], lng2[in_range] = node_lat[t[in_range]], node_lng[t[in_range]]
+    keep = np.flatnonzero(~np.isnan(lat1 + lng1 + lat2 + lng2))
+
+    mx, my = mercator((lat1[keep] + lat2[keep]) / 2, (lng1[keep] + lng2[keep]) / 2)
+    mx1, my1 = mercator(lat1[keep], lng1[keep])
+    mx2, my2 = mercator(lat2[keep], lng2[keep])
+    hx = np.maximum(np.abs(mx1 - mx), np.abs(mx2 - mx))
+    hy = np.maximum(np.abs(my1 - my), np.abs(my2 - my))
+    count = np.asarray(agg['count'])[keep]
+
+    # Hạng trong ô ở từng zoom (nhiều lượt trước, hòa thì giữ thứ tự trong mảnh)
+    minzoom = np.full(len(keep), max_zoom, dtype=np.uint8)
+    for z in range(max_zoom, -1, -1):
+        tx, ty = tile_of(mx, my, z)
+        key = (tx << 32) | ty
+        order = np.lexsort((-count, key))
+        sorted_key = key[order]
+        starts = np.r_[0, np.flatnonzero(sorted_key[1:] != sorted_key[:-1]) + 1]
+        sizes = np.diff(np.r_[starts, len(order)])
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - np.repeat(starts, sizes)
+        minzoom[rank < edge_limit] = z
+
+    tx, ty = tile_of(mx, my, max_zoom)
+    code = morton(tx, ty)
+    order = np.argsort(code, kind='stable')
+    cols = {
+        'from': agg['from'][keep], 'to': agg['to'][keep], 'speed': agg['speed'][keep],
+        'time': agg['time'][keep], 'count': count, 'minzoom': minzoom, 'mx': mx, 'my': my,
+        'hx': hx, 'hy': hy, 'morton': code,
+    }
+    cols.update({name: agg[name][keep] for name in chunkStore.AGG_STAT_COLUMNS if name in agg})
+    return {name: np.asarray(arr)[order] for name, arr in cols.items()}
+
+def _tiles_path(out_dir, date_key, h):
+    return os.path.join(out_dir, TILES_DIRNAME, f"{date_key}_{h}.npz")
+
+def write_tile_index(out_dir, date_key, h, tiles):
+    path = _tiles_path(out_dir, date_key, h)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # app.py dựng chỉ mục từ nhiều luồng request cùng lúc -> file tạm riêng cho từng luồng
+    tmp_path = f"{path}.tmp{os.getpid()}_{threading.get_ident()}"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, max_zoom=np.int64(TILE_MAX_ZOOM), **tiles)
+    os.replace(tmp_path, path)
+
+def read_tile_index(out_dir, date_key, h, node_coords=None):
+    """Chỉ mục ô của một mảnh giờ; dựng lại (và lưu) nếu chưa có hoặc cũ hơn mảnh JSON."""
+    path = _tiles_path(out_dir, date_key, h)
+    shard_path = os.path.join(out_dir, f"{date_key}_{h}.json")
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(shard_path):
+        with np.load(path) as data:
+            if int(data['max_zoom']) == TILE_MAX_ZOOM and 'hx' in data.files:
+                return {name: data[name] for name in TILE_COLUMNS + tuple(chunkStore.AGG_STAT_COLUMNS)
+                        if name in data.files}
+    node_lat, node_lng = node_coords or load_node_coords(out_dir)
+    tiles = build_tile_index(chunkStore.read_agg(out_dir, date_key, h), node_lat, node_lng)
+    write_tile_index(out_dir, date_key, h, tiles)
+    return tiles
+
+def _home_slice(tiles, z, x, y):
+    """Chỉ số các cạnh có trung điểm trong ô z/x/y và hiển thị ở zoom z."""
+    if z <= TILE_MAX_ZOOM:
+        shift = np.uint64(2 * (TILE_MAX_ZOOM - z))
+        lo = morton(np.array([x]), np.array([y]))[0] << shift
+        hi = lo + (np.uint64(1) << shift)
+        start, stop = np.searchsorted(tiles['morton'], [lo, hi])
+        idx = np.arange(start, stop)
+        return idx[tiles['minzoom'][idx] <= z]
+    # Sâu hơn TILE_MAX_ZOOM: lấy ô cha rồi lọc theo tọa độ
+    shift = z - TILE_MAX_ZOOM
+    idx = _home_slice(tiles, TILE_MAX_ZOOM, x >> shift, y >> shift)
+    tx, ty = tile_of(tiles['mx'][idx], tiles['my'][idx], z)
+    return idx[(tx == x) & (ty == y)]
+
+MAX_BBOX_TILES = 256 # khung phủ nhiều ô hơn thì lọc thẳng trên toàn bộ cạnh
+
+def range_slice(tiles, z, x0, x1, y0, y1):
+    """Chỉ số các cạnh hiển thị ở zoom z có khung bao cắt khoảng ô [x0, x1] × [y0, y1].
+
+    Trung điểm của cạnh cắt khoảng ô nằm cách khoảng tối đa hx/hy lớn nhất, nên
+    chỉ cần quét thêm một viền ô quanh khoảng rồi lọc theo khung bao từng cạnh.
+    """
+    n = 1 << z
+    pad_x = int(np.ceil(tiles['hx'].max() * n)) if len(tiles['hx']) else 0
+    pad_y = int(np.ceil(tiles['hy'].max() * n)) if len(tiles['hy']) else 0
+    sx0, sx1 = max(x0 - pad_x, 0), min(x1 + pad_x, n - 1)
+    sy0, sy1 = max(y0 - pad_y, 0), min(y1 + pad_y, n - 1)
+    if (sx1 - sx0 + 1) * (sy1 - sy0 + 1) > MAX_BBOX_TILES:
+        idx = np.flatnonzero(tiles['minzoom'] <= z)
+    else:
+        parts = [_home_slice(tiles, z, x, y) for x in range(sx0, sx1 + 1) for y in range(sy0, sy1 + 1)]
+        idx = np.sort(np.concatenate(parts))
+    mx, my, hx, hy = tiles['mx'][idx], tiles['my'][idx], tiles['hx'][idx], tiles['hy'][idx]
+    hit = (mx + hx >= x0 / n) & (mx - hx < (x1 + 1) / n) & (my + hy >= y0 / n) & (my - hy < (y1 + 1) / n)
+    return idx[hit]
+
+def tile_slice(tiles, z, x, y):
+    """Chỉ số các cạnh của ô z/x/y hiển thị ở zoom z (kể cả cạnh chỉ đi xuyên qua ô)."""
+    return range_slice(tiles, z, x, x, y, y)
+
+def bbox_range(west, south, east, north, z):
+    """Khoảng ô (x0, x1, y0, y1) ở zoom z phủ khung nhìn (bao gồm hai đầu)."""
+    mx, my = mercator(np.array([north, south]), np.array([west, east]))
+    tx, ty = tile_of(mx, my, z)
+    return int(tx.min()), int(tx.max()), int(ty.min()), int(ty.max())
+
+def bbox_slice(tiles, west, south, east, north, z):
+    """Chỉ số các cạnh hiển thị ở zoom z trong khung nhìn (gộp từ các ô phủ khung)."""
+    return range_slice(tiles, z, *bbox_range(west, south, east, north, z))
+
+def build_tiles(out_dir=INPUT_DIR):
+    """Dựng chỉ mục ô cho mọi mảnh trong index.json (bỏ qua mảnh đã có bản mới)."""
+    with open(os.path.join(out_dir, 'index.json'), 'r') as f:
+        index_data = json.load(f)
+    node_coords = load_node_coords(out_dir)
+    print("🗺️ Đang dựng tile pyramid cho các mảnh giờ...")
+    n = 0
+    names = set()
+    for date_key, hours in sorted(index_data.items()):
+        for h in hours:
+            read_tile_index(out_dir, date_key, h, node_coords)
+            names.add(f"{date_key}_{h}.npz")
+            n += 1
+    # Xóa chỉ mục của các mảnh không còn trong index.json
+    tiles_dir = os.path.join(out_dir, TILES_DIRNAME)
+    for fname in os.listdir(tiles_dir) if os.path.isdir(tiles_dir) else []:
+        if fname.endswith('.npz') and fname not in names:
+            os.remove(os.path.join(tiles_dir, fname))
+    print(f"✔ Tile pyramid: {n} mảnh -> {os.path.join(out_dir, TILES_DIRNAME)}")
+
+if __name__ == "__main__":
+    build_tiles()
@@ -0,0 +1,90 @@
+import io
+import os
+import time
+import numpy as np
+import pandas as pd
+
+# --- CẤU HÌNH ---
+GPS_COLUMNS = ['anonymized_vehicle', 'datetime', 'lat', 'lng']
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Tọa độ đọc và khớp trạm ở float64. float32 (truyền coord_dtype=np.float32) chỉ dùng khi
+# chấp nhận sai số: ở lng ≈ 106.7 một bước float32 là ~0.8 m, đủ để điểm sát biên bán kính
+# khớp khác đi (mảnh / cạnh / số điểm khớp đổi so với float64).
+COORD_DTYPE = np.float64
+
+def gps_dtypes(coord_dtype=None):
+    """Schema cố định; mã xe đọc dạng chuỗi rồi chuyển sang categorical (mã int bên trong)."""
+    coord_dtype = coord_dtype or COORD_DTYPE
+    return {'anonymized_vehicle': str, 'datetime': str, 'lat': coord_dtype, 'lng': coord_dtype}
+
+def has_pyarrow():
+    try:
+        import pyarrow # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def parse_datetime(values, fmt=DATETIME_FORMAT):
+    """Parse cột datetime theo định dạng cố định (fast-path C), lỗi thì quay về tự đoán."""
+    try:
+        return pd.to_datetime(values, format=fmt, cache=True)
+    except (ValueError, TypeError):
+        print(f"   ⚠️ datetime không khớp định dạng '{fmt}', chuyển sang tự đoán (chậm hơn)")
+        return pd.to_datetime(values)
+
+def _normalize(df, fmt):
+    df['datetime'] = parse_datetime(df['datetime'], fmt)
+    df['anonymized_vehicle'] = df['anonymized_vehicle'].astype('category')
+    return df
+
+def load_gps(file_path, engine=None, datetime_format=DATETIME_FORMAT, coord_dtype=None, verbose=True):
+    """Đọc một file GPS với schema cố định, chỉ lấy 4 cột cần dùng.
+
+    engine: 'pyarrow' (nếu đã cài) hoặc 'c'; mặc định tự chọn pyarrow khi có.
+    Trả về DataFrame: anonymized_vehicle (category), datetime (datetime64),
+    lat/lng (float64, hoặc `coord_dtype`).
+    """
+    if engine is None:
+        engine = 'pyarrow' if has_pyarrow() else 'c'
+    start = time.perf_counter()
+
+    df = pd.read_csv(file_path, usecols=GPS_COLUMNS, dtype=gps_dtypes(coord_dtype), engine=engine)
+    df = _normalize(df, datetime_format)
+
+    if verbose:
+        report_throughput(file_path, len(df), time.perf_counter() - start, engine)
+    return df
+
+def iter_gps_chunks(file_path, chunk_rows, datetime_format=DATETIME_FORMAT, coord_dtype=None, verbose=True):
+    """Như load_gps nhưng trả về từng chunk `chunk_rows` dòng (engine C, đọc tuần tự)."""
+    rows = 0
+    elapsed = 0.0 # chỉ tính thời gian đọc/parse, không tính phần xử lý của bên gọi
+    reader = pd.read_csv(file_path, usecols=GPS_COLUMNS, dtype=gps_dtypes(coord_dtype), chunksize=chunk_rows)
+    while True:
+        start = time.perf_counter()
+        df = next(reader, None)
+        if df is None:
+            break
+        df = _normalize(df, datetime_format)
+        elapsed += time.perf_counter() - start
+        rows += len(df)
+        yield df
+
+    if verbose:
+        report_throughput(file_path, rows, elapsed, 'c/chunk')
+
+def parse_gps_lines(header, lines, datetime_format=DATETIME_FORMAT, coord_dtype=None):
+    """Các dòng CSV (chuỗi, kết thúc bằng xuống dòng) của một nguồn trực tiếp -> DataFrame như load_gps.
+
+    `header` là dòng tiêu đề của nguồn (thứ tự cột tùy ý, chỉ lấy 4 cột cần dùng).
+    """
+    text = header.rstrip('\r\n') + '\n' + ''.join(lines)
+    df = pd.read_csv(io.StringIO(text), usecols=GPS_COLUMNS, dtype=gps_dtypes(coord_dtype))
+    return _normalize(df, datetime_format)
+
+def report_throughput(file_path, rows, seconds, engine):
+    size_mb = os.path.getsize(file_path) / 2**20
+    seconds = max(seconds, 1e-9)
+    print(f"   📥 {os.path.basename(file_path)}: {rows:,} dòng, {size_mb:.1f} MB trong {seconds:.2f}s "
+          f"({rows / seconds:,.0f} dòng/s, {size_mb / seconds:.1f} MB/s, engine={engine})")
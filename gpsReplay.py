@@ -0,0 +1,113 @@
+import os
+import glob
+import time
+import socket
+import argparse
+import numpy as np
+import gpsLoader
+
+# --- CẤU HÌNH ---
+GPS_FOLDER = 'raw_GPS'
+SPEEDUP = 60.0          # 1 giây dữ liệu phát trong 1/SPEEDUP giây thật; 0 = nhanh nhất có thể
+BATCH_SECONDS = 1.0     # mỗi lô gom bản ghi của BATCH_SECONDS giây thật
+BATCH_ROWS = 50_000     # kích thước lô khi SPEEDUP = 0
+HEADER = ','.join(gpsLoader.GPS_COLUMNS) + '\n'
+
+# Phát lại các file raw_GPS lịch sử theo thứ tự thời gian, nhanh hơn thực tế
+# SPEEDUP lần, tới một nguồn của liveIngest (file ghi nối, thư mục thả file hoặc
+# socket TCP) để thử tải chế độ nạp trực tiếp. Mỗi file (một ngày) được đọc cả vào
+# bộ nhớ để sắp theo thời gian.
+
+def replay_batches(gps_folder=GPS_FOLDER, speedup=SPEEDUP, batch_seconds=BATCH_SECONDS):
+    """Sinh từng lô dòng CSV (không header) đúng nhịp phát lại; trả về sau khi đã chờ tới hạn của lô."""
+    start_wall = start_event = None
+    for gps_file in sorted(glob.glob(os.path.join(gps_folder, "*.csv"))):
+        df = gpsLoader.load_gps(gps_file, coord_dtype=np.float64, verbose=False)
+        df = df[df['datetime'].notna()].sort_values('datetime', kind='stable')
+        if df.empty:
+            continue
+        lines = df[gpsLoader.GPS_COLUMNS].to_csv(header=False, index=False, date_format=gpsLoader.DATETIME_FORMAT)
+        lines = lines.splitlines(keepends=True)
+        times = df['datetime'].values
+        if start_event is None:
+            start_wall, start_event = time.monotonic(), times[0]
+
+        if speedup:
+            # Lô = các bản ghi rơi vào cùng một cửa sổ batch_seconds × speedup giây dữ liệu
+            window = np.timedelta64(int(batch_seconds * speedup * 1e9), 'ns')
+            slot = (times - start_event) // window
+            bounds = np.flatnonzero(np.diff(slot)) + 1
+        else:
+            bounds = np.arange(BATCH_ROWS, len(lines), BATCH_ROWS)
+        starts = np.concatenate(([0], bounds)).tolist()
+        ends = np.concatenate((bounds, [len(lines)])).tolist()
+        for s0, e0 in zip(starts, ends):
+            if speedup:
+                due = start_wall + (times[s0] - start_event) / np.timedelta64(1, 's') / speedup
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            yield lines[s0:e0]
+
+def _open_sink(target, dest):
+    """-> (write(lines), close()) cho 'file' (ghi nối), 'dir' (thả file) hoặc 'socket' ('host:port')."""
+    if target == 'file':
+        f = open(dest, 'a', encoding='utf-8', newline='')
+        if f.tell() == 0:
+            f.write(HEADER)
+
+        def write(lines):
+            f.write(''.join(lines))
+            f.flush()
+        return write, f.close
+
+    if target == 'dir':
+        os.makedirs(dest, exist_ok=True)
+        seq = [0]
+
+        def write(lines):
+            # Ghi dưới tên tạm rồi đổi tên -> bên đọc không bao giờ thấy file dở
+            path = os.path.join(dest, f"replay_{os.getpid()}_{seq[0]:08d}.csv")
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                f.write(HEADER)
+                f.write(''.join(lines))
+            os.replace(tmp_path, path)
+            seq[0] += 1
+        return write, lambda: None
+
+    if target == 'socket':
+        host, port = dest.rsplit(':', 1)
+        conn = socket.create_connection((host, int(port)))
+        conn.sendall(HEADER.encode('utf-8'))
+        return (lambda lines: conn.sendall(''.join(lines).encode('utf-8'))), conn.close
+
+    raise ValueError(f"target phải là 'file', 'dir' hoặc 'socket', nhận {target!r}")
+
+def replay(target, dest, gps_folder=GPS_FOLDER, speedup=SPEEDUP, batch_seconds=BATCH_SECONDS):
+    """Phát lại gps_folder tới một nguồn của liveIngest. Trả về số dòng đã gửi."""
+    write, close = _open_sink(target, dest)
+    print(f"⏩ Phát lại {gps_folder} -> {target}:{dest} (x{speedup or 'max'})")
+    rows = 0
+    start = time.monotonic()
+    try:
+        for lines in replay_batches(gps_folder, speedup, batch_seconds):
+            write(lines)
+            rows += len(lines)
+    except KeyboardInterrupt:
+        print("\n🛑 Dừng phát lại.")
+    finally:
+        close()
+    seconds = max(time.monotonic() - start, 1e-9)
+    print(f"✔ Đã gửi {rows:,} dòng trong {seconds:.1f}s ({rows / seconds:,.0f} dòng/s)")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phát lại raw_GPS tới liveIngest")
+    parser.add_argument('target', choices=('file', 'dir', 'socket'))
+    parser.add_argument('dest', help="đường dẫn file / thư mục, hoặc host:port")
+    parser.add_argument('--gps-folder', default=GPS_FOLDER)
+    parser.add_argument('--speedup', type=float, default=SPEEDUP, help="0 = nhanh nhất có thể")
+    parser.add_argument('--batch-seconds', type=float, default=BATCH_SECONDS)
+    args = parser.parse_args()
+    replay(args.target, args.dest, args.gps_folder, args.speedup, args.batch_seconds)
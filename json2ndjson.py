@@ -1,22 +1,34 @@
-import os, json
+import os, json, re
+import chunkStore
 
+# Từ bản này create_sharded_traffic_map đã ghi sẵn .ndjson khi build;
+# script chỉ còn dùng để chuyển các mảnh cũ (build trước đó hoặc ndjson=False).
 root="traffic_data_chunks"
-out_files=[]
 
-for fname in os.listdir(root):
-    if fname.lower().endswith(".json"):
+def convert_all(root=root, compress=(), force=False):
+    """Sinh {date}_{h}.ndjson (+ .gz/.br) cho các mảnh JSON chưa có bản NDJSON."""
+    out_files=[]
+    for fname in sorted(os.listdir(root)):
+        m=re.match(r'(\d{4}-\d{2}-\d{2})_(\d+)\.json$', fname)
+        if not m: continue # bỏ qua nodes.json, index.json, manifest.json
+        date_key, h = m.group(1), m.group(2)
         src=os.path.join(root,fname)
-        with open(src) as f:
-            try:
-                data=json.load(f)
-            except Exception:
-                continue
-        lines=[]
-        for e in data.get("agg",[]): lines.append(json.dumps(e))
-        for vid,arr in data.get("veh",{}).items():
-            for e in arr: lines.append(json.dumps({"vid":vid, **e}))
-        dst=src.replace(".json",".ndjson")
-        with open(dst,"w") as f: f.write("\n".join(lines))
-        out_files.append(dst)
+        dst=os.path.join(root,f"{date_key}_{h}.ndjson")
+        if not force and os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+            continue
+        cols=chunkStore.read_columnar(root, date_key, h)
+        if cols is not None:
+            # Có bản dạng cột -> khỏi parse JSON
+            data=chunkStore.columns_to_chunk(*cols)
+        else:
+            with open(src) as f:
+                try:
+                    data=json.load(f)
+                except Exception:
+                    continue
+        out_files.append(chunkStore.write_ndjson(root, date_key, h, data, compress))
+    return out_files
 
-out_files
+if __name__ == "__main__":
+    out_files=convert_all()
+    print(f"✔ Đã ghi {len(out_files)} file NDJSON trong {root}")
@@ -0,0 +1,469 @@
+import os
+import json
+import time
+import glob
+import shutil
+import socket
+import argparse
+import selectors
+import numpy as np
+import pandas as pd
+import gpsLoader
+import chunkStore
+import edgeStats
+import tripStore
+import genFullMap
+from nodeIndex import NodeIndex
+
+# --- CẤU HÌNH ---
+LIVE_FILE = 'live.json'      # ảnh chụp các giờ đang mở, nằm trong thư mục mảnh
+STATE_FILE = 'live_state.npz' # trạng thái phiên (xe, điểm chờ, giờ đang mở) để chạy tiếp sau khi dừng
+POLL_SECONDS = 1.0           # nguồn chưa có dữ liệu mới -> chờ rồi đọc lại
+BLOCK_BYTES = 1 << 20        # mỗi lần đọc file / socket
+BATCH_ROWS = 100_000         # số dòng mỗi chunk khi đọc file thả vào thư mục
+SNAPSHOT_SECONDS = 10.0      # chu kỳ ghi live.json
+SOCKET_HOST = '127.0.0.1'
+SOCKET_PORT = 9100
+
+# Chế độ nạp trực tiếp: một process chạy lâu, nhận bản ghi GPS từ file đang được
+# ghi nối, thư mục thả file hoặc socket TCP cục bộ. Mỗi lô được map-matching
+# (NodeIndex) rồi đi qua cùng logic watermark với bản streaming trong genFullMap:
+# điểm cũ hơn watermark (thời gian lớn nhất đã thấy - max_lateness) mới được nối vào
+# trạng thái last_node/last_time của từng xe để sinh chuyến (extract_transitions).
+# Chuyến được gom theo giờ tuyệt đối (ngày + giờ): mỗi giờ đang mở giữ các chuyến và
+# một accumulator theo cạnh (edgeStats) cập nhật dần, ghi ra live.json theo chu kỳ.
+# Giờ H coi như xong khi watermark vượt cuối giờ + max_time (không còn chuyến nào
+# khởi hành trong H có thể tới) -> ghi mảnh như bản batch (write_chunk) và cập nhật
+# index.json nguyên tử. Bộ nhớ chỉ phụ thuộc số xe và số giờ đang mở.
+# Khi dừng, các giờ chưa xong KHÔNG được ghi thành mảnh (phiên sau ghi lại cả mảnh sẽ
+# làm mất chuyến của phiên trước): trạng thái xe, điểm chờ và các giờ đang mở được lưu
+# vào live_state.npz và nạp lại khi khởi động với cùng tham số + file node.
+# Lưu ý: build batch (create_sharded_traffic_map) với tham số khác sẽ xóa cả thư mục
+# mảnh; không chạy batch và live cùng lúc trên một thư mục.
+
+class LiveIngestor:
+    """Trạng thái nạp trực tiếp: xe, điểm chờ watermark và tổng hợp của các giờ đang mở."""
+
+    def __init__(self, nodes_file, radius=50, min_time=5, max_time=5400, max_lateness=300, columnar=None,
+                 ndjson=True, ndjson_compress=(), binary=False, sqlite=False):
+        self.index = NodeIndex.load(nodes_file)
+        self.nodes_sha1 = genFullMap.file_fingerprint(nodes_file)["sha1"]
+        self.max_lateness = int(max_lateness)
+        self.opts = {
+            "radius": radius, "min_time": min_time, "max_time": max_time, "columnar": columnar,
+            "ndjson": ndjson, "ndjson_compress": tuple(ndjson_compress or ()) if ndjson else (),
+            "binary": binary, "sqlite": sqlite
+        }
+        self.lateness = np.timedelta64(int(max_lateness), 's')
+        self.horizon = np.timedelta64(int(np.ceil(max_time)), 's')
+
+        self.vid_codes = {}          # vid -> mã số nguyên
+        self.vid_strs = []
+        self.last_node = np.zeros(0, dtype=np.int64)   # trạng thái theo mã xe
+        self.last_time = np.zeros(0, dtype='datetime64[ns]')
+        self.buf = []                # các điểm đã khớp, chưa qua watermark
+        self.hours = {}              # giờ tuyệt đối (datetime64[h]) -> {"parts": [...], "acc": accumulator}
+        self.seq = 0
+        self.max_seen = None
+        self.watermark = None
+        self.counts = {"rows": 0, "matched": 0, "transitions": 0, "dropped": 0, "hours_written": 0}
+
+        out_dir = genFullMap.OUTPUT_DIR
+        os.makedirs(out_dir, exist_ok=True)
+        genFullMap.write_json_atomic(os.path.join(out_dir, 'nodes.json'), self.index.nodes_meta())
+        self.index_path = os.path.join(out_dir, 'index.json')
+        self.index_data = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index_data = json.load(f)
+        self.state_path = os.path.join(out_dir, STATE_FILE)
+        self.load_state()
+
+    def _state_params(self):
+        return {**self.opts, "ndjson_compress": list(self.opts["ndjson_compress"]),
+                "max_lateness": self.max_lateness, "nodes_sha1": self.nodes_sha1}
+
+    def save_state(self):
+        """Lưu trạng thái phiên vào live_state.npz (ghi nguyên tử) để phiên sau chạy tiếp."""
+        meta = {
+            "params": self._state_params(), "seq": self.seq, "counts": self.counts,
+            "max_seen": None if self.max_seen is None else str(self.max_seen),
+            "watermark": None if self.watermark is None else str(self.watermark),
+            "hours": [str(hour) for hour in sorted(self.hours)]
+        }
+        arrays = {
+            "meta": np.array(json.dumps(meta)), "vid_strs": np.array(self.vid_strs, dtype=str),
+            "last_node": self.last_node, "last_time": self.last_time
+        }
+        if self.buf:
+            for name, col in zip(('veh', 'node', 'tms', 'seq'), (np.concatenate(c) for c in zip(*self.buf))):
+                arrays[f"buf_{name}"] = col
+        for i, hour in enumerate(sorted(self.hours)):
+            slot = self.hours[hour]
+            parts = slot["parts"]
+            for k in parts[0]:
+                arrays[f"h{i}_trans_{k}"] = np.concatenate([p[k] for p in parts])
+            for k, v in slot["acc"].items():
+                arrays[f"h{i}_acc_{k}"] = v
+        tmp_path = f"{self.state_path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.state_path)
+
+    def load_state(self):
+        """Nạp live_state.npz của phiên trước (bỏ qua nếu tham số hoặc file node đã đổi)."""
+        if not os.path.exists(self.state_path):
+            return
+        with np.load(self.state_path) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["params"] != self._state_params():
+                print(f"⚠️ {STATE_FILE} tạo với tham số / file node khác -> bỏ qua, các giờ đang mở của phiên trước"
+                      f" cần được phát lại")
+                return
+            self.vid_strs = data["vid_strs"].tolist()
+            self.vid_codes = {vid: i for i, vid in enumerate(self.vid_strs)}
+            self.last_node = data["last_node"]
+            self.last_time = data["last_time"]
+            if "buf_veh" in data.files:
+                self.buf = [tuple(data[f"buf_{name}"] for name in ('veh', 'node', 'tms', 'seq'))]
+            for i, hour in enumerate(meta["hours"]):
+                trans = {name[len(f"h{i}_trans_"):]: data[name] for name in data.files
+                         if name.startswith(f"h{i}_trans_")}
+                acc = {name[len(f"h{i}_acc_"):]: data[name] for name in data.files if name.startswith(f"h{i}_acc_")}
+                self.hours[np.datetime64(hour, 'h')] = {"parts": [trans], "acc": acc}
+        self.seq = meta["seq"]
+        self.counts = meta["counts"]
+        self.max_seen = None if meta["max_seen"] is None else np.datetime64(meta["max_seen"], 'ns')
+        self.watermark = None if meta["watermark"] is None else np.datetime64(meta["watermark"], 'ns')
+        print(f"♻️ Nạp lại phiên trước: {len(self.vid_strs)} xe, {len(self.hours)} giờ đang mở, "
+              f"watermark {self.watermark_str()}")
+
+    def ingest(self, df):
+        """Nạp một lô bản ghi GPS (DataFrame như gpsLoader.load_gps)."""
+        df = df[df['anonymized_vehicle'].notna() & df['datetime'].notna()]
+        if df.empty:
+            return
+        tms = df['datetime'].values.astype('datetime64[ns]')
+        node = self.index.match(df['lat'].values, df['lng'].values, self.opts['radius'])
+        self.counts["rows"] += len(df)
+        self.counts["matched"] += int((node != -1).sum())
+        seq = self.seq + np.arange(len(df), dtype=np.int64)
+        self.seq += len(df)
+
+        chunk_max = tms.max()
+        self.max_seen = chunk_max if self.max_seen is None else max(self.max_seen, chunk_max)
+        keep = node != -1
+        if self.watermark is not None:
+            late = keep & (tms < self.watermark)
+            self.counts["dropped"] += int(late.sum())
+            keep &= ~late
+        self.watermark = self.max_seen - self.lateness
+
+        if keep.any():
+            # Mã hóa xe (mã cố định suốt phiên)
+            codes, uniques = pd.factorize(df['anonymized_vehicle'].values[keep])
+            mapping = np.empty(len(uniques), dtype=np.int64)
+            for i, vid in enumerate(uniques):
+                if vid not in self.vid_codes:
+                    self.vid_codes[vid] = len(self.vid_strs)
+                    self.vid_strs.append(vid)
+                mapping[i] = self.vid_codes[vid]
+            if len(self.vid_strs) > len(self.last_node):
+                grow = len(self.vid_strs) - len(self.last_node)
+                self.last_node = np.concatenate((self.last_node, np.full(grow, -1, dtype=np.int64)))
+                self.last_time = np.concatenate((self.last_time, np.zeros(grow, dtype='datetime64[ns]')))
+            self.buf.append((mapping[codes], node[keep], tms[keep], seq[keep]))
+
+        # Đưa các điểm đã qua watermark vào trạng thái xe
+        if self.buf:
+            veh_b, node_b, tms_b, seq_b = (np.concatenate(c) for c in zip(*self.buf))
+            ready = tms_b < self.watermark
+            if ready.any():
+                self._finalize(veh_b[ready], node_b[ready], tms_b[ready], seq_b[ready])
+            rest = ~ready
+            self.buf = [(veh_b[rest], node_b[rest], tms_b[rest], seq_b[rest])] if rest.any() else []
+
+    def _finalize(self, veh, node, tms, seq):
+        # Ghép điểm cuối cùng đã biết của mỗi xe vào đầu lô để nối chuyến qua các lô
+        carried = np.unique(veh)
+        carried = carried[self.last_node[carried] != -1]
+        veh = np.concatenate((carried, veh))
+        node = np.concatenate((self.last_node[carried], node))
+        tms = np.concatenate((self.last_time[carried], tms))
+        seq = np.concatenate((np.full(len(carried), -1, dtype=np.int64), seq))
+        order = np.lexsort((seq, tms, veh))
+        veh, node, tms = veh[order], node[order], tms[order]
+
+        trans = genFullMap.extract_transitions(veh, node, tms, self.opts['min_time'], self.opts['max_time'])
+        self.counts["transitions"] += len(trans["veh"])
+        if len(trans["veh"]):
+            node_lat, node_lng = self.index.node_lat, self.index.node_lng
+            f, t = trans["f"], trans["t"]
+            speed = (genFullMap.haversine_np(node_lng[f], node_lat[f], node_lng[t], node_lat[t]) / 1000) \
+                / (trans["tm"] / 3600)
+            abs_hour = trans["dep"].astype('datetime64[h]')
+            for hour in np.unique(abs_hour):
+                sel = abs_hour == hour
+                slot = self.hours.setdefault(hour, {"parts": [], "acc": edgeStats.empty_stats()})
+                slot["parts"].append({k: v[sel] for k, v in trans.items()})
+                batch = edgeStats.from_samples(f[sel], t[sel], speed[sel], trans["tm"][sel])
+                slot["acc"] = edgeStats.update(slot["acc"], batch)
+
+        # Trạng thái mới = điểm cuối của mỗi xe trong lô
+        tail = np.flatnonzero(np.append(veh[1:] != veh[:-1], True))
+        self.last_node[veh[tail]] = node[tail]
+        self.last_time[veh[tail]] = tms[tail]
+
+    def flush_ready(self):
+        """Ghi các giờ đã hoàn tất theo watermark; trả về danh sách (date, h) đã ghi."""
+        if self.watermark is None:
+            return []
+        done = sorted(h for h in self.hours if h + np.timedelta64(1, 'h') + self.horizon <= self.watermark)
+        return [self._flush(hour) for hour in done]
+
+    def _flush(self, hour):
+        parts = self.hours.pop(hour)["parts"]
+        trans = {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+        # Sắp như bản batch: theo tên xe rồi thời điểm khởi hành
+        names = np.array(self.vid_strs)
+        rank = np.empty(len(names), dtype=np.int64)
+        rank[np.argsort(names, kind='stable')] = np.arange(len(names))
+        order = np.lexsort((trans["dep"], rank[trans["veh"]]))
+        trans = {k: v[order] for k, v in trans.items()}
+
+        date_key = str(hour.astype('datetime64[D]'))
+        hourly_stats = {}
+        vehicle_ranges = {}
+        hourly_data = genFullMap.build_hourly_chunks(trans, self.vid_strs, self.index.node_lat, self.index.node_lng,
+                                                     hourly_stats)
+        o = self.opts
+        for h, chunk in hourly_data.items():
+            genFullMap.write_chunk(date_key, h, chunk, o['columnar'], o['ndjson'], o['ndjson_compress'], o['binary'],
+                                   hourly_stats[h], o['sqlite'], vehicle_ranges)
+        chunkStore.write_vehicle_index(genFullMap.OUTPUT_DIR, date_key, vehicle_ranges)
+
+        h = int(hour.astype(np.int64) % 24)
+        self.index_data[date_key] = sorted(set(self.index_data.get(date_key, [])) | {h})
+        genFullMap.write_json_atomic(self.index_path, dict(sorted(self.index_data.items())))
+        self.counts["hours_written"] += 1
+        return date_key, h
+
+    def snapshot(self):
+        """Tổng hợp hiện tại của các giờ đang mở: {"watermark", "counts", "hours": {"date_h": [agg...]}}."""
+        open_hours = {}
+        for hour, slot in sorted(self.hours.items()):
+            name = f"{hour.astype('datetime64[D]')}_{int(hour.astype(np.int64) % 24)}"
+            open_hours[name] = genFullMap.agg_records(slot["acc"], self.index.node_lat, self.index.node_lng)
+        return {
+            "watermark": self.watermark_str(),
+            "counts": dict(self.counts),
+            "hours": open_hours
+        }
+
+    def watermark_str(self):
+        return None if self.watermark is None else str(self.watermark.astype('datetime64[s]'))
+
+    def write_snapshot(self):
+        genFullMap.write_json_atomic(os.path.join(genFullMap.OUTPUT_DIR, LIVE_FILE), self.snapshot())
+
+    def close(self, flush=False):
+        """Kết thúc phiên.
+
+        Mặc định lưu trạng thái (live_state.npz) để phiên sau chạy tiếp, các giờ còn mở
+        chưa được ghi thành mảnh. flush=True chỉ dùng khi nguồn đã hết hẳn: mọi điểm còn
+        chờ được đưa vào trạng thái, các giờ còn mở được ghi luôn và trạng thái bị xóa.
+        """
+        if flush:
+            if self.buf:
+                self._finalize(*(np.concatenate(c) for c in zip(*self.buf)))
+                self.buf = []
+            for hour in sorted(self.hours):
+                self._flush(hour)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+        else:
+            self.save_state()
+        self.write_snapshot()
+        tripStore.close(tripStore.db_path(genFullMap.OUTPUT_DIR))
+
+    def run(self, source, snapshot_seconds=SNAPSHOT_SECONDS, flush_on_exit=False):
+        """Vòng lặp chính: đọc lô từ `source` (generator DataFrame / None khi rỗi) tới khi hết hoặc Ctrl+C."""
+        print(f"📡 Bắt đầu nạp trực tiếp -> {genFullMap.OUTPUT_DIR}")
+        start = last_snapshot = time.monotonic()
+        try:
+            for df in source:
+                if df is not None and len(df):
+                    self.ingest(df)
+                for date_key, h in self.flush_ready():
+                    print(f"   -> OK: {date_key}_{h}")
+                now = time.monotonic()
+                if now - last_snapshot >= snapshot_seconds:
+                    self.write_snapshot()
+                    last_snapshot = now
+                    print(f"   ⏱️ {self.counts['rows']:,} dòng ({self.counts['rows'] / (now - start):,.0f} dòng/s), "
+                          f"watermark {self.watermark_str()}, {len(self.hours)} giờ đang mở")
+        except KeyboardInterrupt:
+            print("\n🛑 Dừng nạp trực tiếp.")
+        finally:
+            self.close(flush_on_exit)
+        if self.counts["dropped"]:
+            print(f"   ⚠️ bỏ {self.counts['dropped']} điểm đến trễ hơn watermark")
+        print(f"✔ Đã ghi {self.counts['hours_written']} mảnh giờ, {self.counts['transitions']:,} chuyến")
+        return self.counts
+
+# --- Nguồn dữ liệu: generator sinh DataFrame mỗi lô, None khi chưa có gì mới ---
+
+def _new_state():
+    return {"header": None, "partial": b'', "lines": []}
+
+def _split_lines(state, data):
+    """Ghép `data` vào phần dòng dở của nguồn; dòng đầu tiên là header."""
+    *complete, state["partial"] = (state["partial"] + data).split(b'\n')
+    for line in complete:
+        if not line.strip():
+            continue
+        text = line.decode('utf-8') + '\n'
+        if state["header"] is None:
+            state["header"] = text
+        else:
+            state["lines"].append(text)
+
+def _take_frame(state):
+    """Các dòng đủ của nguồn -> DataFrame (None nếu chưa có, lô lỗi bị bỏ kèm cảnh báo)."""
+    lines, state["lines"] = state["lines"], []
+    if not lines:
+        return None
+    try:
+        return gpsLoader.parse_gps_lines(state["header"], lines)
+    except (ValueError, pd.errors.ParserError) as e:
+        print(f"   ⚠️ Bỏ lô {len(lines)} dòng không đọc được: {e}")
+        return None
+
+def follow_file(path, poll=POLL_SECONDS, from_start=True, stop=None):
+    """Đọc một file CSV đang được ghi nối thêm (như `tail -f`).
+
+    Dòng cuối chưa có ký tự xuống dòng được giữ lại tới lần đọc sau. File bị cắt
+    ngắn (xoay vòng) thì đọc lại từ header. from_start=False bỏ qua dữ liệu đã có.
+    """
+    while not os.path.exists(path):
+        if stop is not None and stop.is_set():
+            return
+        yield None
+        time.sleep(poll)
+    with open(path, 'rb') as f:
+        state = _new_state()
+        skip_existing = not from_start
+        while stop is None or not stop.is_set():
+            if os.path.getsize(path) < f.tell():
+                f.seek(0)
+                state = _new_state()
+            data = f.read(BLOCK_BYTES)
+            if not data:
+                yield None
+                time.sleep(poll)
+                continue
+            _split_lines(state, data)
+            if skip_existing and state["header"] is not None:
+                # Đã có header -> nhảy tới cuối file, chỉ đọc phần ghi thêm
+                f.seek(0, os.SEEK_END)
+                state.update(partial=b'', lines=[])
+                skip_existing = False
+            frame = _take_frame(state)
+            if frame is not None:
+                yield frame
+
+def watch_directory(folder, pattern='*.csv', poll=POLL_SECONDS, done_dir=None, stop=None):
+    """Thư mục thả file: mỗi file khớp `pattern` được đọc một lần theo chunk.
+
+    Bên ghi phải tạo file dưới tên khác (vd. .tmp) rồi đổi tên vào thư mục để không
+    đọc phải file dở. Có `done_dir` thì file đã đọc được chuyển sang đó.
+    """
+    seen = set()
+    while stop is None or not stop.is_set():
+        new_files = sorted(p for p in glob.glob(os.path.join(folder, pattern)) if p not in seen)
+        for path in new_files:
+            for df in gpsLoader.iter_gps_chunks(path, BATCH_ROWS, verbose=False):
+                yield df
+            if done_dir:
+                os.makedirs(done_dir, exist_ok=True)
+                shutil.move(path, os.path.join(done_dir, os.path.basename(path)))
+            else:
+                seen.add(path)
+        if not new_files:
+            yield None
+            time.sleep(poll)
+
+def listen_socket(host=SOCKET_HOST, port=SOCKET_PORT, poll=POLL_SECONDS, stop=None):
+    """Nhận bản ghi GPS qua TCP cục bộ: mỗi kết nối gửi một dòng header rồi các dòng CSV.
+
+    Nhiều nguồn kết nối cùng lúc được; dòng của mỗi kết nối đọc theo header riêng.
+    """
+    sel = selectors.DefaultSelector()
+    server = socket.create_server((host, port))
+    server.setblocking(False)
+    sel.register(server, selectors.EVENT_READ)
+    clients = {}
+    print(f"🔌 Đang nghe {host}:{port}")
+    try:
+        while stop is None or not stop.is_set():
+            closed = []
+            for key, _ in sel.select(timeout=poll):
+                sock = key.fileobj
+                if sock is server:
+                    conn, _ = server.accept()
+                    conn.setblocking(False)
+                    sel.register(conn, selectors.EVENT_READ)
+                    clients[conn] = _new_state()
+                    continue
+                try:
+                    data = sock.recv(BLOCK_BYTES)
+                except ConnectionError:
+                    data = b''
+                if data:
+                    _split_lines(clients[sock], data)
+                else:
+                    # Kết nối đóng: dòng cuối không có xuống dòng vẫn được tính
+                    _split_lines(clients[sock], b'\n')
+                    sel.unregister(sock)
+                    sock.close()
+                    closed.append(sock)
+            frames = [frame for frame in map(_take_frame, clients.values()) if frame is not None]
+            for sock in closed:
+                del clients[sock]
+            if frames:
+                yield from frames
+            else:
+                yield None
+    finally:
+        for sock in clients:
+            sock.close()
+        sel.close()
+        server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Nạp GPS trực tiếp vào traffic_data_chunks/")
+    parser.add_argument('nodes_file')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file', help="file CSV đang được ghi nối")
+    source.add_argument('--dir', help="thư mục thả file CSV")
+    source.add_argument('--socket', action='store_true', help=f"nghe TCP (mặc định {SOCKET_HOST}:{SOCKET_PORT})")
+    parser.add_argument('--host', default=SOCKET_HOST)
+    parser.add_argument('--port', type=int, default=SOCKET_PORT)
+    parser.add_argument('--radius', type=int, default=50)
+    parser.add_argument('--max-lateness', type=int, default=300)
+    parser.add_argument('--sqlite', action='store_true')
+    parser.add_argument('--flush-on-exit', action='store_true',
+                        help="nguồn đã hết hẳn: ghi cả các giờ chưa xong khi dừng thay vì lưu trạng thái")
+    args = parser.parse_args()
+
+    ingestor = LiveIngestor(args.nodes_file, radius=args.radius, max_lateness=args.max_lateness, sqlite=args.sqlite)
+    if args.file:
+        source = follow_file(args.file)
+    elif args.dir:
+        source = watch_directory(args.dir)
+    else:
+        source = listen_socket(args.host, args.port)
+    ingestor.run(source, flush_on_exit=args.flush_on_exit)
+
+if __name__ == "__main__":
+    main()
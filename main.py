@@ -3,17 +3,34 @@ import genMap as gm
 import genPath as gp
 import genFullMap as gf
 import genCSV as gcsv
+import genRollup as gr
+import genBaseline as gb
+import genHeatmap as gh
+import genTiles as gt
 import pandas as pd
+import pipelineMetrics as pm
 import app
 
+# --- CẤU HÌNH ---
+METRICS_FILE = None  # vd. 'pipeline_metrics.ndjson' để ghi thời gian/bộ đếm từng bước
+PROFILE = None       # None, 'cprofile' hoặc 'tracemalloc' (cần METRICS_FILE)
+
 def main():
     radius = 200
     root_folder = 'HCMC_bus_routes'  # Thư mục gốc chứa dữ liệu
     output_file = '../grouped_stops_nested.csv'
     # output_file = gc.group_stops_nested_structure(root_folder, radius_meters=radius)
 
+    if METRICS_FILE:
+        pm.enable(METRICS_FILE, profile=PROFILE)
+
     # gp.build_graph_with_unified_radius(output_file, '../raw_GPS/anonymized_raw_2025-04-01.csv', UNIFIED_RADIUS=radius)
     gf.create_sharded_traffic_map(output_file, '../raw_GPS', radius=radius)
+    gr.build_rollups(gf.OUTPUT_DIR)
+    gt.build_tiles(gf.OUTPUT_DIR)
+    gb.build_baseline(gf.OUTPUT_DIR)  # hồ sơ giờ-trong-tuần cho z/anomaly và /api/anomalies
+    gh.build_heatmap('../raw_GPS', gh.OUTPUT_DIR)
+    pm.finish()
     app.main()
 
 if __name__ == "__main__":
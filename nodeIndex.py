@@ -0,0 +1,136 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+# --- CẤU HÌNH ---
+R_EARTH = 6371000
+INDEX_VERSION = 2 # tăng khi đổi cách dựng index để cache cũ tự bị bỏ qua
+CACHE_DIRNAME = '.node_index'
+
+def to_ecef(lat, lng):
+    """Lat/Lng (độ) -> tọa độ Descartes (mét) để KDTree tính khoảng cách."""
+    # Luôn tính ở float64 (tọa độ GPS có thể được nạp dạng float32)
+    phi = np.radians(np.asarray(lat, dtype=np.float64))
+    theta = np.radians(np.asarray(lng, dtype=np.float64))
+    return np.column_stack((
+        R_EARTH * np.cos(phi) * np.cos(theta),
+        R_EARTH * np.cos(phi) * np.sin(theta),
+        R_EARTH * np.sin(phi)
+    ))
+
+def nodes_fingerprint(nodes_file):
+    h = hashlib.sha1(f"v{INDEX_VERSION}:".encode())
+    with open(nodes_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class NodeIndex:
+    """Chỉ mục không gian các node (cluster) dùng chung cho map-matching.
+
+    labels/lat/lng theo thứ tự điểm trong KDTree; node_lat/node_lng là bảng
+    tọa độ tra theo cluster_label (NaN nếu không có).
+    """
+
+    def __init__(self, labels, lat, lng, names, ecef=None):
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.lat = lat
+        self.lng = lng
+        self.names = names
+        self.ecef = ecef if ecef is not None else to_ecef(lat, lng)
+        self.tree = cKDTree(self.ecef)
+
+        size = int(self.labels.max()) + 1 if len(self.labels) else 0
+        self.node_lat = np.full(size, np.nan)
+        self.node_lng = np.full(size, np.nan)
+        self.node_lat[self.labels] = lat
+        self.node_lng[self.labels] = lng
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def from_csv(cls, nodes_file):
+        """Dựng index từ grouped_stops_nested.csv (mỗi cluster lấy dòng đầu tiên)."""
+        nodes_df = pd.read_csv(nodes_file)
+        unique_nodes = nodes_df.groupby('cluster_label').agg({
+            'centroid_lat': 'first', 'centroid_lng': 'first', 'Name': 'first'
+        }).reset_index()
+        return cls(
+            unique_nodes['cluster_label'].to_numpy(dtype=np.int64),
+            unique_nodes['centroid_lat'].to_numpy(dtype=np.float64),
+            unique_nodes['centroid_lng'].to_numpy(dtype=np.float64),
+            [str(n) for n in unique_nodes['Name'].tolist()]
+        )
+
+    @classmethod
+    def load(cls, nodes_file, cache_dir=None):
+        """Nạp index từ cache trên đĩa (khóa theo sha1 file node), chưa có thì dựng rồi lưu.
+
+        cache_dir mặc định là `.node_index/` cạnh file node; cache_dir=False để tắt cache.
+        """
+        if cache_dir is False:
+            return cls.from_csv(nodes_file)
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(nodes_file)), CACHE_DIRNAME)
+        path = os.path.join(cache_dir, nodes_fingerprint(nodes_file))
+
+        if os.path.exists(os.path.join(path, 'ecef.npy')):
+            try:
+                return cls._load_cached(path)
+            except Exception as e:
+                print(f"   ⚠️ Cache node index hỏng, dựng lại: {e}")
+
+        index = cls.from_csv(nodes_file)
+        try:
+            index.save(path)
+        except OSError as e:
+            print(f"   ⚠️ Không lưu được cache node index: {e}")
+        return index
+
+    @classmethod
+    def _load_cached(cls, path):
+        # Mảng tọa độ / nhãn được memory-map, không đọc CSV hay tính lại ECEF. Cache chỉ
+        # gồm .npy (allow_pickle=False) và JSON nên không chạy mã từ file; KDTree dựng lại
+        # từ tọa độ ECEF (nhanh so với đọc CSV) thay vì lưu bằng pickle.
+        labels = np.load(os.path.join(path, 'labels.npy'), mmap_mode='r')
+        lat = np.load(os.path.join(path, 'lat.npy'), mmap_mode='r')
+        lng = np.load(os.path.join(path, 'lng.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'names.json'), 'r', encoding='utf-8') as f:
+            names = json.load(f)
+        ecef = np.load(os.path.join(path, 'ecef.npy'), mmap_mode='r')
+        return cls(labels, lat, lng, names, ecef)
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, 'labels.npy'), self.labels)
+        np.save(os.path.join(tmp_path, 'lat.npy'), np.asarray(self.lat))
+        np.save(os.path.join(tmp_path, 'lng.npy'), np.asarray(self.lng))
+        with open(os.path.join(tmp_path, 'names.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.names, f, ensure_ascii=False)
+        np.save(os.path.join(tmp_path, 'ecef.npy'), np.asarray(self.ecef))
+        if os.path.exists(path):
+            shutil.rmtree(tmp_path, ignore_errors=True) # process khác đã lưu trước
+            return
+        os.replace(tmp_path, path)
+
+    def match(self, lat, lng, radius):
+        """Map-matching theo lô: cluster_label gần nhất trong `radius` mét, -1 nếu không có."""
+        dists, idxs = self.tree.query(to_ecef(lat, lng), k=1, distance_upper_bound=radius)
+        valid = idxs < len(self.labels)
+        node_ids = np.full(len(idxs), -1, dtype=np.int64)
+        node_ids[valid] = self.labels[idxs[valid]]
+        return node_ids
+
+    def nodes_meta(self):
+        """{cluster_label: {"lat", "lng", "name"}} như nodes.json."""
+        return {
+            label: {"lat": lat, "lng": lng, "name": name}
+            for label, lat, lng, name in zip(self.labels.tolist(), np.asarray(self.lat).tolist(),
+                                             np.asarray(self.lng).tolist(), self.names)
+        }
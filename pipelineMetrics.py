@@ -0,0 +1,197 @@
+import os
+import io
+import json
+import time
+import pstats
+import threading
+import cProfile
+import tracemalloc
+import contextlib
+try:
+    import resource # không có trên Windows
+except ImportError:
+    resource = None
+
+# --- CẤU HÌNH ---
+METRICS_FILE = 'pipeline_metrics.ndjson'
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+PROFILE_TOP = 25 # số dòng top hàm / dòng cấp phát trong bản tổng kết
+
+# Bộ đo theo bước (stage) cho genFullMap / genCSV / genCluster. Tắt mặc định:
+# stage() khi đó chỉ trả về dict nháp nên gần như không tốn gì. Khi bật, mỗi
+# bước ghi một dòng JSON vào file NDJSON (wall/CPU time, peak RSS, các bộ đếm
+# như rows/matched/transitions/bytes); process con ghi nối vào cùng file.
+# cpu_s là CPU của luồng chạy bước đó (time.thread_time), bước chạy ngoài luồng chính
+# (luồng ghi mảnh nền của genFullMap) có thêm nhãn "thread". peak_rss_mb và đỉnh
+# tracemalloc là của cả process; cProfile chỉ thấy luồng chính -> khi bật profile,
+# genFullMap ghi mảnh ngay trên luồng chính để số đo từng bước không bị lẫn.
+_CONFIG = {"path": None, "run": None, "profile": None}
+_PROFILER = None
+
+def enabled():
+    return _CONFIG["path"] is not None
+
+def profiling():
+    """Đang bật cProfile / tracemalloc (số đo chỉ đúng khi các bước không chạy chồng nhau)."""
+    return enabled() and _CONFIG["profile"] is not None
+
+def config():
+    """Cấu hình hiện tại, truyền cho process con (configure(**config()))."""
+    return dict(_CONFIG)
+
+def configure(path=None, run=None, profile=None):
+    """Nhận cấu hình từ process cha (không ghi bản ghi mở đầu, không bật cProfile)."""
+    _CONFIG.update(path=path, run=run, profile=profile)
+    if path and profile == 'tracemalloc' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def enable(path=METRICS_FILE, profile=None):
+    """Bật ghi metrics vào `path` (NDJSON, ghi nối). profile: None, 'cprofile' hoặc 'tracemalloc'."""
+    global _PROFILER
+    if profile not in (None,) + PROFILE_MODES:
+        raise ValueError(f"profile phải là None hoặc một trong {PROFILE_MODES}")
+    configure(path, f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}", profile)
+    if profile == 'cprofile':
+        _PROFILER = cProfile.Profile()
+        _PROFILER.enable()
+    emit({"event": "run_start", "profile": profile})
+
+def peak_rss_mb():
+    """RSS lớn nhất của process tới lúc này (MB), None nếu không đo được."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux trả KB, macOS trả byte
+        return round(peak / (2**20 if os.uname().sysname == 'Darwin' else 2**10), 1)
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / 2**20, 1)
+    except (ImportError, AttributeError):
+        return None
+
+def emit(record):
+    if not enabled():
+        return
+    record = {"ts": time.strftime('%Y-%m-%dT%H:%M:%S'), "run": _CONFIG["run"], "pid": os.getpid(), **record}
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    # Một lần write ở chế độ append -> các process không chen ngang dòng của nhau
+    with open(_CONFIG["path"], 'a', encoding='utf-8') as f:
+        f.write(line)
+
+class Stage:
+    """Một bước đang đo; gán bộ đếm bằng stage['rows'] = ... rồi gọi done()."""
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.counters = dict(labels)
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        if _CONFIG["profile"] == 'tracemalloc' and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def __setitem__(self, key, value):
+        self.counters[key] = value
+
+    def __getitem__(self, key):
+        return self.counters[key]
+
+    def get(self, key, default=None):
+        return self.counters.get(key, default)
+
+    def done(self, **counters):
+        self.counters.update(counters)
+        record = {
+            "event": "stage", "stage": self.name, **self.counters,
+            "wall_s": round(time.perf_counter() - self.wall, 4),
+            "cpu_s": round(time.thread_time() - self.cpu, 4),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if threading.current_thread() is not threading.main_thread():
+            record["thread"] = threading.current_thread().name
+        if _CONFIG["profile"] == 'tracemalloc' and tracemalloc.is_tracing():
+            record["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        emit(record)
+
+def start(name, **labels):
+    """Bắt đầu đo một bước (dùng khi không bọc được bằng `with stage(...)`)."""
+    return Stage(name, labels) if enabled() else _NullStage()
+
+class _NullStage(dict):
+    def done(self, **counters):
+        pass
+
+@contextlib.contextmanager
+def stage(name, **labels):
+    """with stage('map_matching', file=...) as st: ...; st['rows'] = n"""
+    st = start(name, **labels)
+    yield st
+    st.done()
+
+def file_bytes(*paths):
+    """Tổng dung lượng các file/thư mục đang tồn tại (đếm byte đã ghi)."""
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        elif os.path.isdir(path):
+            total += sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+    return total
+
+def summarize(path=None, run=None):
+    """Cộng các bản ghi stage của một lần chạy theo tên bước (lần chạy cuối nếu run=None)."""
+    path = path or _CONFIG["path"]
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    if run is None:
+        starts = [r["run"] for r in records if r.get("event") == "run_start"]
+        run = starts[-1] if starts else None
+    stages = {}
+    for r in records:
+        if r.get("run") != run or r.get("event") != "stage":
+            continue
+        total = stages.setdefault(r["stage"], {"calls": 0})
+        total["calls"] += 1
+        for key, value in r.items():
+            if key in ("ts", "run", "pid", "event", "stage", "peak_rss_mb", "tracemalloc_peak_mb", "match_rate"):
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                total[key] = round(total.get(key, 0) + value, 4)
+        for key in ("peak_rss_mb", "tracemalloc_peak_mb"):
+            if r.get(key) is not None:
+                total[key] = max(total.get(key, 0), r[key])
+    for total in stages.values():
+        if total.get("rows") and "matched" in total:
+            total["match_rate"] = round(total["matched"] / total["rows"], 4)
+    return run, stages
+
+def finish():
+    """Tắt profiler, ghi bản tổng kết (event=summary) và in bảng thời gian theo bước."""
+    global _PROFILER
+    if not enabled():
+        return None
+    summary = {"event": "summary"}
+    if _PROFILER is not None:
+        _PROFILER.disable()
+        prof_path = f"{os.path.splitext(_CONFIG['path'])[0]}.prof"
+        _PROFILER.dump_stats(prof_path)
+        out = io.StringIO()
+        pstats.Stats(_PROFILER, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        summary["cprofile"] = {"file": prof_path, "top": out.getvalue().splitlines()}
+        _PROFILER = None
+    if _CONFIG["profile"] == 'tracemalloc' and tracemalloc.is_tracing():
+        top = tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_TOP]
+        summary["tracemalloc_top"] = [str(s) for s in top]
+        tracemalloc.stop()
+
+    run, stages = summarize()
+    summary["stages"] = stages
+    emit(summary)
+    print(f"\n📈 Metrics ({_CONFIG['path']}):")
+    for name, total in stages.items():
+        print(f"   {name:<26} {total['calls']:>5} lần  wall {total.get('wall_s', 0):>9.3f}s  cpu {total.get('cpu_s', 0):>9.3f}s")
+    configure(None, None, None)
+    return summary
@@ -0,0 +1,155 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+import contextlib
+import pandas as pd
+
+# --- CẤU HÌNH ---
+INPUT_DIR = 'traffic_data_chunks'
+DB_FILENAME = 'traffic.sqlite'   # nằm trong thư mục mảnh (traffic_data_chunks/)
+BUSY_TIMEOUT_MS = 60_000         # các worker ghi song song chờ nhau thay vì lỗi "database is locked"
+
+# Kho SQLite (stdlib) song song với các mảnh JSON: bảng edges (agg theo cạnh) và
+# trips (chuyến đi từng xe), mỗi dòng gắn (date, hour). Ghi theo từng mảnh giờ
+# trong một transaction (xóa dòng cũ của giờ đó rồi executemany), chế độ WAL
+# để đọc trong lúc đang ghi. Các truy vấn hẹp (một cạnh, một xe, một giờ) đi
+# qua index thay vì quét toàn bộ thư mục mảnh.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS edges (
+    date TEXT NOT NULL, hour INTEGER NOT NULL, from_id INTEGER NOT NULL, to_id INTEGER NOT NULL,
+    avg_speed_kmh REAL, avg_time_sec REAL, trip_count INTEGER,
+    p50_speed_kmh REAL, p85_speed_kmh REAL, speed_variance REAL
+);
+CREATE TABLE IF NOT EXISTS trips (
+    date TEXT NOT NULL, hour INTEGER NOT NULL, vehicle_id TEXT NOT NULL, from_id INTEGER NOT NULL,
+    to_id INTEGER NOT NULL, speed_kmh REAL, travel_time_sec REAL
+);
+CREATE INDEX IF NOT EXISTS edges_date_hour ON edges (date, hour);
+CREATE INDEX IF NOT EXISTS edges_from_to ON edges (from_id, to_id);
+CREATE INDEX IF NOT EXISTS trips_date_hour ON trips (date, hour);
+CREATE INDEX IF NOT EXISTS trips_from_to ON trips (from_id, to_id);
+CREATE INDEX IF NOT EXISTS trips_vehicle ON trips (vehicle_id);
+"""
+
+# Mỗi process / luồng giữ một kết nối cho mỗi file DB (worker và luồng ghi nền ghi nhiều
+# mảnh liên tiếp); check_same_thread=False để luồng chính đóng được sau khi luồng ghi đã dừng
+_CONNECTIONS = {}
+
+def db_path(out_dir):
+    return os.path.join(out_dir, DB_FILENAME)
+
+def connect(path):
+    """Kết nối (dùng lại trong process / luồng) tới DB, tạo bảng / index nếu chưa có."""
+    key = (os.path.abspath(path), os.getpid(), threading.get_ident())
+    conn = _CONNECTIONS.get(key)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.executescript(SCHEMA)
+        _CONNECTIONS[key] = conn
+    return conn
+
+def close(path=None):
+    """Đóng kết nối đã mở (của một DB hoặc tất cả)."""
+    for key in [k for k in _CONNECTIONS if path is None or k[0] == os.path.abspath(path)]:
+        _CONNECTIONS.pop(key).close()
+
+@contextlib.contextmanager
+def _transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def _delete_hour(conn, date_key, h):
+    conn.execute("DELETE FROM edges WHERE date = ? AND hour = ?", (date_key, int(h)))
+    conn.execute("DELETE FROM trips WHERE date = ? AND hour = ?", (date_key, int(h)))
+
+def write_chunk(path, date_key, h, chunk):
+    """Thay toàn bộ dòng của mảnh (date, h) bằng nội dung `chunk` trong một transaction."""
+    h = int(h)
+    with _transaction(connect(path)) as conn:
+        _delete_hour(conn, date_key, h)
+        conn.executemany(
+            "INSERT INTO edges VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((date_key, h, e["f"], e["t"], e["s"], e["tm"], e["c"], e.get("p50"), e.get("p85"), e.get("var"))
+             for e in chunk["agg"])
+        )
+        conn.executemany(
+            "INSERT INTO trips VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((date_key, h, vid, e["f"], e["t"], e["s"], e["tm"]) for vid, arr in chunk["veh"].items() for e in arr)
+        )
+
+def remove_hours(path, date_key, hours):
+    """Xóa các mảnh giờ đã bị bỏ khỏi build."""
+    if not os.path.exists(path):
+        return
+    with _transaction(connect(path)) as conn:
+        for h in hours:
+            _delete_hour(conn, date_key, h)
+
+def import_shards(out_dir=INPUT_DIR, path=None):
+    """Nạp các mảnh JSON đã có (build trước khi bật sqlite) vào DB. Trả về số mảnh đã nạp."""
+    path = path or db_path(out_dir)
+    count = 0
+    for fname in sorted(os.listdir(out_dir)):
+        m = re.match(r'(\d{4}-\d{2}-\d{2})_(\d+)\.json$', fname)
+        if not m:
+            continue
+        with open(os.path.join(out_dir, fname), 'r') as f:
+            write_chunk(path, m.group(1), m.group(2), json.load(f))
+        count += 1
+    return count
+
+# --- Truy vấn (trả về DataFrame) ---
+
+def _where(date_from=None, date_to=None, hours=None, **eq):
+    clauses, args = [], []
+    for column, value in eq.items():
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            args.append(value)
+    if date_from is not None:
+        clauses.append("date >= ?")
+        args.append(date_from)
+    if date_to is not None:
+        clauses.append("date <= ?")
+        args.append(date_to)
+    if hours is not None:
+        hours = sorted({int(h) for h in hours})
+        clauses.append(f"hour IN ({', '.join('?' * len(hours))})")
+        args.extend(hours)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", args
+
+def query(path, sql, args=()):
+    return pd.read_sql_query(sql, connect(path), params=list(args))
+
+def edge_trips(path, from_id, to_id, date_from=None, date_to=None, hours=None):
+    """Mọi chuyến trên cạnh from_id -> to_id trong khoảng ngày [date_from, date_to] (đi qua index from/to)."""
+    where, args = _where(date_from, date_to, hours, from_id=int(from_id), to_id=int(to_id))
+    return query(path, f"SELECT * FROM trips{where} ORDER BY date, hour, rowid", args)
+
+def edge_history(path, from_id, to_id, date_from=None, date_to=None, hours=None):
+    """Các dòng agg của một cạnh theo (ngày, giờ)."""
+    where, args = _where(date_from, date_to, hours, from_id=int(from_id), to_id=int(to_id))
+    return query(path, f"SELECT * FROM edges{where} ORDER BY date, hour, rowid", args)
+
+def vehicle_trips(path, vehicle_id, date_from=None, date_to=None, hours=None):
+    """Các chuyến của một xe (theo ngày, giờ)."""
+    where, args = _where(date_from, date_to, hours, vehicle_id=str(vehicle_id))
+    return query(path, f"SELECT * FROM trips{where} ORDER BY date, hour, rowid", args)
+
+def hour_edges(path, date_key, hour, min_count=None):
+    """Các cạnh agg của một mảnh giờ như `agg` trong JSON."""
+    where, args = _where(date=date_key, hour=int(hour))
+    if min_count is not None:
+        where += " AND trip_count >= ?"
+        args.append(int(min_count))
+    return query(path, f"SELECT * FROM edges{where} ORDER BY rowid", args)